@@ -0,0 +1,102 @@
+from sqlalchemy.ext.asyncio import create_async_engine
+from src import database as db
+from src.api import instrumentation
+
+import os
+
+"""
+Async (asyncpg) engine for the async cart router, pointed at the same database
+as the sync engine. Off by default; with POTION_SHOP_ASYNC_DB=1 the server
+should mount the async router instead of the sync one:
+
+    app.include_router(carts_async.router if async_database.enabled else carts.router)
+
+The sync path (db.engine + carts.router) is untouched either way.
+"""
+
+enabled = os.environ.get("POTION_SHOP_ASYNC_DB", "0") == "1"
+
+
+def libpq_options(options: str):
+    """
+    server_settings from a libpq options string ("-c key=value -c other=value", backslash
+    escapes a space in a value). Other backend flags have no asyncpg equivalent.
+    """
+    tokens = [token.replace("\0", " ") for token in options.replace("\\ ", "\0").split()]
+    settings = {}
+    while tokens:
+        token = tokens.pop(0)
+        if token == "-c" and tokens:
+            setting = tokens.pop(0)
+        elif token.startswith("-c") and len(token) > 2:
+            setting = token[2:]
+        elif token.startswith("--"):
+            setting = token[2:]
+        else:
+            raise ValueError(f"options {options!r}: only -c key=value settings can be passed to asyncpg")
+        key, sep, value = setting.partition("=")
+        if not sep:
+            raise ValueError(f"options {options!r}: {setting!r} isn't key=value")
+        settings[key.replace("-", "_")] = value
+    return settings
+
+
+def connect_args(query):
+    """
+    asyncpg.connect() args for the libpq query args on db.engine's url. asyncpg doesn't read
+    them itself, so the ones it has an equivalent for are translated and anything else is a
+    ValueError, instead of a setting that quietly doesn't apply on the async path.
+    """
+    args = {}
+    server_settings = {}
+    for key, value in query.items():
+        # repeated args come back as a tuple, libpq takes the last one
+        value = value[-1] if isinstance(value, tuple) else value
+        if key == "sslmode":
+            # same disable/allow/prefer/require/verify-ca/verify-full names
+            args["ssl"] = value
+        elif key == "connect_timeout":
+            # libpq's 0 is "wait forever", which leaves asyncpg's own default
+            if int(value) > 0:
+                args["timeout"] = float(value)
+        elif key == "application_name":
+            server_settings["application_name"] = value
+        elif key == "options":
+            server_settings.update(libpq_options(value))
+        else:
+            raise ValueError(f"database url arg {key!r} isn't supported by the async engine "
+                             "(sslmode, connect_timeout, application_name and options are)")
+    if server_settings:
+        args["server_settings"] = server_settings
+    return args
+
+
+def create_engine(pool_size: int, max_overflow: int, **pool_args):
+    """
+    An asyncpg engine on the same database as db.engine. async_engine is one, callers that
+    need a separate pool (the cart export) make their own.
+    """
+    # the url's libpq args go through connect_args (see connect_args above), the query is
+    # only the dialect's own statement cache setting.
+    # asyncpg prepares every statement server side; the cache keeps them per connection, and has to
+    # hold all of statements.registry (search alone has 64 variants) or they get re-prepared.
+    # Set it to 0 behind pgbouncer in transaction mode, which can't keep prepared statements.
+    statement_cache_size = os.environ.get("POTION_SHOP_ASYNC_STATEMENT_CACHE", "500")
+    async_url = db.engine.url.set(drivername="postgresql+asyncpg",
+                                  query={"prepared_statement_cache_size": statement_cache_size})
+    engine = create_async_engine(
+        async_url,
+        connect_args=connect_args(db.engine.url.query),
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=True,
+        **pool_args,
+    )
+    instrumentation.install(engine.sync_engine)
+    return engine
+
+
+async_engine = None
+if enabled:
+    async_engine = create_engine(pool_size=int(os.environ.get("POTION_SHOP_ASYNC_POOL_SIZE", "20")),
+                                 max_overflow=int(os.environ.get("POTION_SHOP_ASYNC_MAX_OVERFLOW", "10")))
@@ -0,0 +1,166 @@
+from concurrent.futures import Future
+import asyncio
+import threading
+
+"""
+Group commit for the routers: calls that show up within a short window get
+handed to one handler call (one transaction) instead of one each.
+
+The handler takes the list of items and returns one result per item, in order.
+A result that is an Exception gets raised to just that caller, so a handler can
+fall back to doing items one at a time and only fail the ones that really failed.
+
+With max_pending set, submit() raises QueueFull once that many items are queued
+or in flight, so callers can shed load (429/503) instead of piling up.
+"""
+
+
+class QueueFull(Exception):
+    pass
+
+
+class MicroBatcher:
+    """
+    For sync handlers running in FastAPI's threadpool. The first caller into an
+    empty batch waits out the window (or until max_batch callers have joined),
+    then runs the whole batch while everyone else blocks on their own result.
+    Only one batch runs at a time; callers that arrive meanwhile form the next one.
+    """
+
+    def __init__(self, handler, window_seconds: float = 0.005, max_batch: int = 500, max_pending: int = None):
+        self.handler = handler
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.batches = 0
+        self.items = 0
+        self.largest = 0
+        self.rejected = 0
+        self.depth = 0
+        self._pending = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+
+    def submit(self, item):
+        future = Future()
+        with self._cond:
+            if self.max_pending is not None and self.depth >= self.max_pending:
+                self.rejected += 1
+                raise QueueFull(f"{self.depth} items queued")
+            self.depth += 1
+            self._pending.append((item, future))
+            leader = len(self._pending) == 1
+            self._cond.notify_all()
+        if leader:
+            self._lead()
+        try:
+            return future.result()
+        finally:
+            with self._cond:
+                self.depth -= 1
+
+    def _lead(self):
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._pending) >= self.max_batch, timeout=self.window_seconds)
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            for start in range(0, len(batch), self.max_batch):
+                self._run(batch[start:start + self.max_batch])
+
+    def _run(self, batch: list):
+        self.batches += 1
+        self.items += len(batch)
+        self.largest = max(self.largest, len(batch))
+        try:
+            results = self.handler([item for item, future in batch])
+        except Exception as e:
+            for item, future in batch:
+                future.set_exception(e)
+            return
+        for (item, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.largest,
+            "window_ms": self.window_seconds * 1000,
+            "depth": self.depth,
+            "rejected": self.rejected,
+        }
+
+
+class AsyncMicroBatcher(MicroBatcher):
+    """
+    Same thing on the event loop, for async handlers (carts_async).
+    """
+
+    def __init__(self, handler, window_seconds: float = 0.005, max_batch: int = 500, max_pending: int = None):
+        super().__init__(handler, window_seconds, max_batch, max_pending)
+        self._loop = None
+        self._full = None
+        self._async_flush_lock = None
+        self._flushes = set()
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # asyncio primitives belong to one loop (a new asyncio.run() gets fresh ones)
+            self._loop = loop
+            self._full = asyncio.Event()
+            self._async_flush_lock = asyncio.Lock()
+        if self.max_pending is not None and self.depth >= self.max_pending:
+            self.rejected += 1
+            raise QueueFull(f"{self.depth} items queued")
+        self.depth += 1
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        if len(self._pending) == 1:
+            # the flush runs as its own task, so cancelling the request that started it (client
+            # gone, timeout) doesn't leave everyone else in the batch waiting forever
+            flush = loop.create_task(self._lead())
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+        try:
+            return await future
+        finally:
+            self.depth -= 1
+
+    async def _lead(self):
+        try:
+            await asyncio.wait_for(self._full.wait(), self.window_seconds)
+        except asyncio.TimeoutError:
+            pass
+        async with self._async_flush_lock:
+            batch, self._pending = self._pending, []
+            self._full.clear()
+            for start in range(0, len(batch), self.max_batch):
+                await self._run(batch[start:start + self.max_batch])
+
+    async def _run(self, batch: list):
+        self.batches += 1
+        self.items += len(batch)
+        self.largest = max(self.largest, len(batch))
+        try:
+            results = await self.handler([item for item, future in batch])
+        except Exception as e:
+            for item, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (item, future), result in zip(batch, results):
+            # a caller that was cancelled while waiting has nobody to hand the result to
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,550 @@
+import sqlalchemy
+from sqlalchemy import event
+from src import database as db
+from src.api import carts
+from src.api import statements
+from src.api.batching import MicroBatcher, AsyncMicroBatcher
+from src.api.game_clock import clock as game_clock
+
+import argparse
+import asyncio
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Load + latency benchmark for the cart flow:
+    post_visits -> create_cart -> set_item_quantity -> checkout, plus search_orders.
+
+Seeds a LOCAL Postgres (whatever src.database points at) with the base schema,
+millions of line items / ledger rows and the migrations, then drives the router
+functions concurrently and reports p50/p95/p99 latency, requests/sec and SQL
+statements per request for each endpoint.
+
+    python -m src.api.benchmark --seed --line-items 3000000
+    python -m src.api.benchmark --concurrency 200 --sessions 5000
+    POTION_SHOP_ASYNC_DB=1 python -m src.api.benchmark --concurrency 200 --async
+    python -m src.api.benchmark --checkout-burst 50 200 1000 --checkout-batch-ms 5
+    python -m src.api.benchmark --check-search-plans
+
+Handlers are called directly (no HTTP), so the numbers are handler + db time.
+
+Parse/plan counts are measured from pg_stat_statements when the database has it
+with planning tracked (CREATE EXTENSION pg_stat_statements, and
+pg_stat_statements.track_planning = on). Otherwise --async prints an estimate
+from per-connection prepared statements; the sync engine (psycopg2) doesn't
+prepare anything, so there every statement is parsed and planned.
+"""
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+POTIONS = [
+    ("RED_POTION", "red potion", 50, [100, 0, 0, 0]),
+    ("GREEN_POTION", "green potion", 50, [0, 100, 0, 0]),
+    ("BLUE_POTION", "blue potion", 60, [0, 0, 100, 0]),
+    ("DARK_POTION", "dark potion", 80, [0, 0, 0, 100]),
+    ("PURPLE_POTION", "purple potion", 65, [50, 0, 50, 0]),
+    ("YELLOW_POTION", "yellow potion", 55, [50, 50, 0, 0]),
+]
+
+CLASSES = ["Druid", "Wizard", "Rogue", "Fighter", "Bard", "Cleric"]
+
+
+# -----------------------------------------------
+# Statement counting
+# -----------------------------------------------
+current_call = contextvars.ContextVar("current_call", default=None)
+unattributed = {"statements": 0}
+count_lock = threading.Lock()
+
+# (dbapi connection, statement text) pairs: with per-connection prepared statements
+# (asyncpg) each pair is one parse/plan, everything else reuses it
+executions = {"total": 0}
+prepared_pairs = set()
+statement_texts = set()
+
+
+plan_counts_sql = sqlalchemy.text("""
+                                SELECT COALESCE(SUM(calls), 0) AS calls, COALESCE(SUM(plans), 0) AS plans
+                                FROM pg_stat_statements
+                                WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+                                    -- BEGIN/COMMIT/SET count as calls but are never planned
+                                    AND query ~* '^[[:space:]]*(select|insert|update|delete|with)'
+                                """)
+
+
+def plan_counts():
+    """
+    (statements run, plans made) in this database so far, or None without pg_stat_statements
+    tracking planning.
+    """
+    try:
+        with db.engine.connect() as connection:
+            tracked = connection.execute(
+                sqlalchemy.text("SELECT current_setting('pg_stat_statements.track_planning', true)")).scalar()
+            if tracked != "on":
+                return None
+            row = connection.execute(plan_counts_sql).fetchone()
+    except sqlalchemy.exc.DBAPIError:
+        return None
+    return int(row.calls), int(row.plans)
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    with count_lock:
+        executions["total"] += 1
+        statement_texts.add(statement)
+        prepared_pairs.add((id(conn.connection.dbapi_connection), statement))
+    call = current_call.get()
+    if call is None:
+        with count_lock:
+            unattributed["statements"] += 1
+    else:
+        call["statements"] += 1
+
+
+# -----------------------------------------------
+# Seeding
+# -----------------------------------------------
+def check_local(force: bool):
+    host = db.engine.url.host or "localhost"
+    if host not in ("localhost", "127.0.0.1", "::1") and not force:
+        sys.exit(f"Refusing to seed/benchmark non-local database host {host!r} (use --force if you mean it)")
+
+
+def run_autocommit(sql: str):
+    """
+    Straight to the driver in autocommit: files hold several statements, DO blocks and their own BEGIN/COMMIT.
+    """
+    raw = db.engine.raw_connection()
+    try:
+        # on the driver's connection itself, setting it on the pool's proxy does nothing (and the
+        # pool's rollback on return would quietly undo the whole file)
+        raw.dbapi_connection.autocommit = True
+        with raw.cursor() as cursor:
+            cursor.execute(sql)
+    finally:
+        raw.dbapi_connection.autocommit = False
+        raw.close()
+
+
+def run_sql_file(path: str):
+    with open(path) as sql_file:
+        run_autocommit(sql_file.read())
+
+
+def apply_migrations():
+    migrations_dir = os.path.join(here, "migrations")
+    with db.engine.begin() as connection:
+        applied = set(connection.execute(sqlalchemy.text("SELECT name FROM schema_migrations")).scalars())
+
+    for name in sorted(os.listdir(migrations_dir)):
+        if not name.endswith(".sql") or name in applied:
+            continue
+        print(f"Applying {name}")
+        run_sql_file(os.path.join(migrations_dir, name))
+        with db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": name})
+
+
+def seed(customers: int, line_items: int, ledger_rows: int):
+    """
+    Bulk loads with generate_series *before* the migrations, so the balance triggers
+    aren't fired row by row for millions of rows (002 seeds the balances from the ledgers).
+    """
+    # throwaway db: start from nothing so the migrations (and their triggers) all run fresh after the load
+    run_autocommit("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+    run_sql_file(os.path.join(here, "benchmark_schema.sql"))
+
+    cart_count = max(1, line_items // 3)
+    seed_params = {"customers": customers, "carts": cart_count, "line_items": line_items,
+                   "ledger_rows": ledger_rows, "classes": CLASSES}
+
+    seed_sql = [
+        "INSERT INTO curr_time (day, hour) SELECT GREATEST(:carts, :ledger_rows) / 20000 + 1, 0",
+        "INSERT INTO capacity (ml, potions) VALUES (10000, 50), (30000, 50), (60000, 0)",
+        "INSERT INTO goal_ml (med_goal, lg_goal, low_ml_limit) VALUES (5000, 20000, 500)",
+        """INSERT INTO customers (cust_name, cust_class, level)
+           SELECT 'customer_' || g, (CAST(:classes AS text[]))[1 + g % 6], 1 + g % 20
+           FROM generate_series(1, :customers) g""",
+        """INSERT INTO carts (cust_id, game_day, game_hr, created_at)
+           SELECT 1 + g % :customers, g / 20000, (g % 12) * 2, now() - make_interval(secs => :carts - g)
+           FROM generate_series(1, :carts) g""",
+        """INSERT INTO line_items (cart_id, item_sku, potion_id, quantity, price, created_at)
+           SELECT 1 + (g - 1) / 3, potion_inventory.sku, potion_inventory.id, 1 + g % 4, potion_inventory.price,
+                  now() - make_interval(secs => :line_items - g)
+           FROM generate_series(1, :line_items) g
+           JOIN potion_inventory ON potion_inventory.id = 1 + ((g - 1) / 3 + (g - 1) % 3) % 6
+           WHERE 1 + (g - 1) / 3 <= :carts""",
+        """INSERT INTO gold_ledger (transactions, game_day, game_hr, reason)
+           SELECT CASE WHEN g = 1 THEN 100000 ELSE 50 + g % 100 END, g / 20000, (g % 12) * 2, 'seed'
+           FROM generate_series(1, :ledger_rows) g""",
+        """INSERT INTO ml_ledger (red, green, blue, dark, game_day, game_hr)
+           SELECT 500, 500, 500, 100, g / 20000, (g % 12) * 2
+           FROM generate_series(1, :ledger_rows) g""",
+        """INSERT INTO potion_ledger (potion_id, transaction, reason)
+           SELECT 1 + g % 6, 5, 'seed'
+           FROM generate_series(1, :ledger_rows) g""",
+    ]
+
+    with db.engine.begin() as connection:
+        for sql in seed_sql[:3]:
+            connection.execute(sqlalchemy.text(sql), seed_params)
+        connection.execute(sqlalchemy.text("""INSERT INTO potion_inventory (sku, name, price, potion_type, bottle_goal)
+                                              VALUES (:sku, :name, :price, :potion_type, 20)"""),
+                           [{"sku": sku, "name": name, "price": price, "potion_type": potion_type}
+                            for sku, name, price, potion_type in POTIONS])
+        for sql in seed_sql[3:]:
+            print(f"Seeding: {sql.split()[2]}")
+            connection.execute(sqlalchemy.text(sql), seed_params)
+
+    run_autocommit("ANALYZE")
+
+
+# -----------------------------------------------
+# Search plans
+# -----------------------------------------------
+# (customer_name, potion_sku) -> trigram indexes (migrations/001) the plan has to use.
+# The terms are selective on the seeded data (customer_<n>, 6 skus): a real sku matches
+# a sixth of line_items, and there walking the sort index is the cheaper plan.
+SEARCH_PLAN_CASES = [
+    (("customer_4242", ""), {"customers_cust_name_trgm_idx"}),
+    (("", "mithril"), {"line_items_item_sku_trgm_idx"}),
+    # with both filters either index will do
+    (("customer_4242", "mithril"), {"customers_cust_name_trgm_idx", "line_items_item_sku_trgm_idx"}),
+]
+
+
+def plan_indexes(plan: dict):
+    indexes = {plan["Index Name"]} if "Index Name" in plan else set()
+    for child in plan.get("Plans", []):
+        indexes |= plan_indexes(child)
+    return indexes
+
+
+def check_search_plans():
+    """
+    EXPLAIN (FORMAT JSON) on the customer_name/potion_sku search statements, every sort
+    column and order. Returns the ones whose plan doesn't use a trigram index.
+    """
+    failures = []
+    with db.engine.begin() as connection:
+        for sort_col in carts.search_sort_options:
+            for sort_order in carts.search_sort_order:
+                for (customer_name, potion_sku), wanted in SEARCH_PLAN_CASES:
+                    statement, params, _ = carts.build_search_query(customer_name, potion_sku, "",
+                                                                    sort_col, sort_order)
+                    plan = connection.execute(sqlalchemy.text(f"EXPLAIN (FORMAT JSON) {statement.text}"),
+                                              params).scalar()
+                    used = plan_indexes(plan[0]["Plan"])
+                    if not used & wanted:
+                        failures.append((customer_name, potion_sku, sort_col.value, sort_order.value, sorted(used)))
+    return failures
+
+
+# -----------------------------------------------
+# Workload
+# -----------------------------------------------
+class Recorder:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def add(self, endpoint: str, seconds: float, statements: int, failed: bool):
+        with self.lock:
+            entry = self.calls.setdefault(endpoint, {"latencies": [], "statements": 0, "errors": 0})
+            entry["latencies"].append(seconds)
+            entry["statements"] += statements
+            entry["errors"] += int(failed)
+
+
+def percentile(sorted_values: list, pct: float):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def report(recorder: Recorder, wall_seconds: float, use_async: bool, plans_before: tuple = None):
+    print(f"\n{'endpoint':<20}{'calls':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'stmts/req':>11}{'errors':>8}")
+    for endpoint, entry in sorted(recorder.calls.items()):
+        latencies = sorted(entry["latencies"])
+        calls = len(latencies)
+        print(f"{endpoint:<20}{calls:>8}{calls / wall_seconds:>10.1f}"
+              f"{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 95) * 1000:>10.2f}"
+              f"{percentile(latencies, 99) * 1000:>10.2f}{entry['statements'] / calls:>11.2f}{entry['errors']:>8}")
+    total = sum(len(entry["latencies"]) for entry in recorder.calls.values())
+    print(f"\n{total} requests in {wall_seconds:.2f}s = {total / wall_seconds:.1f} req/s overall")
+    if unattributed["statements"]:
+        print(f"({unattributed['statements']} statements couldn't be attributed to an endpoint)")
+
+    plans_after = plan_counts() if plans_before is not None else None
+    total = executions["total"]
+    if plans_after is not None:
+        calls, plans = plans_after[0] - plans_before[0], plans_after[1] - plans_before[1]
+        print(f"parse/plan (pg_stat_statements, whole database): {plans} plans for {calls} statements "
+              f"({100 * (1 - plans / calls) if calls else 0:.1f}% ran without planning)")
+    elif total and use_async:
+        saved = 100 * (1 - len(prepared_pairs) / total)
+        print(f"parse/plan (estimate): {total} statements over {len(statement_texts)} distinct texts "
+              f"({len(statements.registry)} registered); prepared per connection that's "
+              f"{len(prepared_pairs)} parse/plans instead of {total} ({saved:.1f}% saved)")
+    elif total:
+        print(f"parse/plan: psycopg2 doesn't prepare, all {total} statements were parsed and planned "
+              f"(server-side prepared statements are only used with --async)")
+
+
+def session_plan(session_id: int, rng: random.Random, customers: int):
+    """
+    One shopper: a customer (mostly existing, some new), 1-3 potions and maybe a search.
+    """
+    if rng.random() < 0.8:
+        n = rng.randint(1, customers)
+        customer = carts.Customer(customer_name=f"customer_{n}", character_class=CLASSES[n % 6], level=1 + n % 20)
+    else:
+        customer = carts.Customer(customer_name=f"bench_{session_id}", character_class=rng.choice(CLASSES),
+                                  level=rng.randint(1, 20))
+    items = rng.sample([sku for sku, _, _, _ in POTIONS], rng.randint(1, 3))
+    search = None
+    if rng.random() < 0.3:
+        search = {"customer_name": rng.choice(["", "customer_1", "bench"]),
+                  "potion_sku": rng.choice(["", "red", "purple"]),
+                  "sort_col": rng.choice(list(carts.search_sort_options)),
+                  "sort_order": rng.choice(list(carts.search_sort_order))}
+    return customer, items, search
+
+
+def timed_sync(recorder: Recorder, endpoint: str, fn, *args, **kwargs):
+    call = {"statements": 0}
+    token = current_call.set(call)
+    start = time.perf_counter()
+    failed = False
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        failed = True
+        return None
+    finally:
+        recorder.add(endpoint, time.perf_counter() - start, call["statements"], failed)
+        current_call.reset(token)
+
+
+def run_session_sync(recorder: Recorder, session_id: int, plan):
+    customer, items, search = plan
+    cart = timed_sync(recorder, "create_cart", carts.create_cart, customer)
+    if cart is None:
+        return
+    for sku in items:
+        timed_sync(recorder, "set_item_quantity", carts.set_item_quantity,
+                   cart["cart_id"], sku, carts.CartItem(quantity=1 + session_id % 3))
+    timed_sync(recorder, "checkout", carts.checkout, cart["cart_id"], carts.CartCheckout(payment="gold"))
+    if search:
+        timed_sync(recorder, "search_orders", carts.search_orders, **search)
+
+
+def run_sync(plans: list, visits: list, concurrency: int, recorder: Recorder):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda batch: timed_sync(recorder, "post_visits", carts.post_visits, batch[0], batch[1]),
+                      enumerate(visits)))
+        list(pool.map(lambda item: run_session_sync(recorder, item[0], item[1]), enumerate(plans)))
+
+
+async def timed_async(recorder: Recorder, endpoint: str, fn, *args, **kwargs):
+    call = {"statements": 0}
+    token = current_call.set(call)
+    start = time.perf_counter()
+    failed = False
+    try:
+        return await fn(*args, **kwargs)
+    except Exception:
+        failed = True
+        return None
+    finally:
+        recorder.add(endpoint, time.perf_counter() - start, call["statements"], failed)
+        current_call.reset(token)
+
+
+async def run_async(plans: list, visits: list, concurrency: int, recorder: Recorder):
+    from src.api import carts_async
+
+    limit = asyncio.Semaphore(concurrency)
+
+    async def visit(visit_id, batch):
+        async with limit:
+            await timed_async(recorder, "post_visits", carts_async.post_visits, visit_id, batch)
+
+    async def session(session_id, plan):
+        customer, items, search = plan
+        async with limit:
+            cart = await timed_async(recorder, "create_cart", carts_async.create_cart, customer)
+            if cart is None:
+                return
+            for sku in items:
+                await timed_async(recorder, "set_item_quantity", carts_async.set_item_quantity,
+                                  cart["cart_id"], sku, carts.CartItem(quantity=1 + session_id % 3))
+            await timed_async(recorder, "checkout", carts_async.checkout,
+                              cart["cart_id"], carts.CartCheckout(payment="gold"))
+            if search:
+                await timed_async(recorder, "search_orders", carts_async.search_orders, **search)
+
+    await asyncio.gather(*(visit(i, batch) for i, batch in enumerate(visits)))
+    await asyncio.gather(*(session(i, plan) for i, plan in enumerate(plans)))
+
+
+def prepare_carts(plans: list, visits: list, concurrency: int):
+    """
+    Carts with items in them, ready for a checkout burst. Not timed.
+    """
+    recorder = Recorder()
+    run_sync([], visits, concurrency, recorder)
+
+    def fill(item):
+        session_id, (customer, items, search) = item
+        cart_id = carts.create_cart(customer)["cart_id"]
+        for sku in items:
+            carts.set_item_quantity(cart_id, sku, carts.CartItem(quantity=1 + session_id % 3))
+        return cart_id
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(fill, enumerate(plans)))
+
+
+def run_checkouts_sync(cart_ids: list, concurrency: int, recorder: Recorder):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda cart_id: timed_sync(recorder, "checkout", carts.checkout,
+                                                 cart_id, carts.CartCheckout(payment="gold")), cart_ids))
+
+
+async def run_checkouts_async(cart_ids: list, concurrency: int, recorder: Recorder):
+    from src.api import carts_async
+    from src.api.async_database import async_engine
+
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(cart_id):
+        async with limit:
+            await timed_async(recorder, "checkout", carts_async.checkout, cart_id, carts.CartCheckout(payment="gold"))
+
+    await asyncio.gather(*(one(cart_id) for cart_id in cart_ids))
+    # pooled asyncpg connections belong to this event loop, the next level runs on a new one
+    await async_engine.dispose()
+
+
+def install_checkout_batcher(args):
+    """
+    --checkout-batch-ms > 0 turns on group commit for whichever router is being driven.
+    """
+    if args.checkout_batch_ms <= 0:
+        return None
+    if args.use_async:
+        from src.api import carts_async
+        carts_async.checkout_batcher = AsyncMicroBatcher(carts_async.checkout_carts, args.checkout_batch_ms / 1000)
+        return carts_async.checkout_batcher
+    carts.checkout_batcher = MicroBatcher(carts.checkout_carts, args.checkout_batch_ms / 1000)
+    return carts.checkout_batcher
+
+
+def checkout_burst(args, plans: list, visits: list, batcher):
+    """
+    Only checkouts, all at once, at each concurrency level: fresh carts per level so
+    every checkout really writes.
+    """
+    for concurrency in args.checkout_burst:
+        cart_ids = prepare_carts(plans, visits, args.concurrency)
+        recorder = Recorder()
+        plans_before = plan_counts()
+        start = time.perf_counter()
+        if args.use_async:
+            asyncio.run(run_checkouts_async(cart_ids, concurrency, recorder))
+        else:
+            run_checkouts_sync(cart_ids, concurrency, recorder)
+        wall_seconds = time.perf_counter() - start
+
+        print(f"\nmode={'async' if args.use_async else 'sync'} checkout burst concurrency={concurrency} "
+              f"carts={len(cart_ids)} batch_ms={args.checkout_batch_ms}")
+        report(recorder, wall_seconds, args.use_async, plans_before)
+        if batcher is not None:
+            print(f"batches: {batcher.stats()}")
+            batcher.batches = batcher.items = batcher.largest = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Potion shop cart flow benchmark")
+    parser.add_argument("--seed", action="store_true", help="(re)create and seed the benchmark data first")
+    parser.add_argument("--customers", type=int, default=100_000)
+    parser.add_argument("--line-items", type=int, default=3_000_000)
+    parser.add_argument("--ledger-rows", type=int, default=1_000_000)
+    parser.add_argument("--sessions", type=int, default=2000, help="shoppers to run through the cart flow")
+    parser.add_argument("--visit-batch", type=int, default=500, help="customers per post_visits call")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="drive carts_async instead of carts")
+    parser.add_argument("--random-seed", type=int, default=7)
+    parser.add_argument("--checkout-burst", type=int, nargs="+",
+                        help="only time checkouts, at each of these concurrency levels (e.g. 50 200 1000)")
+    parser.add_argument("--checkout-batch-ms", type=float, default=0,
+                        help="group checkouts arriving within this window into one transaction (0 = off)")
+    parser.add_argument("--check-search-plans", action="store_true",
+                        help="only check that the search filters use the trigram indexes, exit 1 if not")
+    parser.add_argument("--force", action="store_true", help="allow a non-local database")
+    args = parser.parse_args()
+
+    check_local(args.force)
+
+    if args.seed:
+        seed(args.customers, args.line_items, args.ledger_rows)
+    else:
+        run_sql_file(os.path.join(here, "benchmark_schema.sql"))
+    apply_migrations()
+
+    if args.check_search_plans:
+        failures = check_search_plans()
+        for customer_name, potion_sku, sort_col, sort_order, used in failures:
+            print(f"search customer_name={customer_name!r} potion_sku={potion_sku!r} "
+                  f"sort={sort_col} {sort_order}: no trigram index, plan uses {used}")
+        if failures:
+            sys.exit(1)
+        print("search plans: all use the trigram indexes")
+        return
+
+    rng = random.Random(args.random_seed)
+    plans = [session_plan(i, rng, args.customers) for i in range(args.sessions)]
+    shoppers = [plan[0] for plan in plans]
+    visits = [shoppers[i:i + args.visit_batch] for i in range(0, len(shoppers), args.visit_batch)]
+
+    with db.engine.begin() as connection:
+        game_clock.current(connection)
+
+    if args.use_async:
+        from src.api.async_database import async_engine
+        if async_engine is None:
+            sys.exit("--async needs POTION_SHOP_ASYNC_DB=1")
+        event.listen(async_engine.sync_engine, "before_cursor_execute", count_statement)
+    else:
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+
+    batcher = install_checkout_batcher(args)
+    if args.checkout_burst:
+        checkout_burst(args, plans, visits, batcher)
+        return
+
+    recorder = Recorder()
+    plans_before = plan_counts()
+    start = time.perf_counter()
+    if args.use_async:
+        asyncio.run(run_async(plans, visits, args.concurrency, recorder))
+    else:
+        run_sync(plans, visits, args.concurrency, recorder)
+    wall_seconds = time.perf_counter() - start
+
+    print(f"\nmode={'async' if args.use_async else 'sync'} concurrency={args.concurrency} sessions={args.sessions}")
+    report(recorder, wall_seconds, args.use_async, plans_before)
+    if batcher is not None:
+        print(f"checkout batches: {batcher.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+-- Base tables for the local benchmark database, as the routers use them.
+-- Only for seeding a throwaway Postgres; the real schema lives with the deployed app.
+
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    name        text PRIMARY KEY,
+    applied_at  timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS curr_time (
+    day     int NOT NULL,
+    hour    int NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS capacity (
+    id          serial PRIMARY KEY,
+    ml          int NOT NULL,
+    potions     int NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS goal_ml (
+    med_goal        int NOT NULL,
+    lg_goal         int NOT NULL,
+    low_ml_limit    int NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS potion_inventory (
+    id              serial PRIMARY KEY,
+    sku             text NOT NULL UNIQUE,
+    name            text NOT NULL,
+    price           int NOT NULL,
+    potion_type     int[] NOT NULL,
+    bottle_goal     int NOT NULL DEFAULT 10
+);
+
+CREATE TABLE IF NOT EXISTS customers (
+    id          serial PRIMARY KEY,
+    cust_name   text NOT NULL,
+    cust_class  text NOT NULL,
+    level       int NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS carts (
+    id          serial PRIMARY KEY,
+    cust_id     int REFERENCES customers (id),
+    game_day    int,
+    game_hr     int,
+    created_at  timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS line_items (
+    line_id     serial PRIMARY KEY,
+    cart_id     int NOT NULL REFERENCES carts (id),
+    item_sku    text NOT NULL,
+    potion_id   int REFERENCES potion_inventory (id),
+    quantity    int NOT NULL,
+    price       int,
+    created_at  timestamptz NOT NULL DEFAULT now(),
+    UNIQUE (cart_id, item_sku)
+);
+
+CREATE TABLE IF NOT EXISTS gold_ledger (
+    id              serial PRIMARY KEY,
+    transactions    int,
+    game_day        int,
+    game_hr         int,
+    reason          text,
+    cart_id         int,
+    created_at      timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS ml_ledger (
+    id          serial PRIMARY KEY,
+    red         int NOT NULL DEFAULT 0,
+    green       int NOT NULL DEFAULT 0,
+    blue        int NOT NULL DEFAULT 0,
+    dark        int NOT NULL DEFAULT 0,
+    game_day    int,
+    game_hr     int,
+    created_at  timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS potion_ledger (
+    id              serial PRIMARY KEY,
+    potion_id       int REFERENCES potion_inventory (id),
+    transaction     int NOT NULL,
+    cart_id         int,
+    reason          text,
+    created_at      timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS processed (
+    id          serial PRIMARY KEY,
+    job_id      int NOT NULL,
+    type        text NOT NULL,
+    created_at  timestamptz NOT NULL DEFAULT now(),
+    UNIQUE (job_id, type)
+);
@@ -2,86 +2,144 @@ from fastapi import APIRouter, Depends
 from enum import Enum
 from pydantic import BaseModel
 from src.api import auth
+from src.api import capture
+from src.api import instrumentation
+from src.api import replica_database
+from src.api import sales
+from src.api import planning
+from src.api import statements
+from src.api.fast_json import FastJSONResponse
 
-import sqlalchemy
-from src import database as db
-from sqlalchemy.exc import IntegrityError
+from src.api.game_clock import clock as game_clock
+from src.api.potion_catalog import catalog as potion_catalog
 
+import logging
+
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/bottler",
     tags=["bottler"],
-    dependencies=[Depends(auth.get_api_key)],
+    dependencies=[Depends(auth.get_api_key), Depends(instrumentation.track_request)],
+    route_class=capture.CaptureRoute,
 )
 
 class PotionInventory(BaseModel):
     potion_type: list[int]
     quantity: int
 
+# claim the processed row first: a repeated delivery is this one statement and writes nothing.
+# potion ids come from the catalog's potion_type map (unique index from migrations/006),
+# and the whole delivery goes into potion_ledger as one unnest insert
+deliver_bottles_sql = statements.register("bottler.deliver", """
+                    WITH claim AS (
+                        INSERT INTO processed (job_id, type)
+                        VALUES (:order_id, 'bottler')
+                        ON CONFLICT DO NOTHING
+                        RETURNING job_id
+                    ),
+                    ml_subtract AS (
+                        INSERT INTO ml_ledger (red, green, blue, dark, game_day, game_hr)
+                        SELECT :red, :green, :blue, :dark, :game_day, :game_hr
+                        WHERE EXISTS (SELECT 1 FROM claim)
+                    ),
+                    potion_add AS (
+                        INSERT INTO potion_ledger (transaction, potion_id, reason, game_day, game_hr)
+                        SELECT delivered.transaction, delivered.potion_id, 'Bobo be bottling', :game_day, :game_hr
+                        FROM unnest(CAST(:potion_ids AS int[]), CAST(:transactions AS int[]))
+                            AS delivered (potion_id, transaction)
+                        WHERE EXISTS (SELECT 1 FROM claim)
+                    )
+                    SELECT EXISTS (SELECT 1 FROM claim) AS claimed
+                    """)
+
+
+def potion_ids_for(connection, potion_rows: list):
+    """
+    potion_id per delivered row (None if we don't sell that mix), reloading the
+    catalog once in case the mix was added since it was cached.
+    """
+    potion_catalog.ensure_loaded(connection)
+    potion_ids = [potion_catalog.lookup_type(potion['potion_type']) for potion in potion_rows]
+    if None in potion_ids:
+        potion_catalog.invalidate()
+        potion_catalog.ensure_loaded(connection)
+        potion_ids = [potion_catalog.lookup_type(potion['potion_type']) for potion in potion_rows]
+    return potion_ids
+
+
 @router.post("/deliver/{order_id}")
 def post_deliver_bottles(potions_delivered: list[PotionInventory], order_id: int):
     """ 
     """
-    ml_to_subtract= {
-                        'red': 0,
-                        'green': 0,
-                        'blue': 0,
-                        'dark': 0
-                    }
-    
-    potion_list_of_dicts = []
-    for potion in potions_delivered:
-        potion_list_of_dicts.append({
-                                        "potion_type": potion.potion_type, 
-                                        "transaction": potion.quantity
-                                        })
-                                    
-
-    
-    for potion in potions_delivered:
-        for mix_color, sub_color in zip(potion.potion_type, ml_to_subtract.keys()):
-            ml_to_subtract[sub_color] -= (mix_color * potion.quantity)
-
-    update_ml_sql = sqlalchemy.text("""
-                    INSERT INTO ml_ledger (red, green, blue, dark, game_day, game_hr)
-                    VALUES (:red, :green, :blue, :dark, (SELECT day FROM curr_time), (SELECT hour FROM curr_time))
-                    """)
-
-    
-    update_potion_ledger_sql = sqlalchemy.text("""
-                    WITH subquery AS (
-                        SELECT id AS potion_id
-                        FROM potion_inventory
-                        WHERE potion_type = :potion_type
-                    )
-                    INSERT INTO potion_ledger (transaction, potion_id, reason)
-                    SELECT :transaction, subquery.potion_id, 'Bobo be bottling'
-                    FROM subquery
-                                                """)
+    ml_to_subtract, potion_list_of_dicts = planning.bottle_delivery_totals(potions_delivered)
 
     try:
-        with db.engine.begin() as connection:
-            connection.execute(update_ml_sql, ml_to_subtract)
-            connection.execute(update_potion_ledger_sql, potion_list_of_dicts)
-
-            try:
-                connection.execute(sqlalchemy.text("""INSERT INTO processed (job_id, type)
-                                                            VALUES (:order_id, 'bottler')
-                                                        """), {"order_id": order_id})
-            except IntegrityError as e:
-                print(f"Tried to deliver bottles again on job_id: {order_id}")
-                return "ALREADY_PROCESSED"
+        with replica_database.write_transaction("bottler") as connection:
+            game_day, game_hr = game_clock.current(connection)
+            potion_ids = potion_ids_for(connection, potion_list_of_dicts)
+
+            delivered = []
+            for potion, potion_id in zip(potion_list_of_dicts, potion_ids):
+                if potion_id is None:
+                    logger.error("No potion in inventory with type %s, not adding %s of it",
+                                 potion['potion_type'], potion['transaction'])
+                    continue
+                delivered.append((potion_id, potion['transaction']))
+
+            claimed = connection.execute(deliver_bottles_sql, {
+                                            **ml_to_subtract,
+                                            "order_id": order_id,
+                                            "game_day": game_day,
+                                            "game_hr": game_hr,
+                                            "potion_ids": [potion_id for potion_id, transaction in delivered],
+                                            "transactions": [transaction for potion_id, transaction in delivered],
+                                        }).scalar()
 
     except Exception as e:
-        print(f"Error trying to deliver bottled potions: {e}")
+        logger.error("Error trying to deliver bottled potions: %s", e)
         return "SAD"
-    
+
+    if not claimed:
+        logger.warning("Tried to deliver bottles again on job_id: %s", order_id)
+        return "ALREADY_PROCESSED"
+
     return "OK"
 
-@router.post("/plan")
-def get_bottle_plan():
+
+# balances are kept by the ledger triggers (migrations/002), so no ledger scans here,
+# just a sum over the balance stripes (migrations/011)
+ml_sql = statements.register("bottler.ml", """
+                        SELECT
+                            CAST(SUM(red) AS bigint) AS total_red,
+                            CAST(SUM(green) AS bigint) AS total_green,
+                            CAST(SUM(blue) AS bigint) AS total_blue,
+                            CAST(SUM(dark) AS bigint) AS total_dark
+                        FROM ml_balance;
+                         """)
+
+potion_sql = statements.register("bottler.potions", """
+                                SELECT id, name, potion_balance.quantity as quantity, price, potion_type, bottle_goal
+                                FROM potion_inventory
+                                JOIN (SELECT potion_id, CAST(SUM(quantity) AS bigint) AS quantity
+                                      FROM potion_balance
+                                      GROUP BY potion_id) potion_balance ON potion_balance.potion_id = potion_inventory.id
+                                ORDER BY quantity ASC
+                                """)
+
+
+class bottle_objective(str, Enum):
+    goal_fill = "goal_fill"
+    value = "value"
+
+@router.post("/plan", response_class=FastJSONResponse)
+def get_bottle_plan(objective: bottle_objective = bottle_objective.goal_fill, demand_hours: int = 0):
     """
     Go from barrel to bottle.
+
+    demand_hours > 0: a potion's goal is at least what sold over that many trailing
+    game hours (sales rollup), instead of only the static bottle_goal.
     """
 
     # Each bottle has a quantity of what proportion of red, blue, and
@@ -91,85 +149,34 @@ def get_bottle_plan():
     # "potion_type": [r, g, b, d]
     # Each potion is 100ml
 
-    bottle_plan = []
-
-    avail_color = {"red": 0, "green": 0, "blue": 0, "dark": 0}
-
-    ml_sql = sqlalchemy.text("""
-                            SELECT
-                                SUM(red) AS total_red,
-                                SUM(green) AS total_green,
-                                SUM(blue) AS total_blue,
-                                SUM(dark) AS total_dark
-                            FROM ml_ledger;
-                             """)
-
-    potion_sql = sqlalchemy.text("""
-                                    WITH subquery AS (
-                                            SELECT potion_id, SUM(transaction) AS potion_quant
-                                            FROM potion_ledger
-                                            GROUP BY potion_id
-                                        )
-                                    SELECT id, name, subquery.potion_quant as quantity, price, potion_type, bottle_goal
-                                    FROM potion_inventory
-                                    JOIN subquery ON subquery.potion_id = potion_inventory.id
-                                    ORDER BY quantity ASC
-                                    """)
-    
     try:
-        with db.engine.begin() as connection:
+        with replica_database.read_transaction("bottler") as connection:
             avail_ml = connection.execute(ml_sql).fetchone()
             potion_inventory = connection.execute(potion_sql)
+            potion_columns = potion_inventory.keys()
+            mix_dict = [dict(zip(potion_columns, row)) for row in potion_inventory.fetchall()]
+            demand = sales.trailing_demand(connection, demand_hours) if demand_hours > 0 else None
     except Exception as e:
-        print(f"Error grabbing potion inventories: {e}")
-        return []
-
-    potion_columns = potion_inventory.keys()
-    mix_dict = [dict(zip(potion_columns, row)) for row in potion_inventory.fetchall()]
+        logger.error("Error grabbing potion inventories: %s", e)
+        return FastJSONResponse([])
 
-    total_avail_ml = 0
-    for key, value in zip(avail_color.keys(), avail_ml):
-        avail_color[key] = value
-        total_avail_ml += value
+    if demand is not None:
+        for mix in mix_dict:
+            sold = demand['potions'].get(mix['id'], {}).get('quantity', 0)
+            mix['bottle_goal'] = max(mix['bottle_goal'], sold)
 
+    # how many of each mix fits is closed form (min over channels of avail // ratio),
+    # and all mixes share the ml at once instead of first-come-first-served
+    bottle_plan = planning.plan_bottles(mix_dict, list(avail_ml), objective.value)
+    if not bottle_plan:
+        logger.info("Not enough ml (or every mix at goal) --> no potions bottled")
+        return FastJSONResponse([])
 
-                
-    if total_avail_ml < 100:
-        print(f"Not enough ml --> no potions bottled")
-        return []
-    else:
+    logger.debug("Pre-bottle potion inventory is: %s", mix_dict)
+    logger.info("Bottle plan is %s", bottle_plan)
+    return FastJSONResponse(bottle_plan)
 
-        #logic for what to bottle
-        #only adding potions that have less than 10 in inventory
-        #later optimize based on game days or whatever
-        for mix in mix_dict:
-            can_bottle = False
-            update_quant = mix['bottle_goal'] - mix['quantity'] 
-            if update_quant >= mix['bottle_goal']:
-                update_quant = mix['bottle_goal']
-            if update_quant > 0:
-                for mix_color, have_color in zip(mix['potion_type'], avail_color.keys()):
-
-                    if avail_color[have_color] < (mix_color * update_quant):
-                        while (avail_color[have_color] < (mix_color * update_quant)) and (update_quant > 0):
-                            update_quant -= 1
-                    if avail_color[have_color] >= (mix_color * update_quant):
-                        #reaching end of potion type w/o failure
-                        if have_color == 'dark' and avail_color[have_color] >= mix_color:
-                            can_bottle = True
-                    
-                if can_bottle and update_quant != 0:
-                    bottle_plan.append({'potion_type': mix['potion_type'], 'quantity': update_quant})
-                    for mix_color, have_color in zip(mix['potion_type'], avail_color.keys()):
-                        avail_color[have_color] -= (mix_color * update_quant)
-
-
-
-        print(f"Pre-bottle potion inventory is: {mix_dict}\n")
-        print(f"Bottle plan is {bottle_plan}")
-        return bottle_plan
-    
 
 
 if __name__ == "__main__":
-    print(get_bottle_plan())
\ No newline at end of file
+    print(get_bottle_plan().body.decode())
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import threading
+import time
+
+"""
+Small in-process caches shared by the routers. Handlers run in FastAPI's
+threadpool, so everything here takes a lock around the dict.
+"""
+
+
+class LRUCache:
+    """
+    Bounded least-recently-used cache with hit/miss counters, and an optional
+    TTL after which entries count as misses.
+    get() returns None on a miss, so don't cache None values.
+
+    To cache the result of a query that can race with invalidate(), read
+    generation before running the query and pass it to put(): if anything was
+    invalidated in between, the (possibly stale) value is dropped.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: float = None):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, generation: int = None):
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else None
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def put_many(self, items):
+        for key, value in items:
+            self.put(key, value)
+
+    def invalidate(self, key=None):
+        """
+        Drop one key, or everything if no key given.
+        """
+        with self._lock:
+            self.invalidations += 1
+            self.generation += 1
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
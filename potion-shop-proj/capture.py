@@ -0,0 +1,165 @@
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from src.api.game_clock import clock as game_clock
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+"""
+Opt-in traffic capture for replay (see replay.py). Routers that pass
+route_class=CaptureRoute (carts, barrels, bottler) append one JSON line per
+request to POTION_SHOP_CAPTURE_PATH:
+
+    {"t": 1730000000.123456, "tick": [12, 4], "method": "POST",
+     "route": "/carts/{cart_id}/checkout", "path_params": {"cart_id": 81},
+     "query": "", "body": "{\"payment\": \"...\"}", "status": 200, "ms": 3.41,
+     "response": {"total_potions_bought": 2, "total_gold_paid": 100}}
+
+body is the raw request body text, so replay sends exactly what came in.
+response is the parsed JSON response (null for streamed responses like /carts/export).
+tick is the game (day, hour) the worker had cached when the request came in.
+
+Unset, routes are built the normal way and nothing is captured. Lines are
+encoded and written by a background thread so requests don't wait on the disk.
+With several workers, put {pid} in the path to get one file per worker.
+
+POTION_SHOP_SERVER_TIMING=1 (on the server being replayed against) adds
+"Server-Timing: handler;dur=<ms>" to every response, timed the same way as "ms",
+so replay can put handler time next to handler time instead of round trips.
+"""
+
+logger = logging.getLogger(__name__)
+
+capture_path = os.environ.get("POTION_SHOP_CAPTURE_PATH")
+server_timing = os.environ.get("POTION_SHOP_SERVER_TIMING", "0") == "1"
+
+
+def handler_ms(start: float):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+def add_server_timing(response, ms: float):
+    if server_timing:
+        response.headers["Server-Timing"] = f"handler;dur={ms}"
+
+
+def parse_json(raw: bytes):
+    if not raw:
+        return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw.decode("utf-8", "replace")
+
+
+def encode_record(record: dict):
+    record["body"] = record["body"].decode("utf-8", "replace") if record["body"] else None
+    record["response"] = parse_json(record["response"])
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+class CaptureLog:
+    """
+    Append-only NDJSON file. Each batch of lines goes out in one O_APPEND write.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.written = 0
+        self._queue = queue.SimpleQueue()
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._writer = threading.Thread(target=self._drain, name="capture-log", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def write(self, record: dict):
+        self._queue.put(record)
+
+    def _drain(self):
+        done = False
+        while not done:
+            records = [self._queue.get()]
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                done = True
+                records = [record for record in records if record is not None]
+            if records:
+                try:
+                    os.write(self._fd, "".join(encode_record(record) for record in records).encode())
+                    self.written += len(records)
+                except Exception as e:
+                    logger.error("Couldn't write %s captured requests to %s: %s", len(records), self.path, e)
+        os.close(self._fd)
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=5)
+
+
+capture_log = CaptureLog(capture_path.format(pid=os.getpid())) if capture_path else None
+
+
+class CaptureRoute(APIRoute):
+    """
+    Route class that records each request (body, path params, timing, response) to capture_log,
+    and/or reports the handler time in a Server-Timing header.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        if capture_log is None and not server_timing:
+            return handler
+
+        if capture_log is None:
+            async def timed_handler(request: Request):
+                start = time.perf_counter()
+                response = await handler(request)
+                add_server_timing(response, handler_ms(start))
+                return response
+
+            return timed_handler
+
+        async def capture_handler(request: Request):
+            # starlette keeps the body, so the handler (and json_body) read the same bytes again
+            body = await request.body()
+            record = {
+                "t": round(time.time(), 6),
+                "tick": game_clock.last_known(),
+                "method": request.method,
+                "route": self.path,
+                "path_params": request.path_params,
+                "query": request.url.query,
+                "body": body,
+                "status": 500,
+                "ms": None,
+                "response": None,
+            }
+            start = time.perf_counter()
+            try:
+                response = await handler(request)
+                record["status"] = response.status_code
+                record["response"] = getattr(response, "body", None)
+                add_server_timing(response, handler_ms(start))
+                return response
+            except HTTPException as e:
+                record["status"] = e.status_code
+                raise
+            except RequestValidationError:
+                record["status"] = 422
+                raise
+            finally:
+                record["ms"] = handler_ms(start)
+                capture_log.write(record)
+
+        return capture_handler
@@ -1,19 +1,43 @@
 from fastapi import APIRouter, Depends, Request
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 from src.api import auth
+from src.api import capture
+from src.api import instrumentation
+from src.api import replica_database
+from src.api import statements
+from src.api.batching import MicroBatcher, QueueFull
+from src.api.fast_json import json_body, body_schema
 from enum import Enum
+from datetime import datetime
+
+import anyio
+import base64
+import csv
+import io
+import itertools
+import json
+import logging
+import os
+import threading
 
-import sqlalchemy
 from src import database as db
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeout
+from src.api.cache import LRUCache
+from src.api.game_clock import clock as game_clock
+from src.api.potion_catalog import catalog as potion_catalog
 
 from fastapi import HTTPException, status
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 
-from sqlalchemy.exc import IntegrityError
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/carts",
     tags=["cart"],
-    dependencies=[Depends(auth.get_api_key)],
+    dependencies=[Depends(auth.get_api_key), Depends(instrumentation.track_request)],
+    route_class=capture.CaptureRoute,
 )
 
 class search_sort_options(str, Enum):
@@ -26,6 +50,183 @@ class search_sort_order(str, Enum):
     asc = "asc"
     desc = "desc"   
 
+search_sort_columns = {
+    search_sort_options.customer_name: "customers.cust_name",
+    search_sort_options.item_sku: "line_items.item_sku",
+    search_sort_options.line_item_total: "(line_items.quantity*line_items.price)",
+    search_sort_options.timestamp: "line_items.created_at",
+}
+
+SEARCH_PAGE_SIZE = 5
+
+
+def encode_search_page(direction: str, sort_col: search_sort_options,
+                       sort_order: search_sort_order, row: dict):
+    """
+    Page token = the sort key + line id of the row the page starts after
+    (direction "next") or before (direction "prev"), base64'd so it stays opaque.
+    """
+    sort_val = row[sort_col.value]
+    if isinstance(sort_val, datetime):
+        sort_val = sort_val.isoformat()
+
+    token = {
+        "dir": direction,
+        "col": sort_col.value,
+        "order": sort_order.value,
+        "val": sort_val,
+        "id": row["line_item_id"],
+    }
+    return base64.urlsafe_b64encode(json.dumps(token).encode()).decode()
+
+
+def decode_search_page(search_page: str, sort_col: search_sort_options,
+                       sort_order: search_sort_order):
+    try:
+        token = json.loads(base64.urlsafe_b64decode(search_page.encode()))
+        direction, sort_val, line_id = token["dir"], token["val"], int(token["id"])
+        same_sort = token["col"] == sort_col.value and token["order"] == sort_order.value
+        if sort_col == search_sort_options.timestamp:
+            sort_val = datetime.fromisoformat(sort_val)
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid search page token")
+
+    # token from a different sort would point somewhere random in this ordering
+    if direction not in ("next", "prev") or not same_sort:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid search page token")
+
+    return direction, sort_val, line_id
+
+
+def like_pattern(search_term: str):
+    """
+    Substring pattern for ILIKE, with the user's own % and _ escaped so they match literally.
+    """
+    escaped = search_term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return "%" + escaped + "%"
+
+
+# rendered search pages, dropped whenever set_item_quantity adds a line item;
+# the TTL bounds staleness from writes that went through other workers
+search_cache = LRUCache(maxsize=2000, ttl_seconds=15)
+instrumentation.register_cache("search_pages", search_cache)
+
+
+def search_cache_key(customer_name: str, potion_sku: str, search_page: str,
+                     sort_col: search_sort_options, sort_order: search_sort_order):
+    # filters are case insensitive, so "Red" and "red" are the same page
+    return (customer_name.lower(), potion_sku.lower(), sort_col.value, sort_order.value, search_page)
+
+
+def search_statement_name(sort_col: search_sort_options, ascending: bool,
+                          name_filter: bool, sku_filter: bool, keyset: bool):
+    return "carts.search:{}:{}{}{}{}".format(sort_col.value, "asc" if ascending else "desc",
+                                            ":name" if name_filter else "", ":sku" if sku_filter else "",
+                                            ":keyset" if keyset else "")
+
+
+def register_search_statements():
+    """
+    One statement per sort column x order x filters given x page cursor, registered
+    once at import instead of f-stringing a fresh ORDER BY on every request.
+    """
+    for sort_col, sort_col_val in search_sort_columns.items():
+        for ascending, name_filter, sku_filter, keyset in itertools.product([True, False], repeat=4):
+            query_order = "ASC" if ascending else "DESC"
+
+            # only filter on what was actually given, ILIKE '%%' still costs a scan
+            filter_sql = ["TRUE"]
+            if name_filter:
+                filter_sql.append("customers.cust_name ILIKE :name_search")
+            if sku_filter:
+                filter_sql.append("line_items.item_sku ILIKE :sku_search")
+
+            keyset_sql = ""
+            if keyset:
+                keyset_op = ">" if ascending else "<"
+                keyset_sql = f"AND ({sort_col_val}, line_items.line_id) {keyset_op} (:sort_val, :line_id)"
+
+            statements.register(search_statement_name(sort_col, ascending, name_filter, sku_filter, keyset),
+                                f"""SELECT line_items.line_id as line_item_id,
+                                        line_items.item_sku,
+                                        customers.cust_name as customer_name,
+                                        (line_items.quantity*line_items.price) as line_item_total,
+                                        line_items.created_at as timestamp
+                                    FROM line_items
+                                    JOIN carts ON line_items.cart_id = carts.id
+                                    JOIN customers ON carts.cust_id = customers.id
+                                    WHERE {" AND ".join(filter_sql)}
+                                        {keyset_sql}
+                                    ORDER BY {sort_col_val} {query_order}, line_items.line_id {query_order}
+                                    LIMIT :page_limit """)
+
+
+register_search_statements()
+
+
+def build_search_query(customer_name: str, potion_sku: str, search_page: str,
+                       sort_col: search_sort_options, sort_order: search_sort_order):
+    """
+    Returns (statement, params, direction) for one page of search results.
+    """
+    # keyset pagination: the token carries the (sort key, line_id) of the page edge,
+    # db only ever hands back one row more than a page to tell if there's another one
+    direction = "next"
+    search_dict = {"page_limit": SEARCH_PAGE_SIZE + 1}
+
+    if customer_name:
+        search_dict["name_search"] = like_pattern(customer_name)
+    if potion_sku:
+        search_dict["sku_search"] = like_pattern(potion_sku)
+
+    if search_page:
+        direction, sort_val, line_id = decode_search_page(search_page, sort_col, sort_order)
+        search_dict["sort_val"] = sort_val
+        search_dict["line_id"] = line_id
+
+    # walking backwards = flip the order, then flip the rows back after
+    ascending = (sort_order == search_sort_order.asc) != (direction == "prev")
+
+    results_sql = statements.get(search_statement_name(sort_col, ascending, bool(customer_name),
+                                                       bool(potion_sku), bool(search_page)))
+
+    return results_sql, search_dict, direction
+
+
+def search_page_response(results_list: list[dict], direction: str, search_page: str,
+                         sort_col: search_sort_options, sort_order: search_sort_order):
+    """
+    Trims the extra lookahead row off and works out the previous/next tokens.
+    """
+    prev_pg = ""
+    next_pg = ""
+
+    more_results = len(results_list) > SEARCH_PAGE_SIZE
+    results_list = results_list[:SEARCH_PAGE_SIZE]
+
+    if direction == "prev":
+        results_list.reverse()
+
+    if results_list:
+        first_row, last_row = results_list[0], results_list[-1]
+        if direction == "next":
+            # got here by stepping forward (or first page), so there's a previous page if we came from a token
+            if search_page:
+                prev_pg = encode_search_page("prev", sort_col, sort_order, first_row)
+            if more_results:
+                next_pg = encode_search_page("next", sort_col, sort_order, last_row)
+        else:
+            next_pg = encode_search_page("next", sort_col, sort_order, last_row)
+            if more_results:
+                prev_pg = encode_search_page("prev", sort_col, sort_order, first_row)
+
+    return {
+        "previous": prev_pg,
+        "next": next_pg,
+        "results": results_list
+    }
+
+
 @router.get("/search/", tags=["search"])
 def search_orders(
     customer_name: str = "",
@@ -33,6 +234,7 @@ def search_orders(
     search_page: str = "",
     sort_col: search_sort_options = search_sort_options.timestamp,
     sort_order: search_sort_order = search_sort_order.desc,
+    use_cache: bool = True,
 ):
     """
     Search for cart line items by customer name and/or potion sku.
@@ -57,6 +259,9 @@ def search_orders(
     customer name, line item total (in gold), and timestamp of the order.
     Your results must be paginated, the max results you can return at any
     time is 5 total line items.
+
+    Pages are cached for a few seconds and dropped whenever a line item is
+    added; pass use_cache=false to always hit the db.
     """
     search_param = {
         "customer_name": customer_name,
@@ -66,87 +271,203 @@ def search_orders(
         "sort_order": sort_order.value
     }
 
-    print(f"Search parameters are: {search_param}")
+    logger.debug("Search parameters are: %s", search_param)
 
-    customer_name = "%" + customer_name + "%"
-    potion_sku = "%" + potion_sku + "%"
+    cache_key = search_cache_key(customer_name, potion_sku, search_page, sort_col, sort_order)
+    if use_cache:
+        cached_response = search_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
 
-    sort_col_val = sort_col.value
+    # a line item added while the query runs invalidates the cache, and then this page mustn't go in
+    generation = search_cache.generation
+    results_sql, search_dict, direction = build_search_query(customer_name, potion_sku, search_page,
+                                                             sort_col, sort_order)
+    
+    response = {"previous": "", "next": "", "results": []}
+    
+    try:
+        with replica_database.read_transaction("carts") as connection:
+            results = connection.execute(results_sql, search_dict)
+            results_columns = results.keys()
+            results = results.fetchall()
 
-    match sort_col_val:
-        case 'customer_name':
-            sort_col_val = "customers.cust_name"
-        case 'item_sku':
-            sort_col_val = "line_items.item_sku"
-        case 'line_item_total':
-            sort_col_val = "(line_items.quantity*line_items.price)"
-        case 'timestamp':
-            sort_col_val = "line_items.created_at"
+        results_list = [dict(zip(results_columns, row)) for row in results]
+        response = search_page_response(results_list, direction, search_page, sort_col, sort_order)
+        search_cache.put(cache_key, response, generation)
 
-    if not search_page:
-        search_page = 0
-    else: 
-        search_page = int(search_page)
+        logger.debug("Number of search results: %s", len(response['results']))
 
-    if search_page >= 1:
-        search_offset = 5*(search_page)
-        prev_pg = str(search_page - 1)
-        if not prev_pg:
-            prev_pg = ""
-    elif not search_page:
-        search_offset = 0
-        prev_pg = ""
+    except Exception as e:
+        logger.error("Error trying to grab line item results: %s", e)
 
-    next_pg = str(search_page + 1)
+    return response
 
 
-    search_dict = {"name_search": customer_name, 
-                   "sku_search": potion_sku,
-                   "page_num": search_offset
-                   }
-    
+class export_format(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
 
-    results_sql = sqlalchemy.text(f"""SELECT line_items.line_id as line_item_id,
-                                        line_items.item_sku,
-                                        customers.cust_name as customer_name,
-                                        (line_items.quantity*line_items.price) as line_item_total,
-                                        line_items.created_at as timestamp
-                                    FROM line_items
-                                    JOIN carts ON line_items.cart_id = carts.id
-                                    JOIN customers ON carts.cust_id = customers.id
-                                    WHERE cust_name ILIKE :name_search
-                                        AND item_sku ILIKE :sku_search
-                                    ORDER BY {sort_col_val} {sort_order.value} """)
-    
-    results_list = []
-    
-    try:
-        with db.engine.begin() as connection:
-            results = connection.execute(results_sql, search_dict)
+EXPORT_BATCH_ROWS = 1000
+export_columns = ["line_item_id", "item_sku", "customer_name", "line_item_total", "timestamp"]
 
-        results_columns = results.keys()
-        results = results.fetchall()
-        results_length = len(results)
+# an export holds its connection until the client has read the last row, so exports get a small
+# pool of their own and are turned away when it's empty instead of waiting on search and checkout's
+export_max_concurrent = int(os.environ.get("POTION_SHOP_EXPORT_MAX_CONCURRENT", "2"))
+export_wait_seconds = float(os.environ.get("POTION_SHOP_EXPORT_WAIT_SECONDS", "0.5"))
+export_retry_after = os.environ.get("POTION_SHOP_EXPORT_RETRY_AFTER", "5")
+export_pools = {}
+export_pools_lock = threading.Lock()
 
-        all_results_list = [dict(zip(results_columns, row)) for row in results]
 
-        start_index = 5*search_page
-        finish_index = start_index + 5
+def export_statement_name(name_filter: bool, sku_filter: bool):
+    return "carts.export{}{}".format(":name" if name_filter else "", ":sku" if sku_filter else "")
 
-        results_list = all_results_list[start_index:finish_index]
-        
-        if finish_index >= results_length:
-            next_pg = "" 
-        print(f"Number of search results: {results_length}")
 
-    except Exception as e:
-        print(f"Error trying to grab line item results: {e}")
+def register_export_statements():
+    """
+    Same rows and filters as search, in line_id order, one variant per filter combination.
+    """
+    for name_filter, sku_filter in itertools.product([True, False], repeat=2):
+        filter_sql = ["TRUE"]
+        if name_filter:
+            filter_sql.append("customers.cust_name ILIKE :name_search")
+        if sku_filter:
+            filter_sql.append("line_items.item_sku ILIKE :sku_search")
+
+        statements.register(export_statement_name(name_filter, sku_filter),
+                            f"""SELECT line_items.line_id as line_item_id,
+                                    line_items.item_sku,
+                                    customers.cust_name as customer_name,
+                                    (line_items.quantity*line_items.price) as line_item_total,
+                                    line_items.created_at as timestamp
+                                FROM line_items
+                                JOIN carts ON line_items.cart_id = carts.id
+                                JOIN customers ON carts.cust_id = customers.id
+                                WHERE {" AND ".join(filter_sql)}
+                                ORDER BY line_items.line_id""")
+
+
+register_export_statements()
+
+
+def export_header(format: export_format):
+    if format != export_format.csv:
+        return ""
+    header = io.StringIO()
+    csv.writer(header).writerow(export_columns)
+    return header.getvalue()
+
+
+def encode_export_rows(rows, format: export_format):
+    """
+    One chunk of the export: CSV lines or NDJSON objects, one per row.
+    """
+    if format == export_format.csv:
+        chunk = io.StringIO()
+        writer = csv.writer(chunk)
+        for row in rows:
+            writer.writerow([row.line_item_id, row.item_sku, row.customer_name,
+                             row.line_item_total, row.timestamp.isoformat()])
+        return chunk.getvalue()
+    return "".join(json.dumps({
+                        "line_item_id": row.line_item_id,
+                        "item_sku": row.item_sku,
+                        "customer_name": row.customer_name,
+                        "line_item_total": row.line_item_total,
+                        "timestamp": row.timestamp.isoformat(),
+                    }) + "\n" for row in rows)
+
+
+def build_export_query(customer_name: str, potion_sku: str):
+    """
+    Returns (statement, params) for the export with these filters.
+    """
+    export_dict = {}
+    if customer_name:
+        export_dict["name_search"] = like_pattern(customer_name)
+    if potion_sku:
+        export_dict["sku_search"] = like_pattern(potion_sku)
+    return statements.get(export_statement_name(bool(customer_name), bool(potion_sku))), export_dict
 
-    return {
-        "previous": prev_pg,
-        "next": next_pg,
-        "results": results_list
-    }
+
+def export_pool(engine):
+    """
+    The export pool next to `engine` (the primary or the replica), made on first use.
+    """
+    with export_pools_lock:
+        if engine not in export_pools:
+            export_pools[engine] = create_engine(engine.url,
+                                                 pool_size=export_max_concurrent,
+                                                 max_overflow=0,
+                                                 pool_timeout=export_wait_seconds,
+                                                 pool_pre_ping=True)
+            instrumentation.install(export_pools[engine])
+        return export_pools[engine]
+
+
+def exports_busy(e: PoolTimeout):
+    logger.warning("All %s export connections busy, turning an export away: %s", export_max_concurrent, e)
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail="Too many exports running, retry shortly",
+                         headers={"Retry-After": export_retry_after})
+
+
+def export_response(chunks, format: export_format):
+    media_type = "text/csv" if format == export_format.csv else "application/x-ndjson"
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={"Content-Disposition": f"attachment; filename=line_items.{format.value}"})
+
+
+def export_chunks(connection, export_sql, export_dict: dict, format: export_format):
+    """
+    Streams the rows through a server-side cursor, EXPORT_BATCH_ROWS at a time, and
+    yields one encoded chunk per batch, so neither side ever holds the whole export.
+    Closes the connection (back to the export pool) when done.
+    """
+    with connection, connection.begin():
+        yield export_header(format)
+        results = connection.execution_options(stream_results=True, yield_per=EXPORT_BATCH_ROWS) \
+                            .execute(export_sql, export_dict)
+        for rows in results.partitions():
+            yield encode_export_rows(rows, format)
+
+
+async def until_disconnected(request: Request, chunks):
+    """
+    Passes the chunks on until the client goes away, then stops reading the cursor. Left alone, a
+    sync generator would stream the rest of the export to nobody with the connection checked out.
+    """
+    try:
+        async for chunk in iterate_in_threadpool(chunks):
+            if await request.is_disconnected():
+                break
+            yield chunk
+    finally:
+        chunks.close()
+
+
+@router.get("/export/", tags=["search"])
+def export_orders(
+    request: Request,
+    customer_name: str = "",
+    potion_sku: str = "",
+    format: export_format = export_format.ndjson,
+):
+    """
+    Every line item matching the search filters (same matching as /carts/search),
+    streamed in line item id order as NDJSON (one object per line) or CSV with a header row.
+    """
+    export_sql, export_dict = build_export_query(customer_name, potion_sku)
+    try:
+        connection = replica_database.read_connection("carts", pool_for=export_pool)
+    except PoolTimeout as e:
+        raise exports_busy(e)
+
+    logger.debug("Exporting line items as %s for customer %r, sku %r", format.value, customer_name, potion_sku)
+
+    return export_response(until_disconnected(request, export_chunks(connection, export_sql, export_dict, format)),
+                           format)
 
 
 class Customer(BaseModel):
@@ -154,6 +475,9 @@ class Customer(BaseModel):
     character_class: str
     level: int
 
+# visit payloads get validated straight from the request bytes in one pass (fast_json)
+customer_list = TypeAdapter(list[Customer])
+
 """"
 print(customers) print example list
 
@@ -161,43 +485,156 @@ print(customers) print example list
 Customer(customer_name='Theodora Oakenshield', character_class='Druid', level=2)]
 """
 
-@router.post("/visits/{visit_id}")
-def post_visits(visit_id: int, customers: list[Customer]):
+# (cust_name, cust_class, level) -> customers.id, filled by post_visits and read by create_cart
+customer_id_cache = LRUCache(maxsize=10000)
+instrumentation.register_cache("customer_ids", customer_id_cache)
+
+
+# new customers come back from RETURNING, ones we already had from the join
+# (same snapshot, so nobody shows up twice), and both go into the id cache for create_cart
+customer_visit_sql = statements.register("carts.customer_visit", """WITH visit AS (
+                                            SELECT DISTINCT cust_name, cust_class, level
+                                            FROM unnest(CAST(:cust_names AS text[]),
+                                                        CAST(:cust_classes AS text[]),
+                                                        CAST(:levels AS int[]))
+                                                AS visit(cust_name, cust_class, level)
+                                        ),
+                                        new_customers AS (
+                                            INSERT INTO customers (cust_name, cust_class, level)
+                                            SELECT cust_name, cust_class, level
+                                            FROM visit
+                                            ON CONFLICT (cust_name, cust_class, level) DO NOTHING
+                                            RETURNING id, cust_name, cust_class, level
+                                        )
+                                        SELECT id, cust_name, cust_class, level
+                                        FROM new_customers
+                                        UNION ALL
+                                        SELECT customers.id, customers.cust_name, customers.cust_class, customers.level
+                                        FROM customers
+                                        JOIN visit USING (cust_name, cust_class, level)
+                                    """)
+
+
+def visitor_key(customer: Customer):
+    return (customer.customer_name, customer.character_class, customer.level)
+
+
+def visit_arrays(visitors: list):
+    """
+    (name, class, level) keys -> the three arrays customer_visit_sql takes.
+    """
+    return {
+        "cust_names": [name for name, cust_class, level in visitors],
+        "cust_classes": [cust_class for name, cust_class, level in visitors],
+        "levels": [level for name, cust_class, level in visitors],
+    }
+
+
+def record_visitors(visitors: list):
+    # whole list goes in as three arrays -> one statement, the unique key does the dedup
+    with replica_database.write_transaction("carts") as connection:
+        visitor_ids = connection.execute(customer_visit_sql, visit_arrays(visitors)).fetchall()
+
+    customer_id_cache.put_many(((row.cust_name, row.cust_class, row.level), row.id) for row in visitor_ids)
+
+
+def record_visit_batches(payloads: list):
+    """
+    Batch handler: every queued visit payload in one write, customers deduped across
+    payloads. If that fails each payload is retried on its own.
+    """
+    visitors = list(dict.fromkeys(visitor_key(customer) for customers in payloads for customer in customers))
+    try:
+        record_visitors(visitors)
+    except Exception as e:
+        logger.warning("Batched visits (%s payloads) failed, writing one by one: %s", len(payloads), e)
+        results = []
+        for customers in payloads:
+            try:
+                record_visitors(list(dict.fromkeys(visitor_key(customer) for customer in customers)))
+                results.append("OK")
+            except Exception as payload_error:
+                results.append(payload_error)
+        return results
+    return ["OK"] * len(payloads)
+
+
+# opt-in visit coalescing: POTION_SHOP_VISIT_BATCH_MS=5 merges visit payloads for up to 5ms into one write.
+# past POTION_SHOP_VISIT_MAX_PENDING queued payloads new visits get a 503 + Retry-After instead of waiting.
+# Here every queued payload holds a threadpool thread until its batch is written, so the limit has to stay
+# well under the threadpool size: at or above it a visit storm takes every thread, the queue never fills
+# and checkouts wait behind it. clamp_visit_queue holds it to half the threadpool. The async router holds
+# no threads and has its own limit, POTION_SHOP_ASYNC_VISIT_MAX_PENDING.
+visit_batch_ms = float(os.environ.get("POTION_SHOP_VISIT_BATCH_MS", "0"))
+visit_max_pending = int(os.environ.get("POTION_SHOP_VISIT_MAX_PENDING", "16"))
+visit_max_pending_async = int(os.environ.get("POTION_SHOP_ASYNC_VISIT_MAX_PENDING", "200"))
+visit_retry_after = os.environ.get("POTION_SHOP_VISIT_RETRY_AFTER", "1")
+visit_batcher = MicroBatcher(record_visit_batches, visit_batch_ms / 1000,
+                             max_pending=visit_max_pending) if visit_batch_ms > 0 else None
+visit_queue_clamped = False
+
+
+async def clamp_visit_queue():
+    """
+    Holds the sync visit queue to half of the threadpool. Runs as a dependency of post_visits, on the
+    event loop, which is the only place anyio's thread limiter (the threadpool size) can be read.
+    """
+    global visit_queue_clamped
+    if visit_batcher is None or visit_queue_clamped:
+        return
+    visit_queue_clamped = True
+    threads = anyio.to_thread.current_default_thread_limiter().total_tokens
+    limit = max(1, int(threads) // 2)
+    if visit_batcher.max_pending > limit:
+        logger.warning("POTION_SHOP_VISIT_MAX_PENDING=%s would let visits hold the whole threadpool (%s threads), "
+                       "using %s", visit_batcher.max_pending, threads, limit)
+        visit_batcher.max_pending = limit
+
+
+def visits_busy(e: QueueFull):
+    logger.warning("Visit queue full, shedding a visit payload: %s", e)
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail="Too many visits queued, retry shortly",
+                         headers={"Retry-After": visit_retry_after})
+
+
+@router.post("/visits/{visit_id}", openapi_extra=body_schema(customer_list),
+             dependencies=[Depends(clamp_visit_queue)])
+def post_visits(visit_id: int, customers: list[Customer] = Depends(json_body(customer_list))):
     """
     Which customers visited the shop today?
     """
-    print(customers)
-    print(f"Customer count this tick: {len(customers)}")
+    logger.debug("Visiting customers: %s", customers)
+    logger.info("Customer count this tick: %s", len(customers))
 
-    customer_list = []
     #get passed in empty customer list >.>
     if not customers:
-        print('Uuuuuuuuh, no customers came :(')
+        logger.info('Uuuuuuuuh, no customers came :(')
+    elif visit_batcher is not None:
+        try:
+            visit_batcher.submit(customers)
+        except QueueFull as e:
+            raise visits_busy(e)
     else:
-        for customer in customers:
-            customer_list.append({
-                "cust_name": customer.customer_name,
-                "cust_class": customer.character_class,
-                "level": customer.level            })
-
-        customer_visit_sql = sqlalchemy.text("""INSERT INTO customers (cust_name, cust_class, level)
-                                                SELECT :cust_name, :cust_class, :level
-                                                WHERE NOT EXISTS (
-                                                    SELECT 1 FROM customers 
-                                                    WHERE cust_name = :cust_name
-                                                    AND cust_class = :cust_class
-                                                    AND level = :level
-                                                )
-                                                LIMIT 1
-                                            """)
-        
-        with db.engine.begin() as connection:
-            connection.execute(customer_visit_sql, customer_list)
+        record_visitors(list(dict.fromkeys(visitor_key(customer) for customer in customers)))
     
     return "OK"
 
 
-time_qry = []
+search_cust_sql = statements.register("carts.search_customer", """SELECT id
+                                    FROM customers
+                                    WHERE (cust_name = :cust_name
+                                           AND cust_class = :cust_class
+                                           AND level = :level)
+                                  """)
+
+insert_cart_sql = statements.register("carts.insert_cart", """
+                                INSERT INTO carts (cust_id, game_day, game_hr)
+                                VALUES (:cust_id, :game_day, :game_hr)
+                                RETURNING carts.id
+                                """)
+
+
 @router.post("/")
 def create_cart(new_cart: Customer):
     """ 
@@ -206,43 +643,32 @@ def create_cart(new_cart: Customer):
     """
 
     create_time = {}
-    day_sql = """SELECT day, hour
-                 FROM curr_time
-                """
 
     curr_customer = {
                         "cust_name": new_cart.customer_name,
                         "cust_class": new_cart.character_class,
                         "level": new_cart.level,
                     }
-    
-    search_cust = sqlalchemy.text("""SELECT id
-                     FROM customers
-                     WHERE (cust_name = :cust_name
-                            AND cust_class = :cust_class
-                            AND level = :level)
-                    """)
-
-    insert_cart_sql = sqlalchemy.text("""
-                                    INSERT INTO carts (cust_id, game_day, game_hr)
-                                    VALUES (:cust_id, :game_day, :game_hr)
-                                    RETURNING carts.id
-                                    """)
-    
+
+    cache_key = (new_cart.customer_name, new_cart.character_class, new_cart.level)
+    customer = customer_id_cache.get(cache_key)
         
-    with db.engine.begin() as connection:
-        time_qry = connection.execute(sqlalchemy.text(day_sql)).fetchone()
-        #print(f"Time query: {time_qry}")
-        customer = connection.execute(search_cust, curr_customer).scalar()
+    with replica_database.write_transaction("carts") as connection:
+        game_day, game_hr = game_clock.current(connection)
+        if customer is None:
+            # not seen in a visit from this process (restart, evicted, other worker) -> ask the db
+            customer = connection.execute(search_cust_sql, curr_customer).scalar()
+            if customer is not None:
+                customer_id_cache.put(cache_key, customer)
         create_time = {
                     "cust_id": customer,
-                    "game_day": time_qry.day,
-                    "game_hr": time_qry.hour
+                    "game_day": game_day,
+                    "game_hr": game_hr
                   }
         unique_cart = connection.execute(insert_cart_sql, create_time).scalar()
 
     #test logs
-    print(f"Unique cart #{unique_cart} for customer {curr_customer['cust_name']}")
+    logger.debug("Unique cart #%s for customer %s", unique_cart, curr_customer['cust_name'])
 
     return {"cart_id": unique_cart}
 
@@ -251,6 +677,14 @@ class CartItem(BaseModel):
     quantity: int
 
 
+lineitem_sql = statements.register("carts.line_item", """
+                                INSERT INTO line_items (cart_id, item_sku, potion_id, quantity, price)
+                                VALUES (:cart_id, :item_sku, :potion_id, :quantity, :price)
+                                ON CONFLICT DO NOTHING
+                                RETURNING line_items.line_id
+                               """)
+
+
 @router.post("/{cart_id}/items/{item_sku}")
 def set_item_quantity(cart_id: int, item_sku: str, cart_item: CartItem):
     """ 
@@ -267,85 +701,238 @@ def set_item_quantity(cart_id: int, item_sku: str, cart_item: CartItem):
     }
     """
 
+    if not potion_catalog.loaded():
+        with db.engine.begin() as connection:
+            potion_catalog.ensure_loaded(connection)
+
+    potion = potion_catalog.lookup(item_sku)
+    if potion is None and potion_catalog.reload_on_miss():
+        # might be a potion added since we loaded, check once before turning it away
+        with db.engine.begin() as connection:
+            potion_catalog.reload(connection)
+        potion = potion_catalog.lookup(item_sku)
+    if potion is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown potion sku: {item_sku}")
+    potion_id, price = potion
+
     line_dict = {
                     "cart_id": cart_id,
                     "item_sku": item_sku,
-                    "quantity": cart_item.quantity
+                    "potion_id": potion_id,
+                    "quantity": cart_item.quantity,
+                    "price": price
                 }
-
-    
-    lineitem_sql = sqlalchemy.text("""
-                                    INSERT INTO line_items (cart_id, item_sku, potion_id, quantity, price)
-                                    VALUES (:cart_id, :item_sku, 
-                                            (SELECT id FROM potion_inventory WHERE sku = :item_sku), 
-                                            :quantity, 
-                                            (SELECT price FROM potion_inventory WHERE sku = :item_sku))
-                                    ON CONFLICT DO NOTHING
-                                    RETURNING line_items.line_id
-                                   """)
     
     try:
-        with db.engine.begin() as connection:
-            connection.execute(lineitem_sql, line_dict)
-    except Exception as e:
-        print(f"Error with setting item quantity: {e}")
-
-    return "OK"
+        with replica_database.write_transaction("carts") as connection:
+            new_line = connection.execute(lineitem_sql, line_dict).scalar()
+    except IntegrityError as e:
+        # bad cart id etc., surface it instead of pretending it worked
+        logger.error("Error with setting item quantity: %s", e)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Could not add {item_sku} to cart {cart_id}")
 
+    # a new line item can show up on any search page
+    if new_line is not None:
+        search_cache.invalidate()
 
+    return "OK"
 
 
 class CartCheckout(BaseModel):
     payment: str
 
+
+# claim the processed row first, ledgers only get written if the claim went through.
+# the same statement bumps the hourly sales rollup (migrations/007) the planners read demand from
+checkout_sql = statements.register("carts.checkout", """
+                                WITH claim AS (
+                                    INSERT INTO processed (job_id, type)
+                                    VALUES (:cart_id, 'checkout')
+                                    ON CONFLICT DO NOTHING
+                                    RETURNING job_id
+                                ),
+                                items AS (
+                                    SELECT potion_id, quantity, price
+                                    FROM line_items
+                                    WHERE cart_id = :cart_id
+                                        AND EXISTS (SELECT 1 FROM claim)
+                                ),
+                                deposit AS (
+                                    INSERT INTO gold_ledger (transactions, game_day, game_hr, reason, cart_id)
+                                    SELECT SUM(quantity * price),
+                                           :game_day,
+                                           :game_hr,
+                                           'potion checkout',
+                                           :cart_id
+                                    FROM items
+                                    HAVING EXISTS (SELECT 1 FROM claim)
+                                    RETURNING transactions
+                                ),
+                                potion_subtract AS (
+                                    INSERT INTO potion_ledger (potion_id, transaction, cart_id, reason, game_day, game_hr)
+                                    SELECT potion_id, (-1*quantity), :cart_id, 'cart checkout', :game_day, :game_hr
+                                    FROM items
+                                    RETURNING transaction
+                                ),
+                                sales AS (
+                                    INSERT INTO potion_sales_hourly (game_day, game_hr, potion_id, stripe, quantity, gold)
+                                    SELECT :game_day, :game_hr, potion_id, balance_stripe(), SUM(quantity), SUM(quantity * price)
+                                    FROM items
+                                    GROUP BY potion_id
+                                    ORDER BY potion_id
+                                    ON CONFLICT (game_day, game_hr, potion_id, stripe) DO UPDATE
+                                    SET quantity = potion_sales_hourly.quantity + EXCLUDED.quantity,
+                                        gold = potion_sales_hourly.gold + EXCLUDED.gold
+                                )
+                                SELECT EXISTS (SELECT 1 FROM claim) AS claimed,
+                                       (SELECT transactions FROM deposit) AS total_gold_paid,
+                                       (SELECT -1*SUM(transaction) FROM potion_subtract) AS total_potions_bought
+                                """)
+
+
+# a retry that lost the claim reads back what the first checkout paid. This has to be its own
+# statement: when the claim hit the first attempt still in flight, it waited for that commit, but
+# the checkout statement's snapshot is from before it and can't see the first attempt's ledger rows
+checkout_totals_sql = statements.register("carts.checkout_totals", """
+                                SELECT cart_id,
+                                       FALSE AS claimed,
+                                       (SELECT SUM(transactions) FROM gold_ledger
+                                        WHERE gold_ledger.cart_id = batch.cart_id
+                                            AND reason = 'potion checkout') AS total_gold_paid,
+                                       (SELECT -1*SUM(transaction) FROM potion_ledger
+                                        WHERE potion_ledger.cart_id = batch.cart_id
+                                            AND reason = 'cart checkout') AS total_potions_bought
+                                FROM unnest(CAST(:cart_ids AS int[])) AS batch (cart_id)
+                                """)
+
+
+# same thing for a whole batch of carts at once (group commit): one claim, one gold
+# insert and one potion insert for every cart in :cart_ids, one row back per cart.
+# carts that were already claimed get their totals from checkout_totals_sql afterwards
+checkout_batch_sql = statements.register("carts.checkout_batch", """
+                                WITH batch AS (
+                                    SELECT DISTINCT unnest(CAST(:cart_ids AS int[])) AS cart_id
+                                ),
+                                claim AS (
+                                    INSERT INTO processed (job_id, type)
+                                    SELECT cart_id, 'checkout'
+                                    FROM batch
+                                    ORDER BY cart_id
+                                    ON CONFLICT DO NOTHING
+                                    RETURNING job_id AS cart_id
+                                ),
+                                items AS (
+                                    SELECT line_items.cart_id, potion_id, quantity, price
+                                    FROM line_items
+                                    JOIN claim ON claim.cart_id = line_items.cart_id
+                                ),
+                                deposit AS (
+                                    -- from claim, so an empty cart gets its gold row like checkout_sql writes
+                                    INSERT INTO gold_ledger (transactions, game_day, game_hr, reason, cart_id)
+                                    SELECT SUM(items.quantity * items.price), :game_day, :game_hr, 'potion checkout',
+                                           claim.cart_id
+                                    FROM claim
+                                    LEFT JOIN items ON items.cart_id = claim.cart_id
+                                    GROUP BY claim.cart_id
+                                    RETURNING cart_id, transactions
+                                ),
+                                potion_subtract AS (
+                                    INSERT INTO potion_ledger (potion_id, transaction, cart_id, reason, game_day, game_hr)
+                                    SELECT potion_id, (-1*quantity), cart_id, 'cart checkout', :game_day, :game_hr
+                                    FROM items
+                                    ORDER BY potion_id, cart_id
+                                    RETURNING cart_id, transaction
+                                ),
+                                sales AS (
+                                    INSERT INTO potion_sales_hourly (game_day, game_hr, potion_id, stripe, quantity, gold)
+                                    SELECT :game_day, :game_hr, potion_id, balance_stripe(), SUM(quantity), SUM(quantity * price)
+                                    FROM items
+                                    GROUP BY potion_id
+                                    ORDER BY potion_id
+                                    ON CONFLICT (game_day, game_hr, potion_id, stripe) DO UPDATE
+                                    SET quantity = potion_sales_hourly.quantity + EXCLUDED.quantity,
+                                        gold = potion_sales_hourly.gold + EXCLUDED.gold
+                                )
+                                SELECT batch.cart_id,
+                                       claim.cart_id IS NOT NULL AS claimed,
+                                       (SELECT transactions FROM deposit
+                                        WHERE deposit.cart_id = batch.cart_id) AS total_gold_paid,
+                                       (SELECT -1*SUM(transaction) FROM potion_subtract
+                                        WHERE potion_subtract.cart_id = batch.cart_id) AS total_potions_bought
+                                FROM batch
+                                LEFT JOIN claim ON claim.cart_id = batch.cart_id
+                                """)
+
+
+def checkout_cart(cart_id: int):
+    with replica_database.write_transaction("carts") as connection:
+        game_day, game_hr = game_clock.current(connection)
+        result = connection.execute(checkout_sql, {"cart_id": cart_id, "game_day": game_day, "game_hr": game_hr}).fetchone()
+        if not result.claimed:
+            result = connection.execute(checkout_totals_sql, {"cart_ids": [cart_id]}).fetchone()
+        return result
+
+
+def checkout_carts(cart_ids: list):
+    """
+    Batch handler: every cart in one transaction. If the batch fails (one bad cart
+    rolls back everyone), each cart gets retried on its own so only the bad one errors.
+    """
+    try:
+        with replica_database.write_transaction("carts") as connection:
+            game_day, game_hr = game_clock.current(connection)
+            rows = connection.execute(checkout_batch_sql, {"cart_ids": cart_ids,
+                                                           "game_day": game_day,
+                                                           "game_hr": game_hr}).fetchall()
+            already = [row.cart_id for row in rows if not row.claimed]
+            if already:
+                rows += connection.execute(checkout_totals_sql, {"cart_ids": already}).fetchall()
+    except Exception as e:
+        logger.warning("Batched checkout of %s carts failed, checking out one by one: %s", len(cart_ids), e)
+        results = []
+        for cart_id in cart_ids:
+            try:
+                results.append(checkout_cart(cart_id))
+            except Exception as cart_error:
+                results.append(cart_error)
+        return results
+
+    by_cart = {row.cart_id: row for row in rows}
+    return [by_cart[cart_id] for cart_id in cart_ids]
+
+
+# opt-in group commit: POTION_SHOP_CHECKOUT_BATCH_MS=5 gathers checkouts for up to 5ms into one transaction
+checkout_batch_ms = float(os.environ.get("POTION_SHOP_CHECKOUT_BATCH_MS", "0"))
+checkout_batcher = MicroBatcher(checkout_carts, checkout_batch_ms / 1000) if checkout_batch_ms > 0 else None
+
+
 @router.post("/{cart_id}/checkout")
 def checkout(cart_id: int, cart_checkout: CartCheckout):
     """ 
     LOGIC: CartCheckout has property: payment
+
+    One round trip: claim the processed row first, and only write the gold + potion
+    ledgers if the claim went through. A retried checkout just reads back what the
+    first one paid instead of writing anything. With checkout batching on, the
+    round trip is shared with whatever other checkouts came in during the window.
     """
 
     checkout_summary = {
         'total_potions_bought':0, 
         'total_gold_paid': 0
         }
-    already_processed = False
-    
-    deposit_sql = sqlalchemy.text("""INSERT INTO gold_ledger (transactions, game_day, game_hr, reason, cart_id)
-                                 VALUES ( (SELECT sum(quantity * price) FROM line_items WHERE cart_id = :cart_id), 
-                                          (SELECT day FROM curr_time), 
-                                          (SELECT hour FROM curr_time), 
-                                            'potion checkout', 
-                                            :cart_id)
-                                  RETURNING transactions
-                                """)
-    
-    potion_subtract_sql = sqlalchemy.text("""
-                                          WITH line_item_lookup AS 
-                                                (SELECT (-1*quantity) AS potion_amt, item_sku, potion_id
-                                                FROM line_items
-                                                WHERE cart_id = :cart_id)
-                                          INSERT INTO potion_ledger (potion_id, transaction, cart_id, reason)
-                                          SELECT potion_id, potion_amt, :cart_id, 'cart checkout'
-                                          FROM line_item_lookup
-                                          RETURNING transaction""")
     
-    with db.engine.begin() as connection:
-        
-        paid_gold = connection.execute(deposit_sql, {"cart_id": cart_id}).scalar()
-        potion_amt_sold = connection.execute(potion_subtract_sql, {"cart_id": cart_id}).scalar()
-
-        try:
-            connection.execute(sqlalchemy.text("""INSERT INTO processed (job_id, type)
-                                                        VALUES (:cart_id, 'checkout')
-                                                    """), {"cart_id": cart_id})
-        except IntegrityError as e:
-            already_processed = True
-            print(f"Tried to call cart_checkout again on cart_id: {cart_id}")
+    if checkout_batcher is not None:
+        result = checkout_batcher.submit(cart_id)
+    else:
+        result = checkout_cart(cart_id)
 
+    if not result.claimed:
+        logger.warning("Tried to call cart_checkout again on cart_id: %s", cart_id)
 
-    checkout_summary['total_potions_bought'] = -1 * potion_amt_sold
-    checkout_summary['total_gold_paid'] = paid_gold
+    checkout_summary['total_potions_bought'] = result.total_potions_bought or 0
+    checkout_summary['total_gold_paid'] = result.total_gold_paid or 0
     
-    print(f"Customer with cart id: {cart_id} paid with {cart_checkout}\nSummary of checkout: {checkout_summary}")
+    logger.debug("Customer with cart id: %s paid with %s. Summary of checkout: %s", cart_id, cart_checkout, checkout_summary)
         
     return checkout_summary
@@ -0,0 +1,324 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from src.api import auth
+from src.api import capture
+from src.api import instrumentation
+from src.api.batching import AsyncMicroBatcher, QueueFull
+from src.api.fast_json import json_body, body_schema
+
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeout
+from src.api import async_database
+from src.api.async_database import async_engine
+from src.api.game_clock import clock as game_clock, curr_time_sql
+from src.api.potion_catalog import catalog as potion_catalog, catalog_sql
+from src.api.carts import (
+    Customer, CartItem, CartCheckout, customer_list,
+    search_sort_options, search_sort_order,
+    build_search_query, search_page_response,
+    export_format, EXPORT_BATCH_ROWS, build_export_query, export_header, encode_export_rows, export_response,
+    export_max_concurrent, export_wait_seconds, exports_busy,
+    customer_id_cache, search_cache, search_cache_key,
+    customer_visit_sql, search_cust_sql, insert_cart_sql, lineitem_sql, checkout_sql,
+    checkout_batch_sql, checkout_totals_sql, checkout_batch_ms,
+    visitor_key, visit_arrays, visit_batch_ms, visit_max_pending_async, visits_busy,
+)
+
+import logging
+
+"""
+async def versions of the cart endpoints on the asyncpg engine, so cart bursts
+aren't capped by the threadpool. Same statements, caches and responses as
+carts.py, only the I/O differs. Mounted instead of carts.router when
+async_database.enabled is set.
+"""
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/carts",
+    tags=["cart"],
+    dependencies=[Depends(auth.get_api_key), Depends(instrumentation.track_request)],
+    route_class=capture.CaptureRoute,
+)
+
+
+async def reload_catalog(connection):
+    """
+    potion_catalog.reload on the async engine.
+    """
+    while True:
+        generation = potion_catalog.generation
+        if potion_catalog.load((await connection.execute(catalog_sql)).fetchall(), generation):
+            return
+
+
+async def current_game_time(connection):
+    now = game_clock.cached()
+    if now is None:
+        row = (await connection.execute(curr_time_sql)).fetchone()
+        game_clock.set(row.day, row.hour)
+        now = (row.day, row.hour)
+    return now
+
+
+@router.get("/search/", tags=["search"])
+async def search_orders(
+    customer_name: str = "",
+    potion_sku: str = "",
+    search_page: str = "",
+    sort_col: search_sort_options = search_sort_options.timestamp,
+    sort_order: search_sort_order = search_sort_order.desc,
+    use_cache: bool = True,
+):
+    """
+    Search for cart line items by customer name and/or potion sku.
+    Same contract as carts.search_orders.
+    """
+    cache_key = search_cache_key(customer_name, potion_sku, search_page, sort_col, sort_order)
+    if use_cache:
+        cached_response = search_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+
+    # a line item added while the query runs invalidates the cache, and then this page mustn't go in
+    generation = search_cache.generation
+    results_sql, search_dict, direction = build_search_query(customer_name, potion_sku, search_page,
+                                                             sort_col, sort_order)
+
+    response = {"previous": "", "next": "", "results": []}
+
+    try:
+        async with async_engine.begin() as connection:
+            results = await connection.execute(results_sql, search_dict)
+            results_list = [dict(row._mapping) for row in results.fetchall()]
+
+        response = search_page_response(results_list, direction, search_page, sort_col, sort_order)
+        search_cache.put(cache_key, response, generation)
+
+    except Exception as e:
+        logger.error("Error trying to grab line item results: %s", e)
+
+    return response
+
+
+# exports' own pool, see carts.export_pool
+export_engine = async_database.create_engine(pool_size=export_max_concurrent, max_overflow=0,
+                                             pool_timeout=export_wait_seconds) if async_engine is not None else None
+
+
+async def export_chunks(connection, export_sql, export_dict: dict, format: export_format):
+    """
+    Same as carts.export_chunks, on an asyncpg server-side cursor.
+    """
+    try:
+        yield export_header(format)
+        results = await connection.stream(export_sql, export_dict)
+        async for rows in results.partitions(EXPORT_BATCH_ROWS):
+            yield encode_export_rows(rows, format)
+    finally:
+        await connection.close()
+
+
+@router.get("/export/", tags=["search"])
+async def export_orders(
+    customer_name: str = "",
+    potion_sku: str = "",
+    format: export_format = export_format.ndjson,
+):
+    """
+    Streams every matching line item as NDJSON or CSV, see carts.export_orders.
+    """
+    export_sql, export_dict = build_export_query(customer_name, potion_sku)
+    try:
+        connection = await export_engine.connect()
+    except PoolTimeout as e:
+        raise exports_busy(e)
+    return export_response(export_chunks(connection, export_sql, export_dict, format), format)
+
+
+async def record_visitors(visitors: list):
+    async with async_engine.begin() as connection:
+        visitor_ids = (await connection.execute(customer_visit_sql, visit_arrays(visitors))).fetchall()
+
+    customer_id_cache.put_many(((row.cust_name, row.cust_class, row.level), row.id) for row in visitor_ids)
+
+
+async def record_visit_batches(payloads: list):
+    """
+    Batch handler, see carts.record_visit_batches.
+    """
+    visitors = list(dict.fromkeys(visitor_key(customer) for customers in payloads for customer in customers))
+    try:
+        await record_visitors(visitors)
+    except Exception as e:
+        logger.warning("Batched visits (%s payloads) failed, writing one by one: %s", len(payloads), e)
+        results = []
+        for customers in payloads:
+            try:
+                await record_visitors(list(dict.fromkeys(visitor_key(customer) for customer in customers)))
+                results.append("OK")
+            except Exception as payload_error:
+                results.append(payload_error)
+        return results
+    return ["OK"] * len(payloads)
+
+
+visit_batcher = AsyncMicroBatcher(record_visit_batches, visit_batch_ms / 1000,
+                                  max_pending=visit_max_pending_async) if visit_batch_ms > 0 else None
+
+
+@router.post("/visits/{visit_id}", openapi_extra=body_schema(customer_list))
+async def post_visits(visit_id: int, customers: list[Customer] = Depends(json_body(customer_list))):
+    """
+    Which customers visited the shop today?
+    """
+    logger.info("Customer count this tick: %s", len(customers))
+
+    if not customers:
+        logger.info('Uuuuuuuuh, no customers came :(')
+        return "OK"
+
+    if visit_batcher is not None:
+        try:
+            await visit_batcher.submit(customers)
+        except QueueFull as e:
+            raise visits_busy(e)
+    else:
+        await record_visitors(list(dict.fromkeys(visitor_key(customer) for customer in customers)))
+
+    return "OK"
+
+
+@router.post("/")
+async def create_cart(new_cart: Customer):
+    """ 
+    LOGIC: insert into carts db for each new created cart, will link back to a single customer id
+    """
+    curr_customer = {
+                        "cust_name": new_cart.customer_name,
+                        "cust_class": new_cart.character_class,
+                        "level": new_cart.level,
+                    }
+
+    cache_key = (new_cart.customer_name, new_cart.character_class, new_cart.level)
+    customer = customer_id_cache.get(cache_key)
+
+    async with async_engine.begin() as connection:
+        game_day, game_hr = await current_game_time(connection)
+        if customer is None:
+            customer = (await connection.execute(search_cust_sql, curr_customer)).scalar()
+            if customer is not None:
+                customer_id_cache.put(cache_key, customer)
+        unique_cart = (await connection.execute(insert_cart_sql, {
+                                                    "cust_id": customer,
+                                                    "game_day": game_day,
+                                                    "game_hr": game_hr
+                                                })).scalar()
+
+    logger.debug("Unique cart #%s for customer %s", unique_cart, curr_customer['cust_name'])
+
+    return {"cart_id": unique_cart}
+
+
+@router.post("/{cart_id}/items/{item_sku}")
+async def set_item_quantity(cart_id: int, item_sku: str, cart_item: CartItem):
+    """ 
+    LOGIC: update the quantity of a specific item in a cart
+    """
+    if not potion_catalog.loaded():
+        async with async_engine.begin() as connection:
+            await reload_catalog(connection)
+
+    potion = potion_catalog.lookup(item_sku)
+    if potion is None and potion_catalog.reload_on_miss():
+        # might be a potion added since we loaded, check once before turning it away
+        async with async_engine.begin() as connection:
+            await reload_catalog(connection)
+        potion = potion_catalog.lookup(item_sku)
+    if potion is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown potion sku: {item_sku}")
+    potion_id, price = potion
+
+    line_dict = {
+                    "cart_id": cart_id,
+                    "item_sku": item_sku,
+                    "potion_id": potion_id,
+                    "quantity": cart_item.quantity,
+                    "price": price
+                }
+
+    try:
+        async with async_engine.begin() as connection:
+            new_line = (await connection.execute(lineitem_sql, line_dict)).scalar()
+    except IntegrityError as e:
+        logger.error("Error with setting item quantity: %s", e)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Could not add {item_sku} to cart {cart_id}")
+
+    # a new line item can show up on any search page
+    if new_line is not None:
+        search_cache.invalidate()
+
+    return "OK"
+
+
+async def checkout_cart(cart_id: int):
+    async with async_engine.begin() as connection:
+        game_day, game_hr = await current_game_time(connection)
+        result = (await connection.execute(checkout_sql, {"cart_id": cart_id,
+                                                          "game_day": game_day,
+                                                          "game_hr": game_hr})).fetchone()
+        if not result.claimed:
+            result = (await connection.execute(checkout_totals_sql, {"cart_ids": [cart_id]})).fetchone()
+        return result
+
+
+async def checkout_carts(cart_ids: list):
+    """
+    Batch handler, see carts.checkout_carts.
+    """
+    try:
+        async with async_engine.begin() as connection:
+            game_day, game_hr = await current_game_time(connection)
+            rows = (await connection.execute(checkout_batch_sql, {"cart_ids": cart_ids,
+                                                                  "game_day": game_day,
+                                                                  "game_hr": game_hr})).fetchall()
+            already = [row.cart_id for row in rows if not row.claimed]
+            if already:
+                rows += (await connection.execute(checkout_totals_sql, {"cart_ids": already})).fetchall()
+    except Exception as e:
+        logger.warning("Batched checkout of %s carts failed, checking out one by one: %s", len(cart_ids), e)
+        results = []
+        for cart_id in cart_ids:
+            try:
+                results.append(await checkout_cart(cart_id))
+            except Exception as cart_error:
+                results.append(cart_error)
+        return results
+
+    by_cart = {row.cart_id: row for row in rows}
+    return [by_cart[cart_id] for cart_id in cart_ids]
+
+
+checkout_batcher = AsyncMicroBatcher(checkout_carts, checkout_batch_ms / 1000) if checkout_batch_ms > 0 else None
+
+
+@router.post("/{cart_id}/checkout")
+async def checkout(cart_id: int, cart_checkout: CartCheckout):
+    """ 
+    LOGIC: CartCheckout has property: payment
+    """
+    if checkout_batcher is not None:
+        result = await checkout_batcher.submit(cart_id)
+    else:
+        result = await checkout_cart(cart_id)
+
+    if not result.claimed:
+        logger.warning("Tried to call cart_checkout again on cart_id: %s", cart_id)
+
+    checkout_summary = {
+        'total_potions_bought': result.total_potions_bought or 0,
+        'total_gold_paid': result.total_gold_paid or 0
+        }
+
+    logger.debug("Customer with cart id: %s paid with %s. Summary of checkout: %s", cart_id, cart_checkout, checkout_summary)
+
+    return checkout_summary
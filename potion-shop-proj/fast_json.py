@@ -0,0 +1,52 @@
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
+
+try:
+    import orjson  # noqa: F401  (ORJSONResponse needs it at render time)
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+except ImportError:
+    from fastapi.responses import JSONResponse as FastJSONResponse
+
+"""
+Fast path for the big JSON payloads (wholesale catalog, visit lists).
+
+json_body(adapter) is a dependency that validates the raw request bytes in one
+TypeAdapter.validate_json call, instead of FastAPI doing json.loads into a dict
+tree and validating that item by item. Errors still come back as the usual 422.
+
+FastJSONResponse is ORJSONResponse when orjson is installed (JSONResponse
+otherwise); handlers return it directly so the body skips jsonable_encoder.
+"""
+
+
+def json_body(adapter: TypeAdapter):
+    async def parse(request: Request):
+        try:
+            return adapter.validate_json(await request.body())
+        except ValidationError as e:
+            # same locations FastAPI reports for a body it parsed itself: ("body", 0, "level")
+            raise RequestValidationError([{**error, "loc": ("body", *error["loc"])}
+                                          for error in e.errors(include_url=False)])
+    return parse
+
+
+def body_schema(adapter: TypeAdapter):
+    """
+    openapi_extra for a route that takes its body through json_body, so /docs still shows it.
+    Nested models are inlined, the route's schema isn't part of the app's components.
+    """
+    schema = adapter.json_schema()
+    defs = schema.pop("$defs", {})
+
+    def inline(node):
+        if isinstance(node, dict):
+            ref = node.get("$ref")
+            if ref and ref.startswith("#/$defs/"):
+                return inline(defs[ref[len("#/$defs/"):]])
+            return {key: inline(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [inline(value) for value in node]
+        return node
+
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": inline(schema)}}}}
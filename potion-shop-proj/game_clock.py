@@ -0,0 +1,77 @@
+from src.api import notifications
+from src.api import statements
+
+import threading
+import time
+
+"""
+Process-wide copy of curr_time so writes can bind game_day/game_hr as plain
+parameters instead of running (SELECT day FROM curr_time) subqueries.
+
+Every process follows the tick through Postgres: migrations/009 makes any change
+to curr_time NOTIFY potion_shop_tick, and clock.set(day, hour) runs as soon as it
+arrives (notifications.py), whoever advanced the clock. The refresh interval is
+only a backstop for when the listener is down or reconnecting.
+"""
+
+curr_time_sql = statements.register("game_clock.curr_time", "SELECT day, hour FROM curr_time")
+
+
+class GameClock:
+    def __init__(self, refresh_seconds: float):
+        self.refresh_seconds = refresh_seconds
+        self._day = None
+        self._hour = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def cached(self):
+        """
+        (day, hour) if we have a fresh copy, otherwise None.
+        """
+        with self._lock:
+            if self._day is None or time.monotonic() - self._loaded_at > self.refresh_seconds:
+                return None
+            return self._day, self._hour
+
+    def last_known(self):
+        """
+        (day, hour) from the last load even if it's stale, or None if never loaded.
+        """
+        with self._lock:
+            if self._day is None:
+                return None
+            return self._day, self._hour
+
+    def set(self, day, hour):
+        with self._lock:
+            self._day = day
+            self._hour = hour
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._day = None
+
+    def current(self, connection):
+        """
+        (day, hour), only going to curr_time (on the given connection) when the cached copy is stale.
+        """
+        now = self.cached()
+        if now is None:
+            row = connection.execute(curr_time_sql).fetchone()
+            self.set(row.day, row.hour)
+            now = (row.day, row.hour)
+        return now
+
+
+clock = GameClock(refresh_seconds=5.0)
+
+
+def on_tick(payload: str):
+    day, hour = payload.split(",")
+    clock.set(int(day), int(hour))
+
+
+# after a reconnect we may have missed a tick, so drop the cached one
+notifications.subscribe("potion_shop_tick", on_tick, on_reconnect=clock.invalidate)
@@ -0,0 +1,171 @@
+from fastapi import APIRouter, Depends, Request
+from sqlalchemy import event
+from src.api import auth
+from src import database as db
+
+from collections import deque
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+"""
+Per-request timing + SQL counters for the routers.
+
+Each router adds Depends(track_request). That times the request, and the engine
+listeners below count statements, their time and rows against whatever request
+is running in the current context. Every request logs one structured "request"
+record on the potion_shop.metrics logger. A statement slower than
+POTION_SHOP_SLOW_QUERY_MS also logs a "slow_query" warning. GET /metrics/
+returns the in-process aggregates.
+"""
+
+logger = logging.getLogger("potion_shop.metrics")
+
+SLOW_QUERY_MS = float(os.environ.get("POTION_SHOP_SLOW_QUERY_MS", "100"))
+LATENCY_SAMPLES = 1000
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+endpoint_metrics = {}
+metrics_lock = threading.Lock()
+caches = {}
+
+
+def register_cache(name: str, cache):
+    """
+    Anything with a stats() method, shows up under "caches" in /metrics/.
+    """
+    caches[name] = cache
+
+
+# -----------------------------------------------
+# SQLAlchemy engine hooks
+# -----------------------------------------------
+# the start time lives on the execution context, not conn.info: a statement that raises never
+# reaches after_cursor_execute, and anything stacked on the connection would pile up there for good
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.query_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - context.query_start) * 1000
+    rows = cursor.rowcount if cursor.rowcount and cursor.rowcount > 0 else 0
+
+    stats = current_request.get()
+    if stats is not None:
+        stats["sql_statements"] += 1
+        stats["sql_ms"] += elapsed_ms
+        stats["rows"] += rows
+
+    if elapsed_ms >= SLOW_QUERY_MS:
+        record = {
+            "event": "slow_query",
+            "endpoint": stats["endpoint"] if stats else None,
+            "ms": round(elapsed_ms, 2),
+            "rows": rows,
+            "statement": " ".join(statement.split())[:500],
+        }
+        logger.warning(json.dumps(record), extra={"metrics": record})
+        if stats is not None:
+            stats["slow_queries"] += 1
+
+
+def install(engine):
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+install(db.engine)
+
+
+# -----------------------------------------------
+# Request tracking
+# -----------------------------------------------
+async def track_request(request: Request):
+    """
+    Router dependency. Has to be async so the contextvar is set in the request's
+    own context, which the threadpool copies into sync handlers.
+    """
+    route = request.scope.get("route")
+    stats = {
+        "endpoint": f"{request.method} {route.path if route else request.url.path}",
+        "sql_statements": 0,
+        "sql_ms": 0.0,
+        "rows": 0,
+        "slow_queries": 0,
+    }
+    current_request.set(stats)
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats["wall_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        stats["sql_ms"] = round(stats["sql_ms"], 2)
+        record_request(stats)
+
+
+def record_request(stats: dict):
+    record = {"event": "request", **stats}
+    logger.info(json.dumps(record), extra={"metrics": record})
+
+    with metrics_lock:
+        entry = endpoint_metrics.setdefault(stats["endpoint"], {
+            "requests": 0,
+            "wall_ms_total": 0.0,
+            "wall_ms_max": 0.0,
+            "sql_statements": 0,
+            "sql_ms_total": 0.0,
+            "rows": 0,
+            "slow_queries": 0,
+            "recent_wall_ms": deque(maxlen=LATENCY_SAMPLES),
+        })
+        entry["requests"] += 1
+        entry["wall_ms_total"] += stats["wall_ms"]
+        entry["wall_ms_max"] = max(entry["wall_ms_max"], stats["wall_ms"])
+        entry["sql_statements"] += stats["sql_statements"]
+        entry["sql_ms_total"] += stats["sql_ms"]
+        entry["rows"] += stats["rows"]
+        entry["slow_queries"] += stats["slow_queries"]
+        entry["recent_wall_ms"].append(stats["wall_ms"])
+
+
+def snapshot():
+    endpoints = {}
+    with metrics_lock:
+        for endpoint, entry in endpoint_metrics.items():
+            recent = sorted(entry["recent_wall_ms"])
+            requests = entry["requests"]
+            endpoints[endpoint] = {
+                "requests": requests,
+                "wall_ms_avg": round(entry["wall_ms_total"] / requests, 2),
+                "wall_ms_p50": recent[len(recent) // 2],
+                "wall_ms_p95": recent[min(len(recent) - 1, int(len(recent) * 0.95))],
+                "wall_ms_max": entry["wall_ms_max"],
+                "sql_statements_per_request": round(entry["sql_statements"] / requests, 2),
+                "sql_ms_avg": round(entry["sql_ms_total"] / requests, 2),
+                "rows": entry["rows"],
+                "slow_queries": entry["slow_queries"],
+            }
+    return {
+        "slow_query_ms": SLOW_QUERY_MS,
+        "endpoints": endpoints,
+        "caches": {name: cache.stats() for name, cache in caches.items()},
+    }
+
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["metrics"],
+    dependencies=[Depends(auth.get_api_key)],
+)
+
+
+@router.get("/")
+def get_metrics():
+    """
+    In-process request/SQL metrics since this worker started.
+    """
+    return snapshot()
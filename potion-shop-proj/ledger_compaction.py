@@ -0,0 +1,193 @@
+import sqlalchemy
+from src import database as db
+
+import argparse
+import re
+import time
+
+"""
+Rolls closed game days of gold_ledger, ml_ledger and potion_ledger into one
+opening-balance row per entity, then detaches the old day partitions
+(migrations/005). Detached partitions are dropped, or with --archive moved into
+the ledger_archive schema. Also creates partitions a few days ahead so new rows
+don't pile up in the default partition.
+
+Partitions are created one per transaction, with the same lock_timeout and
+retries as the folds below. Days are folded forward one at a time, oldest first,
+one short transaction per ledger and day: day d's rows (opening rows included) are summed into opening rows
+on day d + 1, then d's partition is detached. DETACH takes an ACCESS EXCLUSIVE
+lock on the whole ledger, so it's the last statement before the commit, and it
+gives up after lock_timeout and retries instead of queueing checkouts behind it.
+Every committed step leaves the ledger totals exactly where they were, so an
+interrupted run just picks up at the next day.
+
+The balance tables are left alone (potion_shop.compacting makes the triggers
+skip). Run once a game day:
+
+    python -m src.api.ledger_compaction --keep-days 7 [--archive]
+"""
+
+LEDGERS = ["gold_ledger", "ml_ledger", "potion_ledger"]
+DAYS_AHEAD = 3
+OPENING_REASON = "opening balance"
+LOCK_TIMEOUT = "2s"
+LOCK_RETRIES = 5
+
+partition_name = re.compile(r"^(gold_ledger|ml_ledger|potion_ledger)_d(\d+)$")
+
+partitions_sql = sqlalchemy.text("""
+                                SELECT child.relname AS partition
+                                FROM pg_inherits
+                                JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+                                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                                WHERE parent.relname = :ledger
+                                """)
+
+default_has_day_sql = {
+    ledger: sqlalchemy.text(f"SELECT EXISTS (SELECT 1 FROM {ledger}_default WHERE game_day = :day)")
+    for ledger in LEDGERS
+}
+
+default_days_sql = {
+    ledger: sqlalchemy.text(f"SELECT DISTINCT game_day FROM {ledger}_default WHERE game_day < :cutoff")
+    for ledger in LEDGERS
+}
+
+roll_sql = {
+    "gold_ledger": sqlalchemy.text("""
+                                INSERT INTO gold_ledger (transactions, game_day, game_hr, reason)
+                                SELECT COALESCE(SUM(transactions), 0), :day + 1, 0, :reason
+                                FROM gold_ledger
+                                WHERE game_day = :day
+                                HAVING COUNT(*) > 0
+                                """),
+    "ml_ledger": sqlalchemy.text("""
+                                INSERT INTO ml_ledger (red, green, blue, dark, game_day, game_hr)
+                                SELECT COALESCE(SUM(red), 0), COALESCE(SUM(green), 0),
+                                       COALESCE(SUM(blue), 0), COALESCE(SUM(dark), 0), :day + 1, 0
+                                FROM ml_ledger
+                                WHERE game_day = :day
+                                HAVING COUNT(*) > 0
+                                """),
+    "potion_ledger": sqlalchemy.text("""
+                                INSERT INTO potion_ledger (potion_id, transaction, reason, game_day, game_hr)
+                                SELECT potion_id, SUM(transaction), :reason, :day + 1, 0
+                                FROM potion_ledger
+                                WHERE game_day = :day
+                                GROUP BY potion_id
+                                """),
+}
+
+
+def partitions_by_day(connection, ledger: str):
+    days = {}
+    for row in connection.execute(partitions_sql, {"ledger": ledger}):
+        match = partition_name.match(row.partition)
+        if match:
+            days[int(match.group(2))] = row.partition
+    return days
+
+
+def with_lock_retries(step: str, work):
+    """
+    Runs work(connection) in a transaction of its own with lock_timeout = LOCK_TIMEOUT, so it gives
+    up instead of queueing checkouts behind a lock on the ledger, and retries it up to LOCK_RETRIES times.
+    """
+    for attempt in range(1, LOCK_RETRIES + 1):
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(sqlalchemy.text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+                work(connection)
+            return
+        except sqlalchemy.exc.OperationalError as e:
+            if "lock timeout" not in str(e) or attempt == LOCK_RETRIES:
+                raise
+            print(f"{step} couldn't get its lock (attempt {attempt}), retrying")
+            time.sleep(attempt)
+
+
+def ensure_partition(ledger: str, day: int):
+    """
+    One transaction per partition: CREATE TABLE ... PARTITION OF locks the parent ledger.
+    """
+    def create(connection):
+        # a day that already has rows in the default partition can't get its own partition any more
+        if connection.execute(default_has_day_sql[ledger], {"day": day}).scalar():
+            print(f"{ledger}: day {day} already has rows in {ledger}_default, leaving it there")
+            return
+        connection.execute(sqlalchemy.text("SELECT create_ledger_partition(:ledger, :day)"),
+                           {"ledger": ledger, "day": day})
+
+    with_lock_retries(f"{ledger}: partition for day {day}", create)
+
+
+def fold_day(ledger: str, day: int, partition: str, archive: bool):
+    """
+    One transaction: day's rows become opening rows on day + 1, then its partition goes.
+    Retried if the DETACH can't get its lock within LOCK_TIMEOUT.
+    """
+    def fold(connection):
+        connection.execute(sqlalchemy.text("SET LOCAL potion_shop.compacting = 'on'"))
+        connection.execute(roll_sql[ledger], {"day": day, "reason": OPENING_REASON})
+        # stragglers that landed in the default partition are in the opening rows now too
+        connection.execute(sqlalchemy.text(f"DELETE FROM {ledger}_default WHERE game_day = :day"),
+                           {"day": day})
+        if partition is None:
+            return
+        connection.execute(sqlalchemy.text(f"ALTER TABLE {ledger} DETACH PARTITION {partition}"))
+        if archive:
+            connection.execute(sqlalchemy.text(f"ALTER TABLE {partition} SET SCHEMA ledger_archive"))
+        else:
+            connection.execute(sqlalchemy.text(f"DROP TABLE {partition}"))
+
+    with_lock_retries(f"{ledger}: day {day}", fold)
+
+
+def compact_ledgers(keep_days: int, archive: bool = False):
+    """
+    Everything before (current day - keep_days) gets rolled up and detached, one day at a time.
+    Returns {ledger: [detached partitions]}.
+    """
+    detached = {ledger: [] for ledger in LEDGERS}
+
+    with db.engine.begin() as connection:
+        today = connection.execute(sqlalchemy.text("SELECT day FROM curr_time")).scalar()
+    cutoff = today - keep_days
+
+    for ledger in LEDGERS:
+        for day in range(max(cutoff, 0), today + DAYS_AHEAD + 1):
+            ensure_partition(ledger, day)
+
+    if cutoff <= 0:
+        return detached
+
+    with db.engine.begin() as connection:
+        if archive:
+            connection.execute(sqlalchemy.text("CREATE SCHEMA IF NOT EXISTS ledger_archive"))
+
+        work = {}
+        for ledger in LEDGERS:
+            partitions = {day: partition for day, partition in partitions_by_day(connection, ledger).items()
+                          if day < cutoff}
+            days = set(partitions) | set(connection.execute(default_days_sql[ledger], {"cutoff": cutoff}).scalars())
+            work[ledger] = (min(days, default=cutoff), partitions)
+
+    for ledger, (first_day, partitions) in work.items():
+        # each fold adds rows to the next day, so every day up to the cutoff, oldest first
+        for day in range(first_day, cutoff):
+            fold_day(ledger, day, partitions.get(day), archive)
+            if day in partitions:
+                detached[ledger].append(partitions[day])
+
+    return detached
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roll closed game days into opening balances")
+    parser.add_argument("--keep-days", type=int, default=7, help="closed days to keep as raw ledger rows")
+    parser.add_argument("--archive", action="store_true", help="keep detached partitions in ledger_archive")
+    args = parser.parse_args()
+
+    detached = compact_ledgers(args.keep_days, args.archive)
+    for ledger, partitions in detached.items():
+        print(f"{ledger}: {len(partitions)} partitions {'archived' if args.archive else 'dropped'}")
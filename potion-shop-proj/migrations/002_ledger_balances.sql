@@ -0,0 +1,117 @@
+-- Running balances for the append-only ledgers, kept up to date by triggers so
+-- the planners read one row instead of summing the whole ledger every tick.
+-- Every writer (barrels, bottler, carts, anything else) is covered without code changes.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS gold_balance (
+    id      int PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    gold    bigint NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS ml_balance (
+    id      int PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    red     bigint NOT NULL DEFAULT 0,
+    green   bigint NOT NULL DEFAULT 0,
+    blue    bigint NOT NULL DEFAULT 0,
+    dark    bigint NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS potion_balance (
+    potion_id   int PRIMARY KEY REFERENCES potion_inventory (id),
+    quantity    bigint NOT NULL DEFAULT 0
+);
+
+
+CREATE OR REPLACE FUNCTION gold_balance_apply() RETURNS trigger AS $$
+DECLARE
+    delta bigint := 0;
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        delta := delta + COALESCE(NEW.transactions, 0);
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        delta := delta - COALESCE(OLD.transactions, 0);
+    END IF;
+
+    UPDATE gold_balance SET gold = gold + delta WHERE id = 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ml_balance_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE ml_balance
+        SET red = red + COALESCE(NEW.red, 0),
+            green = green + COALESCE(NEW.green, 0),
+            blue = blue + COALESCE(NEW.blue, 0),
+            dark = dark + COALESCE(NEW.dark, 0)
+        WHERE id = 1;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE ml_balance
+        SET red = red - COALESCE(OLD.red, 0),
+            green = green - COALESCE(OLD.green, 0),
+            blue = blue - COALESCE(OLD.blue, 0),
+            dark = dark - COALESCE(OLD.dark, 0)
+        WHERE id = 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION potion_balance_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.potion_id IS NOT NULL THEN
+        INSERT INTO potion_balance (potion_id, quantity)
+        VALUES (NEW.potion_id, COALESCE(NEW.transaction, 0))
+        ON CONFLICT (potion_id) DO UPDATE
+            SET quantity = potion_balance.quantity + EXCLUDED.quantity;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.potion_id IS NOT NULL THEN
+        UPDATE potion_balance
+        SET quantity = quantity - COALESCE(OLD.transaction, 0)
+        WHERE potion_id = OLD.potion_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS gold_ledger_balance ON gold_ledger;
+CREATE TRIGGER gold_ledger_balance
+    AFTER INSERT OR UPDATE OR DELETE ON gold_ledger
+    FOR EACH ROW EXECUTE FUNCTION gold_balance_apply();
+
+DROP TRIGGER IF EXISTS ml_ledger_balance ON ml_ledger;
+CREATE TRIGGER ml_ledger_balance
+    AFTER INSERT OR UPDATE OR DELETE ON ml_ledger
+    FOR EACH ROW EXECUTE FUNCTION ml_balance_apply();
+
+DROP TRIGGER IF EXISTS potion_ledger_balance ON potion_ledger;
+CREATE TRIGGER potion_ledger_balance
+    AFTER INSERT OR UPDATE OR DELETE ON potion_ledger
+    FOR EACH ROW EXECUTE FUNCTION potion_balance_apply();
+
+
+-- Seed from the ledgers as they are now; the lock keeps writers out until the triggers are live.
+LOCK TABLE gold_ledger, ml_ledger, potion_ledger IN SHARE MODE;
+
+INSERT INTO gold_balance (id, gold)
+SELECT 1, COALESCE(SUM(transactions), 0) FROM gold_ledger
+ON CONFLICT (id) DO UPDATE SET gold = EXCLUDED.gold;
+
+INSERT INTO ml_balance (id, red, green, blue, dark)
+SELECT 1, COALESCE(SUM(red), 0), COALESCE(SUM(green), 0), COALESCE(SUM(blue), 0), COALESCE(SUM(dark), 0)
+FROM ml_ledger
+ON CONFLICT (id) DO UPDATE
+    SET red = EXCLUDED.red, green = EXCLUDED.green, blue = EXCLUDED.blue, dark = EXCLUDED.dark;
+
+INSERT INTO potion_balance (potion_id, quantity)
+SELECT potion_id, SUM(transaction) FROM potion_ledger
+WHERE potion_id IS NOT NULL
+GROUP BY potion_id
+ON CONFLICT (potion_id) DO UPDATE SET quantity = EXCLUDED.quantity;
+
+COMMIT;
@@ -0,0 +1,6 @@
+-- A retried checkout reads back the totals the first attempt wrote for the cart.
+CREATE INDEX IF NOT EXISTS gold_ledger_cart_id_idx
+    ON gold_ledger (cart_id) WHERE cart_id IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS potion_ledger_cart_id_idx
+    ON potion_ledger (cart_id) WHERE cart_id IS NOT NULL;
@@ -0,0 +1,29 @@
+-- One row per (cust_name, cust_class, level) so visits can bulk insert with ON CONFLICT.
+-- Concurrent visit batches could previously race past the NOT EXISTS check and
+-- create duplicates, so fold those into the lowest id first.
+
+BEGIN;
+
+LOCK TABLE customers, carts IN SHARE ROW EXCLUSIVE MODE;
+
+WITH keepers AS (
+    SELECT id, MIN(id) OVER (PARTITION BY cust_name, cust_class, level) AS keep_id
+    FROM customers
+)
+UPDATE carts
+SET cust_id = keepers.keep_id
+FROM keepers
+WHERE carts.cust_id = keepers.id
+    AND keepers.id <> keepers.keep_id;
+
+DELETE FROM customers
+USING customers AS keeper
+WHERE customers.cust_name = keeper.cust_name
+    AND customers.cust_class = keeper.cust_class
+    AND customers.level = keeper.level
+    AND customers.id > keeper.id;
+
+ALTER TABLE customers
+    ADD CONSTRAINT customers_identity_key UNIQUE (cust_name, cust_class, level);
+
+COMMIT;
@@ -0,0 +1,183 @@
+-- Partition gold_ledger, ml_ledger and potion_ledger by game_day so old days can be
+-- rolled into an opening balance and detached (ledger_compaction.py) instead of
+-- every scan covering the whole history.
+--
+-- The balance triggers skip rows while potion_shop.compacting is on, so compaction's
+-- opening-balance rows and deletes don't move gold_balance / ml_balance / potion_balance.
+
+BEGIN;
+
+LOCK TABLE gold_ledger, ml_ledger, potion_ledger IN ACCESS EXCLUSIVE MODE;
+
+-- the backfill below doesn't move any amounts and these tables are dropped at the end,
+-- so skip the balance triggers (otherwise every updated row rewrites the one balance row)
+ALTER TABLE gold_ledger DISABLE TRIGGER USER;
+ALTER TABLE ml_ledger DISABLE TRIGGER USER;
+ALTER TABLE potion_ledger DISABLE TRIGGER USER;
+
+-- potion_ledger never carried the game time, backfill from the cart where there is one
+ALTER TABLE potion_ledger ADD COLUMN IF NOT EXISTS game_day int;
+ALTER TABLE potion_ledger ADD COLUMN IF NOT EXISTS game_hr int;
+
+UPDATE potion_ledger
+SET game_day = carts.game_day, game_hr = carts.game_hr
+FROM carts
+WHERE potion_ledger.cart_id = carts.id
+    AND potion_ledger.game_day IS NULL;
+
+UPDATE potion_ledger SET game_day = 0 WHERE game_day IS NULL;
+UPDATE gold_ledger SET game_day = 0 WHERE game_day IS NULL;
+UPDATE ml_ledger SET game_day = 0 WHERE game_day IS NULL;
+
+
+CREATE OR REPLACE FUNCTION create_ledger_partition(ledger text, day int) RETURNS void AS $$
+BEGIN
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%s) TO (%s)',
+                   ledger || '_d' || day, ledger, day, day + 1);
+END;
+$$ LANGUAGE plpgsql;
+
+
+DO $$
+DECLARE
+    ledger text;
+    old_table text;
+    seq text;
+    identity "char";
+    day int;
+    fk record;
+BEGIN
+    FOREACH ledger IN ARRAY ARRAY['gold_ledger', 'ml_ledger', 'potion_ledger'] LOOP
+        old_table := ledger || '_unpartitioned';
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', ledger, old_table);
+
+        -- LIKE copies CHECK constraints with INCLUDING CONSTRAINTS, foreign keys never (re-added below)
+        EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING IDENTITY) '
+                       'PARTITION BY RANGE (game_day)', ledger, old_table);
+        EXECUTE format('ALTER TABLE %I ALTER COLUMN game_day SET NOT NULL', ledger);
+
+        -- keep ids counting on from where they were. A serial id's sequence moves to the new table;
+        -- an identity id gets a fresh sequence from INCLUDING IDENTITY, set to the old one's position
+        seq := pg_get_serial_sequence(old_table, 'id');
+        SELECT attidentity INTO identity
+        FROM pg_attribute
+        WHERE attrelid = old_table::regclass AND attname = 'id';
+        IF identity IN ('a', 'd') THEN
+            EXECUTE format('SELECT setval(%L, last_value, is_called) FROM %s',
+                           pg_get_serial_sequence(ledger, 'id'), seq);
+        ELSIF seq IS NOT NULL THEN
+            EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.id', seq, ledger);
+        END IF;
+
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', ledger || '_default', ledger);
+        FOR day IN EXECUTE format('SELECT DISTINCT game_day FROM %I', old_table) LOOP
+            PERFORM create_ledger_partition(ledger, day);
+        END LOOP;
+
+        -- no triggers on the new table yet, so the balances (already right) aren't touched
+        EXECUTE format('INSERT INTO %I OVERRIDING SYSTEM VALUE SELECT * FROM %I', ledger, old_table);
+
+        -- e.g. potion_ledger.potion_id -> potion_inventory, checked once against the copied rows
+        FOR fk IN SELECT conname, pg_get_constraintdef(oid) AS definition
+                  FROM pg_constraint
+                  WHERE conrelid = old_table::regclass AND contype = 'f' LOOP
+            EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I %s', ledger, fk.conname, fk.definition);
+        END LOOP;
+
+        EXECUTE format('DROP TABLE %I', old_table);
+
+        -- after the drop so the _pkey name is free again
+        EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (id, game_day)', ledger);
+    END LOOP;
+END $$;
+
+SELECT create_ledger_partition(ledger, (SELECT day FROM curr_time) + ahead)
+FROM unnest(ARRAY['gold_ledger', 'ml_ledger', 'potion_ledger']) AS ledger,
+     generate_series(0, 3) AS ahead;
+
+
+CREATE INDEX IF NOT EXISTS gold_ledger_cart_id_idx
+    ON gold_ledger (cart_id) WHERE cart_id IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS potion_ledger_cart_id_idx
+    ON potion_ledger (cart_id) WHERE cart_id IS NOT NULL;
+
+
+CREATE OR REPLACE FUNCTION gold_balance_apply() RETURNS trigger AS $$
+DECLARE
+    delta bigint := 0;
+BEGIN
+    IF current_setting('potion_shop.compacting', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        delta := delta + COALESCE(NEW.transactions, 0);
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        delta := delta - COALESCE(OLD.transactions, 0);
+    END IF;
+
+    UPDATE gold_balance SET gold = gold + delta WHERE id = 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ml_balance_apply() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('potion_shop.compacting', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE ml_balance
+        SET red = red + COALESCE(NEW.red, 0),
+            green = green + COALESCE(NEW.green, 0),
+            blue = blue + COALESCE(NEW.blue, 0),
+            dark = dark + COALESCE(NEW.dark, 0)
+        WHERE id = 1;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE ml_balance
+        SET red = red - COALESCE(OLD.red, 0),
+            green = green - COALESCE(OLD.green, 0),
+            blue = blue - COALESCE(OLD.blue, 0),
+            dark = dark - COALESCE(OLD.dark, 0)
+        WHERE id = 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION potion_balance_apply() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('potion_shop.compacting', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.potion_id IS NOT NULL THEN
+        INSERT INTO potion_balance (potion_id, quantity)
+        VALUES (NEW.potion_id, COALESCE(NEW.transaction, 0))
+        ON CONFLICT (potion_id) DO UPDATE
+            SET quantity = potion_balance.quantity + EXCLUDED.quantity;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.potion_id IS NOT NULL THEN
+        UPDATE potion_balance
+        SET quantity = quantity - COALESCE(OLD.transaction, 0)
+        WHERE potion_id = OLD.potion_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER gold_ledger_balance
+    AFTER INSERT OR UPDATE OR DELETE ON gold_ledger
+    FOR EACH ROW EXECUTE FUNCTION gold_balance_apply();
+
+CREATE TRIGGER ml_ledger_balance
+    AFTER INSERT OR UPDATE OR DELETE ON ml_ledger
+    FOR EACH ROW EXECUTE FUNCTION ml_balance_apply();
+
+CREATE TRIGGER potion_ledger_balance
+    AFTER INSERT OR UPDATE OR DELETE ON potion_ledger
+    FOR EACH ROW EXECUTE FUNCTION potion_balance_apply();
+
+COMMIT;
@@ -0,0 +1,5 @@
+-- Bottle deliveries come in keyed by potion_type, so that has to identify one potion.
+-- Also makes any potion_type = ... lookup an index probe instead of a scan + array compare.
+-- Fails if two potions already share a potion_type; merge those first.
+CREATE UNIQUE INDEX IF NOT EXISTS potion_inventory_potion_type_key
+    ON potion_inventory (potion_type);
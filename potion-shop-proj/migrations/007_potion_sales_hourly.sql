@@ -0,0 +1,29 @@
+-- Hourly sales rollup, one row per (game_day, game_hr, potion_id). Checkout bumps it in
+-- the same statement that writes the ledgers, so the planners can read trailing demand
+-- with one primary key range scan instead of going through line_items.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS potion_sales_hourly (
+    game_day    int NOT NULL,
+    game_hr     int NOT NULL,
+    potion_id   int NOT NULL REFERENCES potion_inventory (id),
+    quantity    int NOT NULL DEFAULT 0,
+    gold        int NOT NULL DEFAULT 0,
+    PRIMARY KEY (game_day, game_hr, potion_id)
+);
+
+-- backfill from the checkout rows still in potion_ledger (anything compacted into
+-- opening balances is gone). Gold uses today's price, close enough for demand.
+INSERT INTO potion_sales_hourly (game_day, game_hr, potion_id, quantity, gold)
+SELECT potion_ledger.game_day, potion_ledger.game_hr, potion_ledger.potion_id,
+       SUM(-1*potion_ledger.transaction), SUM(-1*potion_ledger.transaction * potion_inventory.price)
+FROM potion_ledger
+JOIN potion_inventory ON potion_inventory.id = potion_ledger.potion_id
+WHERE potion_ledger.reason = 'cart checkout'
+    AND potion_ledger.game_day IS NOT NULL
+    AND potion_ledger.game_hr IS NOT NULL
+GROUP BY potion_ledger.game_day, potion_ledger.game_hr, potion_ledger.potion_id
+ON CONFLICT (game_day, game_hr, potion_id) DO NOTHING;
+
+COMMIT;
@@ -0,0 +1,18 @@
+-- Tell every worker when the game clock moves (game_clock.py listens on potion_shop_tick),
+-- so cached ticks are replaced right away instead of when their refresh interval runs out.
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION curr_time_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('potion_shop_tick', NEW.day || ',' || NEW.hour);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS curr_time_tick ON curr_time;
+CREATE TRIGGER curr_time_tick
+    AFTER INSERT OR UPDATE ON curr_time
+    FOR EACH ROW EXECUTE FUNCTION curr_time_notify();
+
+COMMIT;
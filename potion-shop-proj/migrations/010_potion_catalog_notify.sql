@@ -0,0 +1,19 @@
+-- Tell every worker when potions are added, removed or repriced (potion_catalog.py listens
+-- on potion_shop_catalog), so a new sku sells and a new price applies right away instead of
+-- after the catalog's max age. Once per statement, the workers reload the whole catalog anyway.
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION potion_catalog_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('potion_shop_catalog', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS potion_catalog_changed ON potion_inventory;
+CREATE TRIGGER potion_catalog_changed
+    AFTER INSERT OR DELETE OR TRUNCATE OR UPDATE OF sku, price, potion_type ON potion_inventory
+    FOR EACH STATEMENT EXECUTE FUNCTION potion_catalog_notify();
+
+COMMIT;
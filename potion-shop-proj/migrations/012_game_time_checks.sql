@@ -0,0 +1,30 @@
+-- The sales rollup window (sales.window_start) turns (day, hour) into an absolute hour,
+-- day * 24 + hour, and the ledger partitions (migrations/005) range over game_day. Both only
+-- work if days are integers that count up and hours stay in 0..23, so check that here and
+-- fail loudly instead of computing a wrong window.
+
+BEGIN;
+
+DO $$
+DECLARE
+    bad text;
+BEGIN
+    SELECT string_agg(table_name || '.' || column_name || ' is ' || data_type, ', ')
+    INTO bad
+    FROM information_schema.columns
+    WHERE table_schema = current_schema()
+        AND (table_name, column_name) IN (('curr_time', 'day'), ('curr_time', 'hour'),
+                                          ('carts', 'game_day'), ('carts', 'game_hr'),
+                                          ('potion_sales_hourly', 'game_day'), ('potion_sales_hourly', 'game_hr'))
+        AND data_type NOT IN ('smallint', 'integer', 'bigint');
+
+    IF bad IS NOT NULL THEN
+        RAISE EXCEPTION 'game time columns must be integers (day counting up, hour 0..23): %', bad;
+    END IF;
+END;
+$$;
+
+ALTER TABLE curr_time DROP CONSTRAINT IF EXISTS curr_time_hour_check;
+ALTER TABLE curr_time ADD CONSTRAINT curr_time_hour_check CHECK (hour BETWEEN 0 AND 23 AND day >= 0);
+
+COMMIT;
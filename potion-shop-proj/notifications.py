@@ -0,0 +1,87 @@
+from src import database as db
+
+import logging
+import os
+import select
+import threading
+import time
+
+"""
+Postgres LISTEN/NOTIFY for the in-process caches. One background thread per
+process holds its own connection (not one from the request pool), listens on
+every subscribed channel and runs the callbacks as notifications arrive:
+
+    notifications.subscribe("potion_shop_tick", on_tick, on_reconnect=clock.invalidate)
+
+The NOTIFYs come from triggers (migrations/009), so it doesn't matter which
+process or script made the change. Notifications sent while the listener was
+disconnected are lost, so on_reconnect should drop whatever the cache holds.
+
+POTION_SHOP_LISTEN=0 turns the listener off; caches then rely on their refresh intervals.
+"""
+
+logger = logging.getLogger(__name__)
+
+RETRY_SECONDS = 5.0
+
+enabled = os.environ.get("POTION_SHOP_LISTEN", "1") != "0"
+subscribers = {}
+reconnect_hooks = []
+listener = None
+listener_lock = threading.Lock()
+
+
+def subscribe(channel: str, callback, on_reconnect=None):
+    """
+    callback(payload) for every NOTIFY on channel. Starts the listener on first use.
+    """
+    global listener
+    with listener_lock:
+        subscribers.setdefault(channel, []).append(callback)
+        if on_reconnect is not None:
+            reconnect_hooks.append(on_reconnect)
+        if enabled and listener is None:
+            listener = threading.Thread(target=listen, args=(db.engine,), name="pg-notify-listener", daemon=True)
+            listener.start()
+
+
+def listen(engine):
+    while True:
+        raw = None
+        try:
+            raw = engine.raw_connection()
+            raw.detach()
+            connection = raw.dbapi_connection
+            connection.autocommit = True
+            with listener_lock:
+                channels = list(subscribers)
+            with connection.cursor() as cursor:
+                for channel in channels:
+                    cursor.execute(f"LISTEN {channel}")
+            for hook in list(reconnect_hooks):
+                hook()
+
+            while True:
+                with listener_lock:
+                    new_channels = [channel for channel in subscribers if channel not in channels]
+                if new_channels:
+                    # subscribed after we connected (modules import in any order)
+                    with connection.cursor() as cursor:
+                        for channel in new_channels:
+                            cursor.execute(f"LISTEN {channel}")
+                    channels += new_channels
+                if not select.select([connection], [], [], 1.0)[0]:
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    for callback in subscribers.get(notify.channel, []):
+                        try:
+                            callback(notify.payload)
+                        except Exception as e:
+                            logger.error("Notification handler for %s failed: %s", notify.channel, e)
+        except Exception as e:
+            logger.warning("Notification listener lost its connection, caches fall back to refreshes: %s", e)
+            if raw is not None:
+                raw.close()
+            time.sleep(RETRY_SECONDS)
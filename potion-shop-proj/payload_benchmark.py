@@ -0,0 +1,132 @@
+from src.api import planning
+from src.api.barrels import Barrel, barrel_list
+from src.api.carts import Customer, customer_list
+
+import argparse
+import json
+import random
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+Payload benchmark for the big JSON bodies, no database or server needed:
+    POST /barrels/plan with a huge wholesale catalog, POST /carts/visits with a huge customer list.
+
+Compares the old path (json.loads into dicts, then a model per item) with one
+TypeAdapter.validate_json over the raw bytes (what fast_json.json_body does),
+times both barrel planners on the parsed catalog and on a 400 SKU catalog of mixed
+barrel sizes (the knapsack's slow case), and json vs orjson for the response.
+
+    python -m src.api.payload_benchmark
+    python -m src.api.payload_benchmark --items 10000 50000 --repeat 5
+"""
+
+POTION_TYPES = [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]
+CLASSES = ["Druid", "Wizard", "Rogue", "Fighter", "Bard", "Cleric"]
+GOAL_ML = {"med_goal": 20000, "lg_goal": 60000, "low_ml_limit": 500}
+
+
+def catalog_payload(items: int, rng: random.Random):
+    return json.dumps([
+        {
+            "sku": f"BARREL_{i}",
+            "ml_per_barrel": rng.choice([500, 2500, 10000]),
+            "potion_type": rng.choice(POTION_TYPES),
+            "price": rng.randint(50, 1500),
+            "quantity": rng.randint(1, 20),
+        }
+        for i in range(items)
+    ]).encode()
+
+
+def mixed_catalog(items: int, rng: random.Random):
+    """
+    Barrels of any size from 100 to 10000 ml, so the sizes have no useful gcd.
+    """
+    return [
+        Barrel(sku=f"MIXED_{i}", ml_per_barrel=rng.randint(100, 10000), potion_type=rng.choice(POTION_TYPES),
+               price=rng.randint(40, 1500), quantity=rng.randint(1, 20))
+        for i in range(items)
+    ]
+
+
+def visits_payload(items: int, rng: random.Random):
+    return json.dumps([
+        {"customer_name": f"customer {i}", "character_class": rng.choice(CLASSES), "level": rng.randint(1, 40)}
+        for i in range(items)
+    ]).encode()
+
+
+def best_of(repeat: int, fn, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def per_item(model):
+    return lambda body: [model(**item) for item in json.loads(body)]
+
+
+def report(name: str, seconds: float, baseline: float = None):
+    line = f"  {name:<36} {seconds * 1000:9.2f} ms"
+    if baseline:
+        line += f"  ({baseline / seconds:.1f}x)"
+    print(line)
+
+
+def run(items: int, repeat: int, rng: random.Random):
+    print(f"{items} items")
+
+    for name, body, model, adapter in [
+        ("barrels", catalog_payload(items, rng), Barrel, barrel_list),
+        ("visits", visits_payload(items, rng), Customer, customer_list),
+    ]:
+        slow, _ = best_of(repeat, per_item(model), body)
+        fast, parsed = best_of(repeat, adapter.validate_json, body)
+        report(f"{name}: json.loads + model per item", slow)
+        report(f"{name}: TypeAdapter.validate_json", fast, slow)
+        if name == "barrels":
+            catalog = parsed
+
+    inventory_ml = {color: 1000 for color in planning.COLORS}
+    greedy, _ = best_of(repeat, planning.plan_greedy_barrels, catalog, 20000, inventory_ml, 100000, GOAL_ML)
+    optimal, _ = best_of(repeat, planning.solve_barrel_purchase, catalog, 20000, inventory_ml, 100000)
+    report("plan: greedy", greedy)
+    report("plan: optimal", optimal)
+    mixed, _ = best_of(repeat, planning.solve_barrel_purchase, mixed_catalog(400, rng), 20000, inventory_ml, 100000)
+    report("plan: optimal, 400 mixed sizes", mixed)
+
+    # the plan response is small, so serialise the parsed catalog to see the encoder on a big body
+    rows = barrel_list.dump_python(catalog)
+    slow, _ = best_of(repeat, lambda: json.dumps(rows).encode())
+    report("response: json.dumps", slow)
+    if orjson is not None:
+        fast, _ = best_of(repeat, orjson.dumps, rows)
+        report("response: orjson.dumps", fast, slow)
+    else:
+        print("  (orjson not installed, FastJSONResponse falls back to JSONResponse)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse/validate/plan/serialise benchmark for large payloads")
+    parser.add_argument("--items", type=int, nargs="+", default=[10_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--random-seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.random_seed)
+    for items in args.items:
+        run(items, args.repeat, rng)
+
+
+if __name__ == "__main__":
+    main()
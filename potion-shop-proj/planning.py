@@ -0,0 +1,520 @@
+from math import gcd, isqrt
+from functools import reduce
+
+import logging
+
+"""
+Planning math for the barrel and bottle planners, kept free of FastAPI/SQL so
+it can be called (and checked) on its own.
+"""
+
+logger = logging.getLogger(__name__)
+
+COLORS = ["red", "green", "blue", "dark"]
+
+# gold/capacity cut-offs the greedy barrel plan uses to pick a size tier
+GREEDY_THRESHOLDS = {
+    "large_gold": 2500,
+    "large_capacity": 40000,
+    "medium_gold": 800,
+    "medium_room": 5000,
+    "small_gold": 100,
+    "small_capacity": 10000,
+}
+
+# cap on the ml resolution of the barrel knapsack, keeps the per-colour tables small
+# no matter how big the catalog or the free capacity is
+MAX_ML_UNITS = 1000
+
+# the colour combine costs (states so far x options) per colour, quadratic in the resolution, so the
+# resolution is also coarsened until that stays under this many pairs (~0.3 us each in CPython)
+COMBINE_BUDGET = 150_000
+
+INF = float("inf")
+
+
+def barrel_color(potion_type):
+    """
+    Index of the colour a barrel holds, or None for anything that isn't a pure barrel.
+    """
+    if sum(potion_type) != 1 or max(potion_type) != 1:
+        return None
+    return potion_type.index(1)
+
+
+def color_targets(inventory_ml: dict, free_ml: int, colors: list):
+    """
+    How much ml of each colour to aim for: water-fill the free capacity so the
+    lowest colours get topped up first and everyone ends as level as possible.
+    """
+    targets = {color: 0 for color in COLORS}
+    if free_ml <= 0 or not colors:
+        return targets
+
+    levels = sorted((inventory_ml[color], color) for color in colors)
+    remaining = free_ml
+    filled = []
+    water_line = levels[0][0]
+
+    for i, (level, color) in enumerate(levels):
+        filled.append(color)
+        next_level = levels[i + 1][0] if i + 1 < len(levels) else INF
+        room = (next_level - water_line) * len(filled)
+        if room >= remaining:
+            water_line += remaining / len(filled)
+            break
+        remaining -= room
+        water_line = next_level
+
+    for color in filled:
+        targets[color] = max(0, int(water_line - inventory_ml[color]))
+
+    return targets
+
+
+def split_quantity(quantity: int):
+    """
+    Binary split so a bounded item becomes log(quantity) 0/1 items: 13 -> 1, 2, 4, 6.
+    """
+    parts = []
+    size = 1
+    while quantity > 0:
+        take = min(size, quantity)
+        parts.append(take)
+        quantity -= take
+        size *= 2
+    return parts
+
+
+def min_gold_by_ml(barrels: list, weights: list, cap_units: int):
+    """
+    Bounded knapsack for one colour: cheapest gold to get exactly m ml-units, for every m up to cap.
+    Returns (min_cost, pieces, took) so a chosen m can be traced back to barrel counts.
+    """
+    min_cost = [INF] * (cap_units + 1)
+    min_cost[0] = 0
+    pieces = []
+    took = []
+
+    for barrel, weight in zip(barrels, weights):
+        max_count = min(barrel.quantity, cap_units // weight)
+        for count in split_quantity(max_count):
+            piece_weight = count * weight
+            piece_cost = count * barrel.price
+            updated = bytearray(cap_units + 1)
+            for m in range(cap_units, piece_weight - 1, -1):
+                cost = min_cost[m - piece_weight] + piece_cost
+                if cost < min_cost[m]:
+                    min_cost[m] = cost
+                    updated[m] = 1
+            pieces.append((barrel, count, piece_weight))
+            took.append(updated)
+
+    return min_cost, pieces, took
+
+
+def cheapest_by_weight(barrels: list, weights: list, cap_units: int):
+    """
+    Drops barrels the knapsack can never want: with the same weight, a plan only takes the cheapest
+    ones, and never more than cap_units // weight of them. Big catalogs shrink to a few barrels per size.
+    """
+    by_weight = {}
+    for barrel, weight in zip(barrels, weights):
+        by_weight.setdefault(weight, []).append(barrel)
+
+    kept_barrels, kept_weights = [], []
+    for weight, same_weight in by_weight.items():
+        needed = cap_units // weight
+        for barrel in sorted(same_weight, key=lambda barrel: barrel.price):
+            if needed <= 0:
+                break
+            kept_barrels.append(barrel)
+            kept_weights.append(weight)
+            needed -= barrel.quantity
+    return kept_barrels, kept_weights
+
+
+def trace_pieces(m: int, pieces: list, took: list):
+    counts = {}
+    for (barrel, count, piece_weight), updated in zip(reversed(pieces), reversed(took)):
+        if m > 0 and updated[m]:
+            counts[barrel.sku] = counts.get(barrel.sku, 0) + count
+            m -= piece_weight
+    return counts
+
+
+def ml_after_demand(inventory_ml: dict, color_demand: dict = None):
+    """
+    ml per colour minus what recent demand would use up (can go negative), for prioritising colours.
+    """
+    if not color_demand:
+        return inventory_ml
+    return {color: inventory_ml[color] - color_demand.get(color, 0) for color in COLORS}
+
+
+def barrels_by_color(wholesale_catalog: list, avail_gold: int):
+    """
+    Pure barrels we could buy at least one of, per colour.
+    """
+    by_color = {color: [] for color in COLORS}
+    for barrel in wholesale_catalog:
+        color = barrel_color(barrel.potion_type)
+        if color is None or barrel.quantity <= 0 or barrel.price > avail_gold or barrel.ml_per_barrel <= 0:
+            continue
+        by_color[COLORS[color]].append(barrel)
+    return by_color
+
+
+def color_limits(by_color: dict, targets: dict, free_ml: int):
+    """
+    Most ml of each colour a plan may buy: its target plus one barrel (the biggest that fits),
+    so a colour can take a large barrel without the targets having to be a multiple of it.
+    """
+    limits = {}
+    for color, barrels in by_color.items():
+        sizes = [barrel.ml_per_barrel for barrel in barrels if barrel.ml_per_barrel <= free_ml]
+        limits[color] = min(free_ml, targets[color] + max(sizes, default=0))
+    return limits
+
+
+def combine_work(offered: list, limits: dict, free_ml: int, unit: int):
+    """
+    How many (state, option) pairs combining the colours looks at with this ml unit, at most.
+    """
+    cap_units = free_ml // unit
+    work = 0
+    states = 1
+    for color in offered:
+        options = limits[color] // unit + 1
+        work += states * options
+        states = min(cap_units + 1, states + options - 1)
+    return work
+
+
+def solve_barrel_purchase(wholesale_catalog: list, avail_gold: int, inventory_ml: dict, free_ml: int,
+                          color_demand: dict = None):
+    """
+    Buys the most ml the gold allows, as a bounded knapsack over the whole catalog: gold budget,
+    free ml capacity, per-colour limits and catalog quantities. Ties on ml go to the cheaper plan,
+    then to the plan that goes least past the per-colour targets.
+
+    The targets water-fill the free capacity from current ml. A colour may go up to one barrel past
+    its target (color_limits), so one large barrel can beat several mediums, but the free capacity
+    doesn't all go to whichever colour is cheapest.
+
+    color_demand: optional recent ml sold per colour (sales.trailing_demand); the water-fill then
+    levels ml left after that demand, so colours that sell get topped up first.
+
+    Exact at the gcd of the barrel sizes when that fits MAX_ML_UNITS and COMBINE_BUDGET, otherwise
+    the ml resolution is coarsened to fit (a percent or two less ml on mixed sizes). Worst case
+    measured ~37 ms on one core, for catalogs of 100-5000 SKUs with random sizes (100-10000 ml),
+    up to 1000 of each and 30k-1M ml free; payload_benchmark has a 400 SKU mixed-size case.
+
+    Barrels are anything with sku, ml_per_barrel, potion_type, price and quantity.
+    Returns the plan as [{sku, ml_per_barrel, potion_type, price, quantity}], same shape as the greedy plan.
+    """
+    by_color = barrels_by_color(wholesale_catalog, avail_gold)
+    offered = [color for color in COLORS if by_color[color]]
+    if free_ml <= 0 or not offered:
+        return []
+    targets = color_targets(ml_after_demand(inventory_ml, color_demand), free_ml, offered)
+    limits = color_limits(by_color, targets, free_ml)
+
+    # ml resolution: gcd of the barrel sizes, coarsened if that would make the tables or the colour
+    # combine too big. coarse weights round up, so a coarse plan never goes over capacity
+    sizes = [barrel.ml_per_barrel for color in offered for barrel in by_color[color]]
+    unit = reduce(gcd, sizes)
+    if free_ml // unit > MAX_ML_UNITS:
+        unit = -(-free_ml // MAX_ML_UNITS)
+    while (work := combine_work(offered, limits, free_ml, unit)) > COMBINE_BUDGET:
+        # work is about quadratic in 1 / unit
+        unit = max(unit + 1, unit * isqrt(-(-work * 10000 // COMBINE_BUDGET)) // 100)
+    cap_units = free_ml // unit
+    if cap_units <= 0:
+        return []
+
+    # per colour: cheapest gold for each reachable ml amount, and how far past the target that goes
+    color_tables = {}
+    for color in offered:
+        color_cap = limits[color] // unit
+        barrels = by_color[color]
+        weights = [-(-barrel.ml_per_barrel // unit) for barrel in barrels]
+        barrels, weights = cheapest_by_weight(barrels, weights, color_cap)
+        min_cost, pieces, took = min_gold_by_ml(barrels, weights, color_cap)
+        options = [(m, min_cost[m], max(0, m * unit - targets[color]))
+                   for m in range(color_cap + 1) if min_cost[m] <= avail_gold]
+        color_tables[color] = (options, pieces, took)
+
+    # combine colours: best (gold, ml past targets) for M units overall, remembering each colour's
+    # share. Both add up across colours, so keeping the best pair per M is exact
+    total = [(0, 0, 0)]
+    shares = []
+    for color, (options, pieces, took) in color_tables.items():
+        best_gold = [INF] * (cap_units + 1)
+        best_over = [INF] * (cap_units + 1)
+        share = {}
+        for units_so_far, gold_so_far, over_so_far in total:
+            room = cap_units - units_so_far
+            gold_left = avail_gold - gold_so_far
+            for m, cost, over in options:
+                if m > room:
+                    break
+                if cost > gold_left:
+                    continue
+                key = units_so_far + m
+                gold = gold_so_far + cost
+                if gold < best_gold[key] or (gold == best_gold[key] and over_so_far + over < best_over[key]):
+                    best_gold[key] = gold
+                    best_over[key] = over_so_far + over
+                    share[key] = (units_so_far, m)
+        total = [(key, best_gold[key], best_over[key]) for key in range(cap_units + 1) if best_gold[key] < INF]
+        shares.append((color, share))
+
+    best_units, best_gold, best_over = max(total, key=lambda state: (state[0], -state[1], -state[2]))
+    if best_units == 0:
+        return []
+
+    # walk back through the colours to get each one's ml, then each colour's barrel counts
+    quantities = {}
+    units = best_units
+    for color, share in reversed(shares):
+        units, m = share[units]
+        options, pieces, took = color_tables[color]
+        quantities.update(trace_pieces(m, pieces, took))
+
+    plan = []
+    for barrel in wholesale_catalog:
+        quantity = quantities.get(barrel.sku, 0)
+        if quantity:
+            plan.append({
+                "sku": barrel.sku,
+                "ml_per_barrel": barrel.ml_per_barrel,
+                "potion_type": barrel.potion_type,
+                "price": barrel.price,
+                "quantity": quantity,
+            })
+    return plan
+
+
+def plan_greedy_barrels(wholesale_catalog: list, avail_gold: int, inventory_ml: dict, curr_capacity: int,
+                        goal_ml: dict, thresholds: dict = GREEDY_THRESHOLDS, color_demand: dict = None):
+    """
+    The original greedy plan: pick one size tier from gold + capacity, then round-robin
+    one barrel at a time over it, lowest ml colour first, until gold, room or catalog runs out.
+
+    goal_ml: {med_goal, lg_goal, low_ml_limit}, the goal_ml table row.
+    color_demand: optional recent ml sold per colour; colours go in order of ml left after it.
+    Returns the plan as [{sku, ml_per_barrel, potion_type, price, quantity}].
+    """
+    # the catalog entries are only read; per barrel state lives in plain lists below
+    sm_barrels = []
+    med_barrels = []
+    lg_barrels = []
+
+    tier = []
+
+    for barrel in wholesale_catalog:
+        match barrel.ml_per_barrel:
+            case 500: #small barrels
+                sm_barrels.append(barrel)
+            case 2500: #medium barrels
+                med_barrels.append(barrel)
+            case 10000: #large barrels
+                lg_barrels.append(barrel)
+                if barrel.potion_type == [0,0,0,1]:
+                    med_barrels.append(barrel)
+
+    # current capacity level minus ml already have
+    curr_ml = sum(inventory_ml.values())
+    avail_ml = curr_capacity - curr_ml
+
+    logger.debug("Current capacity for ml is: %s", curr_capacity)
+    logger.debug("Ml in inventory: %s", curr_ml)
+    logger.debug("Avail. for ml: %s", avail_ml)
+
+    desp_level = goal_ml['low_ml_limit'] # set by table in db
+    med_planned = goal_ml['med_goal']
+    lg_planned = goal_ml['lg_goal'] if goal_ml['lg_goal'] <= avail_ml else avail_ml
+
+    low_ml = False
+    if inventory_ml['red'] <= desp_level or inventory_ml['green'] <= desp_level or inventory_ml['blue'] <= desp_level:
+        low_ml = True
+
+    if avail_gold >= thresholds['large_gold'] and lg_barrels \
+        and curr_capacity >= thresholds['large_capacity']:
+
+        tier = lg_barrels
+        logger.debug("Room we actually have: %s ml", avail_ml)
+        logger.debug("Goal ml for large that we're doing: %s ml", goal_ml['lg_goal'])
+        avail_ml = lg_planned
+
+    elif avail_gold >= thresholds['medium_gold'] and med_barrels \
+        and avail_ml >= thresholds['medium_room'] and low_ml: #only get med if desperately low & and no large barrel
+
+        tier = med_barrels
+        logger.debug("We're desperate, going with db medium barrel goal plan: %s ml", goal_ml['med_goal'])
+        avail_ml = med_planned
+
+    elif avail_gold >= thresholds['small_gold'] \
+        and curr_capacity <= thresholds['small_capacity']: #only get small in beginning
+        tier = sm_barrels
+
+
+    #sort list so that least ml prioritized
+    priority_ml = ml_after_demand(inventory_ml, color_demand)
+
+    def priority(barrel):
+        color = barrel_color(barrel.potion_type)
+        return priority_ml[COLORS[color]] if color is not None else 0
+
+    tier = sorted(tier, key=priority)
+    prices = [barrel.price for barrel in tier]
+    sizes = [barrel.ml_per_barrel for barrel in tier]
+    in_catalog = [barrel.quantity for barrel in tier]
+    quantity = [0] * len(tier)
+    reached_max = [False] * len(tier)
+
+    gold_to_pay = 0
+    ml_to_add = 0
+    at_max = False
+    num_reached_max = 0
+    while not at_max and tier:
+        for i in range(len(tier)):
+            gold_check = gold_to_pay + prices[i]
+            ml_check = ml_to_add + sizes[i]
+            if num_reached_max >= len(tier):
+                at_max = True
+                logger.debug("Reached max quantity of barrels from catalog")
+                break
+            elif avail_gold >= gold_check and avail_ml >= ml_check:
+                if quantity[i] < in_catalog[i]:
+                    quantity[i] += 1
+                    gold_to_pay += prices[i]
+                    ml_to_add += sizes[i]
+                elif not reached_max[i]:
+                    reached_max[i] = True
+                    num_reached_max += 1
+            else:
+                if avail_gold < gold_check:
+                    logger.debug("Reached max gold for barrel plan")
+                if avail_ml < ml_check:
+                    logger.debug("Reached max ml for barrel plan")
+                at_max = True
+                break
+
+    buying_plan = [
+        {
+            "sku": barrel.sku,
+            "ml_per_barrel": barrel.ml_per_barrel,
+            "potion_type": barrel.potion_type,
+            "price": barrel.price,
+            "quantity": bought,
+        }
+        for barrel, bought in zip(tier, quantity) if bought != 0
+    ]
+
+    logger.debug("Gold that this plan will cost: %s", gold_to_pay)
+    logger.debug("Gold that I have: %s", avail_gold)
+    logger.debug("Total ml that this plan will add: %s", ml_to_add)
+    logger.debug("Total ml that there is room for: %s", avail_ml)
+
+    return buying_plan
+
+
+def barrel_delivery_totals(barrels_delivered: list):
+    """
+    What a barrel delivery does to the ledgers: ml added per colour and the (negative) gold paid.
+    """
+    quantity_plan = {color: 0 for color in COLORS}
+    gold_to_pay = 0
+
+    for barrel in barrels_delivered:
+        gold_to_pay -= (barrel.quantity * barrel.price)
+        color = barrel_color(barrel.potion_type)
+        if color is not None:
+            quantity_plan[COLORS[color]] += (barrel.quantity * barrel.ml_per_barrel)
+
+    return quantity_plan, gold_to_pay
+
+
+def bottles_possible(potion_type: list, avail_ml: list):
+    """
+    Closed form for how many bottles of one mix the ml covers: min over the used channels of avail // ratio.
+    """
+    return min((avail // ratio for ratio, avail in zip(potion_type, avail_ml) if ratio > 0), default=0)
+
+
+def allocate_bottles(mixes: list, avail_ml: list, objective: str = "goal_fill"):
+    """
+    Splits the ml across every mix at once.
+
+    mixes: dicts with potion_type, quantity (in stock), bottle_goal and price.
+    avail_ml: [red, green, blue, dark] ml on hand.
+    objective: "goal_fill" tops up the emptiest mixes first, "value" the priciest.
+
+    First pass hands each channel out in proportion to what the mixes want from it
+    (so nobody gets starved by list order), second pass tops mixes up in objective
+    order with whatever is left. Every step is O(channels) per mix.
+    Returns [(mix, bottles)] for mixes that get at least one bottle.
+    """
+    avail = list(avail_ml)
+    needs = [max(0, min(mix['bottle_goal'] - mix['quantity'], mix['bottle_goal'])) for mix in mixes]
+
+    demand = [0] * len(avail)
+    for mix, need in zip(mixes, needs):
+        for channel, ratio in enumerate(mix['potion_type']):
+            demand[channel] += ratio * need
+
+    share = [min(1.0, avail[channel] / demand[channel]) if demand[channel] else 1.0
+             for channel in range(len(avail))]
+
+    bottles = []
+    for mix, need in zip(mixes, needs):
+        used = [share[channel] for channel, ratio in enumerate(mix['potion_type']) if ratio > 0]
+        bottles.append(int(need * min(used)) if used and need else 0)
+
+    for mix, count in zip(mixes, bottles):
+        for channel, ratio in enumerate(mix['potion_type']):
+            avail[channel] -= ratio * count
+
+    if objective == "value":
+        order = sorted(range(len(mixes)), key=lambda i: -mixes[i]['price'])
+    else:
+        order = sorted(range(len(mixes)),
+                       key=lambda i: (mixes[i]['quantity'] + bottles[i]) / mixes[i]['bottle_goal']
+                       if mixes[i]['bottle_goal'] else 1.0)
+
+    for i in order:
+        extra = min(needs[i] - bottles[i], bottles_possible(mixes[i]['potion_type'], avail))
+        if extra > 0:
+            bottles[i] += extra
+            for channel, ratio in enumerate(mixes[i]['potion_type']):
+                avail[channel] -= ratio * extra
+
+    return [(mix, count) for mix, count in zip(mixes, bottles) if count > 0]
+
+
+def plan_bottles(mixes: list, avail_ml: list, objective: str = "goal_fill"):
+    """
+    The bottle plan from the mixes and ml on hand: [{potion_type, quantity}], nothing under 100ml total.
+    """
+    if sum(avail_ml) < 100:
+        return []
+    return [{'potion_type': mix['potion_type'], 'quantity': quantity}
+            for mix, quantity in allocate_bottles(mixes, avail_ml, objective)]
+
+
+def bottle_delivery_totals(potions_delivered: list):
+    """
+    What a bottle delivery does to the ledgers: ml taken per colour (negative) and
+    one {potion_type, transaction} row per delivered mix.
+    """
+    ml_to_subtract = {color: 0 for color in COLORS}
+    potion_rows = []
+
+    for potion in potions_delivered:
+        potion_rows.append({"potion_type": potion.potion_type, "transaction": potion.quantity})
+        for mix_color, sub_color in zip(potion.potion_type, COLORS):
+            ml_to_subtract[sub_color] -= (mix_color * potion.quantity)
+
+    return ml_to_subtract, potion_rows
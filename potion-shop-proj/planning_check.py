@@ -0,0 +1,130 @@
+from src.api import planning
+from src.api.simulator import WholesaleBarrel, WHOLESALE_CATALOG
+
+import argparse
+import itertools
+import random
+import sys
+
+"""
+Checks planning.solve_barrel_purchase against a brute force over every barrel
+combination, on the game's catalog and on small random ones:
+
+    python -m src.api.planning_check --cases 300
+
+A plan is wrong if it breaks the gold, capacity, quantity or per-colour limits
+(planning.color_limits), or if some combination within them gets more ml, or the
+same ml for less gold. Random cases keep free
+ml small enough for planning.MAX_ML_UNITS and planning.COMBINE_BUDGET at the
+gcd of the barrel sizes, so the solver works at exact ml resolution and has to
+match the brute force exactly.
+"""
+
+SIZES = [200, 500, 1000, 2500, 5000, 10000]
+
+# (catalog, avail_gold, inventory_ml, free_ml, ml, gold) the solver must hit exactly, for cases
+# too big to brute force
+KNOWN_CASES = [
+    # the water-fill targets used to cap each colour at 5000 ml, so no 10000 ml barrel fit and
+    # the plan was 8 mediums for 2100. A large red and a large green do it for 900
+    (WHOLESALE_CATALOG, 5000, {color: 0 for color in planning.COLORS}, 20000, 20000, 900),
+]
+
+
+def plan_totals(plan: list):
+    return (sum(barrel["ml_per_barrel"] * barrel["quantity"] for barrel in plan),
+            sum(barrel["price"] * barrel["quantity"] for barrel in plan))
+
+
+def brute_force_purchase(catalog: list, avail_gold: int, inventory_ml: dict, free_ml: int):
+    """
+    (ml, gold) of the best plan under the solver's rules: most ml, then least gold, within the
+    gold, free ml, catalog quantities and per-colour limits (planning.color_limits).
+    """
+    by_color = planning.barrels_by_color(catalog, avail_gold)
+    offered = [color for color in planning.COLORS if by_color[color]]
+    targets = planning.color_targets(inventory_ml, free_ml, offered)
+    limits = planning.color_limits(by_color, targets, free_ml)
+
+    barrels = [(color, barrel) for color in offered for barrel in by_color[color]]
+    counts = [range(min(barrel.quantity, free_ml // barrel.ml_per_barrel) + 1) for color, barrel in barrels]
+    best = (0, 0)
+    for quantities in itertools.product(*counts):
+        ml_by_color = {color: 0 for color in offered}
+        gold = 0
+        for (color, barrel), quantity in zip(barrels, quantities):
+            ml_by_color[color] += barrel.ml_per_barrel * quantity
+            gold += barrel.price * quantity
+        ml = sum(ml_by_color.values())
+        if ml > free_ml or gold > avail_gold or any(ml_by_color[color] > limits[color] for color in offered):
+            continue
+        if (ml, -gold) > (best[0], -best[1]):
+            best = (ml, gold)
+    return best
+
+
+def plan_errors(plan: list, catalog: list, avail_gold: int, free_ml: int):
+    errors = []
+    ml, gold = plan_totals(plan)
+    if gold > avail_gold:
+        errors.append(f"spends {gold} gold with {avail_gold}")
+    if ml > free_ml:
+        errors.append(f"buys {ml} ml with {free_ml} free")
+    offered = {barrel.sku: barrel.quantity for barrel in catalog}
+    for barrel in plan:
+        if barrel["quantity"] > offered.get(barrel["sku"], 0):
+            errors.append(f"buys {barrel['quantity']} {barrel['sku']}, {offered.get(barrel['sku'], 0)} offered")
+    return errors
+
+
+def random_case(rng: random.Random):
+    catalog = []
+    for i in range(rng.randint(3, 6)):
+        potion_type = [0, 0, 0, 0]
+        potion_type[rng.randrange(4)] = 1
+        catalog.append(WholesaleBarrel(f"BARREL_{i}", rng.choice(SIZES), potion_type,
+                                       rng.randint(40, 800), rng.randint(1, 3)))
+    inventory_ml = {color: rng.choice([0, 0, 500, 2000, 8000]) for color in planning.COLORS}
+    return catalog, rng.randint(100, 3000), inventory_ml, rng.randrange(0, 30001, 100)
+
+
+def check_case(catalog: list, avail_gold: int, inventory_ml: dict, free_ml: int, expected: tuple = None):
+    plan = planning.solve_barrel_purchase(catalog, avail_gold, inventory_ml, free_ml)
+    errors = plan_errors(plan, catalog, avail_gold, free_ml)
+    got = plan_totals(plan)
+    if expected is None:
+        expected = brute_force_purchase(catalog, avail_gold, inventory_ml, free_ml)
+    if got != expected:
+        errors.append(f"{got[0]} ml for {got[1]} gold, best is {expected[0]} ml for {expected[1]} gold")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the barrel knapsack against a brute force")
+    parser.add_argument("--cases", type=int, default=300, help="random catalogs to check")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    failures = 0
+    for catalog, avail_gold, inventory_ml, free_ml, ml, gold in KNOWN_CASES:
+        errors = check_case(catalog, avail_gold, inventory_ml, free_ml, (ml, gold))
+        if errors:
+            failures += 1
+            print(f"game catalog, {avail_gold} gold, {free_ml} ml free: {'; '.join(errors)}")
+
+    rng = random.Random(args.seed)
+    for case in range(args.cases):
+        catalog, avail_gold, inventory_ml, free_ml = random_case(rng)
+        errors = check_case(catalog, avail_gold, inventory_ml, free_ml)
+        if errors:
+            failures += 1
+            print(f"case {case} ({avail_gold} gold, {free_ml} ml free, {len(catalog)} barrels): {'; '.join(errors)}")
+
+    total = len(KNOWN_CASES) + args.cases
+    print(f"{total - failures}/{total} plans optimal")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
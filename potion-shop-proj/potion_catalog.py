@@ -0,0 +1,105 @@
+from src.api import notifications
+from src.api import statements
+
+import threading
+import time
+
+"""
+In-memory sku -> (potion_id, price) and potion_type -> potion_id maps over
+potion_inventory, so adding a line item or bottling doesn't need subqueries
+against potion_inventory.
+
+Adding, removing or repricing a potion NOTIFYs potion_shop_catalog (migrations/010)
+and every process drops its copy (notifications.py). An sku we don't know also
+triggers one reload, at most every MISS_RELOAD_SECONDS, before it's turned away.
+The max age is a backstop for when the listener is down.
+
+Like cache.LRUCache, rows read before an invalidation never replace the cleared
+copy: load() takes the generation read before the query and drops the rows if it
+has moved on since, and reload() then reads again.
+"""
+
+MISS_RELOAD_SECONDS = 1.0
+
+catalog_sql = statements.register("potion_catalog.catalog", "SELECT id, sku, price, potion_type FROM potion_inventory")
+
+
+class PotionCatalog:
+    def __init__(self, max_age_seconds: float):
+        self.max_age_seconds = max_age_seconds
+        self._by_sku = None
+        self._by_type = None
+        self._loaded_at = 0.0
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def loaded(self):
+        with self._lock:
+            return self._by_sku is not None and time.monotonic() - self._loaded_at <= self.max_age_seconds
+
+    def reload_on_miss(self):
+        """
+        True if a lookup miss should reload the catalog: it's older than
+        MISS_RELOAD_SECONDS, so a stream of bogus skus can't reload it on every request.
+        """
+        with self._lock:
+            return time.monotonic() - self._loaded_at > MISS_RELOAD_SECONDS
+
+    def load(self, rows, generation: int = None):
+        """
+        rows: anything with .id, .sku, .price, .potion_type (rows from catalog_sql)
+        generation: self.generation from before the query; if it was invalidated since, the rows
+        may predate the change and are dropped. Returns whether they were stored.
+        """
+        by_sku = {row.sku: (row.id, row.price) for row in rows}
+        by_type = {tuple(row.potion_type): row.id for row in rows}
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._by_sku = by_sku
+            self._by_type = by_type
+            self._loaded_at = time.monotonic()
+            return True
+
+    def reload(self, connection):
+        """
+        Reads the catalog again, and again if an invalidation lands while the query runs.
+        """
+        while True:
+            generation = self.generation
+            if self.load(connection.execute(catalog_sql).fetchall(), generation):
+                return
+
+    def ensure_loaded(self, connection):
+        if not self.loaded():
+            self.reload(connection)
+
+    def lookup(self, sku: str):
+        """
+        (potion_id, price) for the sku, or None if we don't sell it.
+        """
+        with self._lock:
+            if self._by_sku is None:
+                return None
+            return self._by_sku.get(sku)
+
+    def lookup_type(self, potion_type: list):
+        """
+        potion_id for a [r, g, b, d] mix, or None if no potion has it.
+        """
+        with self._lock:
+            if self._by_type is None:
+                return None
+            return self._by_type.get(tuple(potion_type))
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._by_sku = None
+            self._by_type = None
+
+
+catalog = PotionCatalog(max_age_seconds=60.0)
+
+notifications.subscribe("potion_shop_catalog", lambda payload: catalog.invalidate(),
+                        on_reconnect=catalog.invalidate)
@@ -0,0 +1,129 @@
+import sqlalchemy
+from src import database as db
+
+import sys
+
+"""
+Checks the running balance tables (gold_balance, ml_balance, potion_balance, summed
+over their stripes) against full sums of the raw ledgers. Run after deploys or if a plan looks off:
+
+    python -m src.api.reconcile          # report only
+    python -m src.api.reconcile --fix    # also overwrite balances with the ledger sums
+"""
+
+gold_check_sql = sqlalchemy.text("""
+                                SELECT (SELECT SUM(gold) FROM gold_balance) AS balance,
+                                       (SELECT COALESCE(SUM(transactions), 0) FROM gold_ledger) AS ledger
+                                """)
+
+ml_check_sql = sqlalchemy.text("""
+                                SELECT b.red, b.green, b.blue, b.dark,
+                                       l.red AS ledger_red, l.green AS ledger_green,
+                                       l.blue AS ledger_blue, l.dark AS ledger_dark
+                                FROM (SELECT SUM(red) AS red, SUM(green) AS green,
+                                             SUM(blue) AS blue, SUM(dark) AS dark
+                                      FROM ml_balance) b,
+                                     (SELECT COALESCE(SUM(red), 0) AS red, COALESCE(SUM(green), 0) AS green,
+                                             COALESCE(SUM(blue), 0) AS blue, COALESCE(SUM(dark), 0) AS dark
+                                      FROM ml_ledger) l
+                                """)
+
+potion_check_sql = sqlalchemy.text("""
+                                    WITH ledger AS (
+                                        SELECT potion_id, SUM(transaction) AS quantity
+                                        FROM potion_ledger
+                                        WHERE potion_id IS NOT NULL
+                                        GROUP BY potion_id
+                                    )
+                                    SELECT COALESCE(b.potion_id, ledger.potion_id) AS potion_id,
+                                           COALESCE(b.quantity, 0) AS balance,
+                                           COALESCE(ledger.quantity, 0) AS ledger
+                                    FROM (SELECT potion_id, SUM(quantity) AS quantity
+                                          FROM potion_balance
+                                          GROUP BY potion_id) b
+                                    FULL JOIN ledger ON ledger.potion_id = b.potion_id
+                                    WHERE COALESCE(b.quantity, 0) <> COALESCE(ledger.quantity, 0)
+                                    """)
+
+fix_gold_sql = sqlalchemy.text("""
+                                UPDATE gold_balance
+                                SET gold = CASE WHEN id = 1
+                                                THEN (SELECT COALESCE(SUM(transactions), 0) FROM gold_ledger)
+                                                ELSE 0
+                                           END
+                                """)
+
+fix_ml_sql = sqlalchemy.text("""
+                                UPDATE ml_balance
+                                SET red = CASE WHEN ml_balance.id = 1 THEN ledger.red ELSE 0 END,
+                                    green = CASE WHEN ml_balance.id = 1 THEN ledger.green ELSE 0 END,
+                                    blue = CASE WHEN ml_balance.id = 1 THEN ledger.blue ELSE 0 END,
+                                    dark = CASE WHEN ml_balance.id = 1 THEN ledger.dark ELSE 0 END
+                                FROM (SELECT COALESCE(SUM(red), 0) AS red, COALESCE(SUM(green), 0) AS green,
+                                             COALESCE(SUM(blue), 0) AS blue, COALESCE(SUM(dark), 0) AS dark
+                                      FROM ml_ledger) ledger
+                                """)
+
+# the whole balance goes on stripe 1, the other stripes start again from 0
+clear_potion_stripes_sql = sqlalchemy.text("UPDATE potion_balance SET quantity = 0 WHERE stripe <> 1")
+
+fix_potion_sql = sqlalchemy.text("""
+                                INSERT INTO potion_balance (potion_id, stripe, quantity)
+                                SELECT potion_inventory.id, 1, COALESCE(SUM(potion_ledger.transaction), 0)
+                                FROM potion_inventory
+                                LEFT JOIN potion_ledger ON potion_ledger.potion_id = potion_inventory.id
+                                GROUP BY potion_inventory.id
+                                ON CONFLICT (potion_id, stripe) DO UPDATE SET quantity = EXCLUDED.quantity
+                                """)
+
+
+def reconcile_balances(fix: bool = False):
+    """
+    Returns a list of mismatches (empty if everything lines up).
+    Runs at REPEATABLE READ so the balances and the ledger sums come from the same snapshot.
+    """
+    mismatches = []
+
+    with db.engine.connect().execution_options(isolation_level="REPEATABLE READ") as connection:
+        with connection.begin():
+            gold = connection.execute(gold_check_sql).fetchone()
+            ml = connection.execute(ml_check_sql).fetchone()
+            potions = connection.execute(potion_check_sql).fetchall()
+
+            if gold.balance != gold.ledger:
+                mismatches.append({"ledger": "gold", "balance": gold.balance, "expected": gold.ledger})
+
+            for color in ["red", "green", "blue", "dark"]:
+                balance = getattr(ml, color)
+                expected = getattr(ml, f"ledger_{color}")
+                if balance != expected:
+                    mismatches.append({"ledger": f"ml_{color}", "balance": balance, "expected": expected})
+
+            for potion in potions:
+                mismatches.append({"ledger": f"potion_{potion.potion_id}",
+                                   "balance": potion.balance, "expected": potion.ledger})
+
+    if mismatches and fix:
+        # lock out ledger writers so the rebuilt balances can't miss a row
+        with db.engine.begin() as connection:
+            connection.execute(sqlalchemy.text("LOCK TABLE gold_ledger, ml_ledger, potion_ledger IN SHARE MODE"))
+            connection.execute(fix_gold_sql)
+            connection.execute(fix_ml_sql)
+            connection.execute(clear_potion_stripes_sql)
+            connection.execute(fix_potion_sql)
+
+    return mismatches
+
+
+if __name__ == "__main__":
+    fix = "--fix" in sys.argv[1:]
+    mismatches = reconcile_balances(fix=fix)
+
+    if not mismatches:
+        print("Balances match the ledgers")
+    else:
+        for mismatch in mismatches:
+            print(f"{mismatch['ledger']}: balance {mismatch['balance']} but ledger sums to {mismatch['expected']}")
+        if fix:
+            print("Balances rebuilt from the ledgers")
+        sys.exit(1)
@@ -0,0 +1,317 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote, urlsplit
+from urllib.request import Request, urlopen
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+"""
+Replays traffic captured by capture.py (POTION_SHOP_CAPTURE_PATH) against a
+LOCAL server, in the order it really came in within each tick (barrels, bottler,
+visits, carts, checkouts), and reports latency and response differences per endpoint.
+
+    python -m src.api.replay capture.ndjson --day 12                 # real time (1x)
+    python -m src.api.replay capture-*.ndjson --day 12 --speed 0     # as fast as possible
+    python -m src.api.replay capture.ndjson --speed 0 --set-clock    # also move curr_time each tick
+
+The server should be pointed at a copy of the database as it was when the
+captured day started (e.g. restored from a dump), otherwise responses differ
+just because the data does. Run it with POTION_SHOP_SERVER_TIMING=1 so the
+report can compare the captured handler time (cap) with the replayed handler
+time (srv); the round trip (rtt) also counts the client, network and queueing.
+
+Ordering: barrels, bottler and visit calls are barriers, everything before them
+finishes first and nothing after starts until they're done. Calls for one cart
+run in captured order. Carts created during the replay get new ids, later
+paths are remapped to them. Everything else runs with up to --concurrency in
+flight, paced by the captured timestamps divided by --speed (0 = no pacing).
+"""
+
+BARRIER_PREFIXES = ("/barrels", "/bottler", "/carts/visits")
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+def load_records(paths: list, day: int = None):
+    records = []
+    for path in paths:
+        with open(path) as capture_file:
+            for line in capture_file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if day is not None and (record["tick"] is None or record["tick"][0] != day):
+                    continue
+                records.append(record)
+    records.sort(key=lambda record: record["t"])
+    return records
+
+
+def check_local(url: str, force: bool):
+    host = urlsplit(url).hostname
+    if host not in LOCAL_HOSTS and not force:
+        sys.exit(f"Refusing to replay against non-local host {host!r} (use --force if you mean it)")
+
+
+def endpoint(record: dict):
+    return f"{record['method']} {record['route']}"
+
+
+def is_barrier(record: dict):
+    return record["route"].startswith(BARRIER_PREFIXES)
+
+
+def created_cart(record: dict):
+    """
+    Captured cart id if this call created a cart (POST /carts/ answers {"cart_id": ...}).
+    As a string, the same as it shows up in path_params.
+    """
+    response = record["response"]
+    if "cart_id" not in record["path_params"] and isinstance(response, dict) and "cart_id" in response:
+        return str(response["cart_id"])
+    return None
+
+
+def comparable(record: dict, response):
+    # a created cart's id depends on the sequence, only whether we got one matters
+    if created_cart(record) is not None and isinstance(response, dict):
+        return {**response, "cart_id": response.get("cart_id") is not None}
+    return response
+
+
+def server_timing_ms(headers):
+    """
+    dur of the "handler" metric in a Server-Timing header (capture.py), None if there isn't one.
+    """
+    for metric in (headers.get("Server-Timing") or "").split(","):
+        name, _, params = metric.strip().partition(";")
+        if name != "handler":
+            continue
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                return float(value)
+    return None
+
+
+def percentile(sorted_values: list, pct: float):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Replayer:
+    def __init__(self, base_url: str, headers: dict, timeout: float):
+        self.base_url = base_url.rstrip("/")
+        self.headers = headers
+        self.timeout = timeout
+        # captured cart id -> Future of the replayed id
+        self.cart_ids = {}
+        # captured cart id -> Future of the last call queued for that cart
+        self.last_for_cart = {}
+        self.results = []
+        self.lock = threading.Lock()
+
+    def send(self, method: str, path: str, query: str, body: str):
+        url = self.base_url + path + (f"?{query}" if query else "")
+        request = Request(url, data=body.encode() if body is not None else None, method=method,
+                          headers={"Content-Type": "application/json", **self.headers})
+        start = time.perf_counter()
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                status, raw, headers = response.status, response.read(), response.headers
+        except HTTPError as e:
+            status, raw, headers = e.code, e.read(), e.headers
+        ms = (time.perf_counter() - start) * 1000
+        try:
+            parsed = json.loads(raw) if raw else None
+        except ValueError:
+            parsed = raw.decode("utf-8", "replace")
+        return status, parsed, ms, server_timing_ms(headers)
+
+    def replay(self, record: dict, previous: Future = None):
+        if previous is not None:
+            previous.result()
+
+        params = dict(record["path_params"])
+        captured_cart = params.get("cart_id")
+        if captured_cart is not None and captured_cart in self.cart_ids:
+            params["cart_id"] = self.cart_ids[captured_cart].result()
+            if params["cart_id"] is None:
+                self.add(record, None, None, None, None, "cart was never created in the replay")
+                return
+        path = record["route"].format(**{name: quote(str(value), safe="") for name, value in params.items()})
+
+        new_cart = created_cart(record)
+        try:
+            status, response, ms, server_ms = self.send(record["method"], path, record["query"], record["body"])
+        except (URLError, OSError) as e:
+            if new_cart is not None:
+                self.cart_ids[new_cart].set_result(None)
+            self.add(record, None, None, None, None, str(e))
+            return
+
+        if new_cart is not None:
+            self.cart_ids[new_cart].set_result(response.get("cart_id") if isinstance(response, dict) else None)
+        self.add(record, status, response, ms, server_ms, None)
+
+    def add(self, record: dict, status, response, ms, server_ms, error):
+        with self.lock:
+            self.results.append({"record": record, "status": status, "response": response, "ms": ms,
+                                 "server_ms": server_ms, "error": error})
+
+    def dispatch(self, pool: ThreadPoolExecutor, record: dict, in_flight: list):
+        if is_barrier(record):
+            wait(in_flight)
+            in_flight.clear()
+            self.replay(record)
+            return
+
+        new_cart = created_cart(record)
+        if new_cart is not None:
+            self.cart_ids[new_cart] = Future()
+        cart = record["path_params"].get("cart_id", new_cart)
+        # calls are queued in order and the pool runs them FIFO, so waiting on an earlier one can't deadlock
+        future = pool.submit(self.replay, record, self.last_for_cart.get(cart) if cart is not None else None)
+        if cart is not None:
+            self.last_for_cart[cart] = future
+        in_flight.append(future)
+
+
+def set_clock(tick: list, settle_seconds: float):
+    """
+    Moves curr_time on the local database, then gives the server's game clock time to follow
+    (the potion_shop_tick notification, or its refresh interval if the server isn't listening).
+    """
+    import sqlalchemy
+    from src import database as db
+
+    host = db.engine.url.host or "localhost"
+    if host not in LOCAL_HOSTS:
+        sys.exit(f"Refusing to set curr_time on non-local database host {host!r}")
+    with db.engine.begin() as connection:
+        connection.execute(sqlalchemy.text("UPDATE curr_time SET day = :day, hour = :hour"),
+                           {"day": tick[0], "hour": tick[1]})
+    time.sleep(settle_seconds)
+
+
+def run(records: list, replayer: Replayer, speed: float, concurrency: int,
+        clock: bool = False, clock_settle: float = 0.5):
+    in_flight = []
+    current_tick = None
+    start = time.perf_counter()
+    first_t = records[0]["t"]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for record in records:
+            if clock and record["tick"] is not None and record["tick"] != current_tick:
+                wait(in_flight)
+                in_flight.clear()
+                current_tick = record["tick"]
+                set_clock(current_tick, clock_settle)
+                # pacing restarts at each tick, the settle time isn't part of the captured gaps
+                start = time.perf_counter()
+                first_t = record["t"]
+            if speed > 0:
+                delay = (record["t"] - first_t) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            replayer.dispatch(pool, record, in_flight)
+        wait(in_flight)
+
+
+def report(results: list, wall_seconds: float, show_diffs: int):
+    by_endpoint = {}
+    diffs = []
+    for result in results:
+        record = result["record"]
+        entry = by_endpoint.setdefault(endpoint(record), {
+            "captured_ms": [], "server_ms": [], "replay_ms": [], "status_diffs": 0, "body_diffs": 0, "errors": 0,
+        })
+        if record["ms"] is not None:
+            entry["captured_ms"].append(record["ms"])
+        if result["error"] is not None:
+            entry["errors"] += 1
+            diffs.append(result)
+            continue
+        entry["replay_ms"].append(result["ms"])
+        if result["server_ms"] is not None:
+            entry["server_ms"].append(result["server_ms"])
+        if result["status"] != record["status"]:
+            entry["status_diffs"] += 1
+            diffs.append(result)
+        elif record["response"] is not None and \
+                comparable(record, result["response"]) != comparable(record, record["response"]):
+            entry["body_diffs"] += 1
+            diffs.append(result)
+
+    def ms_columns(values: list, pcts: tuple):
+        if not values:
+            return "".join(f"{'-':>9}" for pct in pcts)
+        values = sorted(values)
+        return "".join(f"{percentile(values, pct):>9.2f}" for pct in pcts)
+
+    print("\nms: cap = captured handler, srv = replayed handler (Server-Timing), rtt = replay round trip")
+    print(f"{'endpoint':<40}{'calls':>7}{'cap p50':>9}{'cap p95':>9}{'srv p50':>9}{'srv p95':>9}"
+          f"{'rtt p50':>9}{'rtt p95':>9}{'rtt p99':>9}{'status':>8}{'body':>6}{'errors':>8}")
+    for name, entry in sorted(by_endpoint.items()):
+        calls = len(entry["replay_ms"]) + entry["errors"]
+        print(f"{name:<40}{calls:>7}{ms_columns(entry['captured_ms'], (50, 95))}"
+              f"{ms_columns(entry['server_ms'], (50, 95))}{ms_columns(entry['replay_ms'], (50, 95, 99))}"
+              f"{entry['status_diffs']:>8}{entry['body_diffs']:>6}{entry['errors']:>8}")
+    if not any(entry["server_ms"] for entry in by_endpoint.values()):
+        print("(no Server-Timing from the server, start it with POTION_SHOP_SERVER_TIMING=1 for srv)")
+
+    total = len(results)
+    print(f"\n{total} requests in {wall_seconds:.2f}s = {total / wall_seconds:.1f} req/s, "
+          f"{len(diffs)} differed from the capture")
+
+    for result in diffs[:show_diffs]:
+        record = result["record"]
+        print(f"\n{endpoint(record)} {record['path_params']} tick={record['tick']}")
+        if result["error"] is not None:
+            print(f"  error:    {result['error']}")
+            continue
+        print(f"  captured: {record['status']} {json.dumps(record['response'])[:500]}")
+        print(f"  replayed: {result['status']} {json.dumps(result['response'])[:500]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured potion shop traffic against a local server")
+    parser.add_argument("captures", nargs="+", help="NDJSON files written by capture.py")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--day", type=int, help="only replay this game day")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = real time, 0 = as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--api-key", default=os.environ.get("API_KEY", ""))
+    parser.add_argument("--api-key-header", default="access_token")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--set-clock", action="store_true",
+                        help="set curr_time on the local database (src.database) at each captured tick")
+    parser.add_argument("--clock-settle", type=float, default=0.5,
+                        help="seconds to wait after setting curr_time for the server to pick it up; "
+                             "use its clock refresh (5) if it runs with POTION_SHOP_LISTEN=0")
+    parser.add_argument("--show-diffs", type=int, default=10)
+    parser.add_argument("--force", action="store_true", help="allow a non-local server")
+    args = parser.parse_args()
+
+    check_local(args.url, args.force)
+    records = load_records(args.captures, args.day)
+    if not records:
+        sys.exit("Nothing to replay")
+    ticks = sorted({tuple(record["tick"]) for record in records if record["tick"] is not None})
+    print(f"Replaying {len(records)} requests over {len(ticks)} ticks at "
+          f"{'max speed' if args.speed <= 0 else f'{args.speed}x'} against {args.url}")
+
+    replayer = Replayer(args.url, {args.api_key_header: args.api_key}, args.timeout)
+    start = time.perf_counter()
+    run(records, replayer, args.speed, args.concurrency, args.set_clock, args.clock_settle)
+    report(replayer.results, time.perf_counter() - start, args.show_diffs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+from contextlib import contextmanager
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from src import database as db
+from src.api import instrumentation
+from src.api.game_clock import clock as game_clock
+
+import logging
+import os
+import threading
+
+"""
+Read-replica routing. Read-only handlers take read_transaction(router), writes
+take write_transaction(router); everything goes to the primary (db.engine)
+unless a replica is configured:
+
+    POTION_SHOP_REPLICA_URL=postgresql://...@localhost:5433/potions
+    POTION_SHOP_REPLICA_ROUTERS=carts,sales    # routers allowed to read from it
+    POTION_SHOP_REPLICA_POOL_SIZE / POTION_SHOP_REPLICA_MAX_OVERFLOW
+
+Read-your-writes: once anything writes in a game tick, reads stay on the primary
+for the rest of that tick, since the replica may not have replayed the write yet.
+That's any router, not just the one reading: barrels writes the ml the bottler
+plans with, checkouts write the gold barrels plans with. If the replica can't be
+reached, reads fall back to the primary.
+
+The pin is per worker process, a write that went to another worker doesn't move
+it. So by default only carts (search, export) and sales (trailing demand) read
+from the replica; the barrel and bottle plans decide what gold and ml to spend,
+run once a tick and stay on the primary.
+"""
+
+logger = logging.getLogger(__name__)
+
+replica_url = os.environ.get("POTION_SHOP_REPLICA_URL")
+replica_routers = {router.strip() for router in
+                   os.environ.get("POTION_SHOP_REPLICA_ROUTERS", "carts,sales").split(",") if router.strip()}
+
+replica_engine = None
+if replica_url:
+    replica_engine = create_engine(
+        replica_url,
+        pool_size=int(os.environ.get("POTION_SHOP_REPLICA_POOL_SIZE", "10")),
+        max_overflow=int(os.environ.get("POTION_SHOP_REPLICA_MAX_OVERFLOW", "10")),
+        pool_pre_ping=True,
+    )
+    instrumentation.install(replica_engine)
+
+# (day, hour) of the last committed write, from any router
+last_write = {"tick": None}
+write_lock = threading.Lock()
+
+
+def read_engine(router: str):
+    """
+    Engine a read for this router should use right now.
+    """
+    if replica_engine is None or router not in replica_routers:
+        return db.engine
+    now = game_clock.last_known()
+    with write_lock:
+        wrote_at = last_write["tick"]
+    # tick unknown, or something was written this tick -> the replica might be behind us
+    if now is None or wrote_at == now:
+        return db.engine
+    return replica_engine
+
+
+def read_connection(router: str, pool_for=None):
+    """
+    Connection for a read from this router, on the primary if the replica can't be reached.
+    pool_for(engine) picks what to actually connect with, for callers with a pool of their own
+    next to the primary and the replica.
+    """
+    pool_for = pool_for or (lambda engine: engine)
+    engine = read_engine(router)
+    try:
+        return pool_for(engine).connect()
+    except OperationalError as e:
+        if engine is db.engine:
+            raise
+        logger.warning("Replica unavailable for %s, reading from the primary: %s", router, e)
+        return pool_for(db.engine).connect()
+
+
+@contextmanager
+def read_transaction(router: str):
+    connection = read_connection(router)
+    with connection, connection.begin():
+        yield connection
+
+
+@contextmanager
+def write_transaction(router: str):
+    with db.engine.begin() as connection:
+        yield connection
+    # only after the commit, a failed write doesn't pin reads to the primary
+    now = game_clock.last_known()
+    with write_lock:
+        last_write["tick"] = now
@@ -0,0 +1,75 @@
+from fastapi import APIRouter, Depends
+from src.api import auth
+from src.api import instrumentation
+from src.api import planning
+from src.api import replica_database
+from src.api import statements
+from src.api.game_clock import clock as game_clock
+
+import logging
+
+"""
+Trailing demand from the hourly sales rollup (potion_sales_hourly, migrations/007),
+which checkout keeps up to date. One primary key range scan per call, so the
+planners can afford it at plan time.
+"""
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/sales",
+    tags=["sales"],
+    dependencies=[Depends(auth.get_api_key), Depends(instrumentation.track_request)],
+)
+
+HOURS_PER_DAY = 24
+
+# (game_day, game_hr) > (:from_day, :from_hr) is a row comparison, so it's a range on the primary key
+trailing_sales_sql = statements.register("sales.trailing", """
+                                SELECT potion_inventory.id AS potion_id,
+                                       potion_inventory.sku,
+                                       potion_inventory.potion_type,
+                                       SUM(potion_sales_hourly.quantity) AS quantity,
+                                       SUM(potion_sales_hourly.gold) AS gold
+                                FROM potion_sales_hourly
+                                JOIN potion_inventory ON potion_inventory.id = potion_sales_hourly.potion_id
+                                WHERE (potion_sales_hourly.game_day, potion_sales_hourly.game_hr) > (:from_day, :from_hr)
+                                GROUP BY potion_inventory.id, potion_inventory.sku, potion_inventory.potion_type
+                                """)
+
+
+def window_start(game_day: int, game_hr: int, hours: int):
+    """
+    (day, hour) just before the window, so "> start" covers the last `hours` hours including this one.
+    Days are integers that count up and hours run 0..23, migrations/012 checks both.
+    """
+    return divmod(game_day * HOURS_PER_DAY + game_hr - hours, HOURS_PER_DAY)
+
+
+def trailing_demand(connection, hours: int):
+    """
+    Sales over the last `hours` game hours:
+        {"potions": {potion_id: {sku, quantity, gold}}, "colors": {red: ml, green: ml, blue: ml, dark: ml}}
+    Colour demand is the ml those potions took to bottle.
+    """
+    game_day, game_hr = game_clock.current(connection)
+    from_day, from_hr = window_start(game_day, game_hr, hours)
+    rows = connection.execute(trailing_sales_sql, {"from_day": from_day, "from_hr": from_hr}).fetchall()
+
+    potions = {}
+    colors = {color: 0 for color in planning.COLORS}
+    for row in rows:
+        potions[row.potion_id] = {"sku": row.sku, "quantity": row.quantity, "gold": row.gold}
+        for color, ratio in zip(planning.COLORS, row.potion_type):
+            colors[color] += ratio * row.quantity
+
+    return {"potions": potions, "colors": colors}
+
+
+@router.get("/demand")
+def get_demand(hours: int = 24):
+    """
+    Trailing demand per potion and per colour over the last `hours` game hours.
+    """
+    with replica_database.read_transaction("sales") as connection:
+        return trailing_demand(connection, hours)
@@ -0,0 +1,262 @@
+from src.api import planning
+
+import argparse
+import itertools
+import logging
+import random
+import time
+from collections import namedtuple
+
+"""
+Offline tick simulator for the barrel and bottle planners. Keeps the ledgers,
+capacity and customer demand in memory and calls the same planning code the
+/barrels and /bottler routes use, so goal_ml, bottle_goal and the greedy gold
+thresholds can be tuned without touching the live game or a database.
+
+    python -m src.api.simulator --days 1000
+    python -m src.api.simulator --days 365 --strategy greedy optimal --objective goal_fill value
+    python -m src.api.simulator --capacity 50000 --lg-goal 20000 --large-gold 1500
+
+Same --seed means same catalog and same customers for every configuration, so
+the numbers in the comparison table only differ by the planner settings.
+"""
+
+logger = logging.getLogger(__name__)
+
+WholesaleBarrel = namedtuple("WholesaleBarrel", ["sku", "ml_per_barrel", "potion_type", "price", "quantity"])
+Delivered = namedtuple("Delivered", ["potion_type", "quantity"])
+
+# the catalog the game offers every day (see the WHOLESALE CATALOG note in barrels.py)
+WHOLESALE_CATALOG = [
+    WholesaleBarrel('SMALL_RED_BARREL', 500, [1, 0, 0, 0], 100, 10),
+    WholesaleBarrel('SMALL_GREEN_BARREL', 500, [0, 1, 0, 0], 100, 10),
+    WholesaleBarrel('SMALL_BLUE_BARREL', 500, [0, 0, 1, 0], 120, 10),
+    WholesaleBarrel('MEDIUM_RED_BARREL', 2500, [1, 0, 0, 0], 250, 10),
+    WholesaleBarrel('MEDIUM_GREEN_BARREL', 2500, [0, 1, 0, 0], 250, 10),
+    WholesaleBarrel('MEDIUM_BLUE_BARREL', 2500, [0, 0, 1, 0], 300, 10),
+    WholesaleBarrel('MINI_RED_BARREL', 200, [1, 0, 0, 0], 60, 1),
+    WholesaleBarrel('MINI_GREEN_BARREL', 200, [0, 1, 0, 0], 60, 1),
+    WholesaleBarrel('MINI_BLUE_BARREL', 200, [0, 0, 1, 0], 60, 1),
+    WholesaleBarrel('LARGE_DARK_BARREL', 10000, [0, 0, 0, 1], 750, 10),
+    WholesaleBarrel('LARGE_BLUE_BARREL', 10000, [0, 0, 1, 0], 600, 30),
+    WholesaleBarrel('LARGE_GREEN_BARREL', 10000, [0, 1, 0, 0], 400, 30),
+    WholesaleBarrel('LARGE_RED_BARREL', 10000, [1, 0, 0, 0], 500, 30),
+]
+
+# potion_inventory rows: sku, potion_type, price, bottle_goal, and how often customers ask for it
+POTIONS = [
+    {"sku": "RED_POTION", "potion_type": [100, 0, 0, 0], "price": 50, "bottle_goal": 20, "popularity": 3},
+    {"sku": "GREEN_POTION", "potion_type": [0, 100, 0, 0], "price": 50, "bottle_goal": 20, "popularity": 3},
+    {"sku": "BLUE_POTION", "potion_type": [0, 0, 100, 0], "price": 55, "bottle_goal": 20, "popularity": 2},
+    {"sku": "DARK_POTION", "potion_type": [0, 0, 0, 100], "price": 70, "bottle_goal": 10, "popularity": 1},
+    {"sku": "PURPLE_POTION", "potion_type": [50, 0, 50, 0], "price": 60, "bottle_goal": 15, "popularity": 2},
+    {"sku": "YELLOW_POTION", "potion_type": [50, 50, 0, 0], "price": 55, "bottle_goal": 15, "popularity": 2},
+    {"sku": "TEAL_POTION", "potion_type": [0, 50, 50, 0], "price": 55, "bottle_goal": 15, "popularity": 1},
+]
+
+# the game ticks every 2 hours, barrels are sold once a day on the first tick
+TICK_HOURS = range(0, 24, 2)
+BARREL_HOUR = 0
+
+
+class SimulatedShop:
+    """
+    In-memory stand-in for the shop's tables: append-only ledgers plus the running
+    balances the ledger triggers keep (migrations/002), capacity, potion_inventory and goal_ml.
+    """
+
+    def __init__(self, gold: int, ml_capacity: int, goal_ml: dict, potions: list, keep_ledgers: bool = True):
+        self.gold = 0
+        self.ml = {color: 0 for color in planning.COLORS}
+        self.ml_capacity = ml_capacity
+        self.goal_ml = goal_ml
+        self.potions = [dict(potion, quantity=0) for potion in potions]
+        self.by_type = {tuple(potion["potion_type"]): potion for potion in self.potions}
+        self.by_sku = {potion["sku"]: potion for potion in self.potions}
+
+        self.keep_ledgers = keep_ledgers
+        self.gold_ledger = []
+        self.ml_ledger = []
+        self.potion_ledger = []
+
+        self.stats = {"revenue": 0, "barrel_gold": 0, "barrels": 0, "ml_bought": 0,
+                      "bottled": 0, "sold": 0, "lost_sales": 0, "rejected_plans": 0}
+
+        self.post_gold(gold, 0, 0, 'opening balance')
+
+    def post_gold(self, transactions: int, game_day: int, game_hr: int, reason: str):
+        self.gold += transactions
+        if self.keep_ledgers:
+            self.gold_ledger.append((game_day, game_hr, transactions, reason))
+
+    def post_ml(self, ml: dict, game_day: int, game_hr: int):
+        for color in planning.COLORS:
+            self.ml[color] += ml[color]
+        if self.keep_ledgers:
+            self.ml_ledger.append((game_day, game_hr, ml))
+
+    def post_potion(self, potion: dict, transaction: int, game_day: int, game_hr: int, reason: str):
+        potion["quantity"] += transaction
+        if self.keep_ledgers:
+            self.potion_ledger.append((game_day, game_hr, potion["sku"], transaction, reason))
+
+    def check_balances(self):
+        """
+        Same check as reconcile.py: the running balances have to match the ledger sums.
+        """
+        if not self.keep_ledgers:
+            return True
+        gold = sum(entry[2] for entry in self.gold_ledger)
+        ml = {color: sum(entry[2][color] for entry in self.ml_ledger) for color in planning.COLORS}
+        potions = {}
+        for game_day, game_hr, sku, transaction, reason in self.potion_ledger:
+            potions[sku] = potions.get(sku, 0) + transaction
+        return gold == self.gold and ml == self.ml \
+            and all(potions.get(potion["sku"], 0) == potion["quantity"] for potion in self.potions)
+
+
+def barrel_tick(shop: SimulatedShop, catalog: list, game_day: int, game_hr: int, strategy: str, thresholds: dict):
+    """
+    get_wholesale_purchase_plan + post_deliver_barrels, without the SQL.
+    """
+    if strategy == "optimal":
+        free_ml = min(shop.ml_capacity - sum(shop.ml.values()), shop.goal_ml["lg_goal"])
+        plan = planning.solve_barrel_purchase(catalog, shop.gold, dict(shop.ml), free_ml)
+    else:
+        plan = planning.plan_greedy_barrels(catalog, shop.gold, dict(shop.ml), shop.ml_capacity,
+                                            shop.goal_ml, thresholds)
+
+    delivered = [WholesaleBarrel(**barrel) for barrel in plan]
+    ml_added, gold_to_pay = planning.barrel_delivery_totals(delivered)
+
+    # the game refuses plans that cost more than we have or overflow capacity
+    if shop.gold + gold_to_pay < 0 or sum(shop.ml.values()) + sum(ml_added.values()) > shop.ml_capacity:
+        shop.stats["rejected_plans"] += 1
+        logger.debug("Day %s: plan rejected, %s gold / %s ml for %s", game_day, gold_to_pay, ml_added, plan)
+        return
+
+    if delivered:
+        shop.post_ml(ml_added, game_day, game_hr)
+        shop.post_gold(gold_to_pay, game_day, game_hr, 'barrel delivery')
+        shop.stats["barrel_gold"] -= gold_to_pay
+        shop.stats["barrels"] += sum(barrel.quantity for barrel in delivered)
+        shop.stats["ml_bought"] += sum(ml_added.values())
+
+
+def bottle_tick(shop: SimulatedShop, game_day: int, game_hr: int, objective: str):
+    """
+    get_bottle_plan + post_deliver_bottles, without the SQL.
+    """
+    mixes = sorted(shop.potions, key=lambda potion: potion["quantity"])
+    plan = planning.plan_bottles(mixes, [shop.ml[color] for color in planning.COLORS], objective)
+    if not plan:
+        return
+
+    delivered = [Delivered(potion["potion_type"], potion["quantity"]) for potion in plan]
+    ml_to_subtract, potion_rows = planning.bottle_delivery_totals(delivered)
+    shop.post_ml(ml_to_subtract, game_day, game_hr)
+    for row in potion_rows:
+        shop.post_potion(shop.by_type[tuple(row["potion_type"])], row["transaction"],
+                         game_day, game_hr, 'Bobo be bottling')
+        shop.stats["bottled"] += row["transaction"]
+
+
+def customer_tick(shop: SimulatedShop, customers: list, game_day: int, game_hr: int):
+    """
+    Carts that check out this tick: every customer wants (sku, quantity), sold only if we have all of it.
+    """
+    for sku, quantity in customers:
+        potion = shop.by_sku[sku]
+        if potion["quantity"] < quantity:
+            shop.stats["lost_sales"] += quantity
+            continue
+        shop.post_potion(potion, -quantity, game_day, game_hr, 'customer purchase')
+        shop.post_gold(quantity * potion["price"], game_day, game_hr, 'customer purchase')
+        shop.stats["revenue"] += quantity * potion["price"]
+        shop.stats["sold"] += quantity
+
+
+def demand(rng: random.Random, potions: list, max_customers: int):
+    """
+    One tick of customers. Drawn the same way whatever the shop's state, so a seed gives
+    every configuration the same demand.
+    """
+    skus = [potion["sku"] for potion in potions]
+    weights = [potion["popularity"] for potion in potions]
+    count = rng.randint(0, max_customers)
+    return list(zip(rng.choices(skus, weights, k=count), [rng.randint(1, 3) for _ in range(count)]))
+
+
+def simulate(days: int, seed: int, strategy: str = "greedy", objective: str = "goal_fill",
+             gold: int = 100, ml_capacity: int = 10000, goal_ml: dict = None,
+             bottle_goal_scale: float = 1.0, thresholds: dict = planning.GREEDY_THRESHOLDS,
+             max_customers: int = 6, keep_ledgers: bool = True):
+    """
+    Plays `days` game days tick by tick and returns the shop's totals.
+    """
+    goal_ml = goal_ml or {"med_goal": 10000, "lg_goal": 30000, "low_ml_limit": 500}
+    potions = [dict(potion, bottle_goal=max(1, int(potion["bottle_goal"] * bottle_goal_scale))) for potion in POTIONS]
+    shop = SimulatedShop(gold, ml_capacity, goal_ml, potions, keep_ledgers)
+
+    catalog_rng = random.Random(seed)
+    demand_rng = random.Random(seed + 1)
+
+    for game_day in range(days):
+        # catalog quantities move a little day to day, like the real wholesaler
+        catalog = [barrel._replace(quantity=catalog_rng.randint(0, barrel.quantity)) for barrel in WHOLESALE_CATALOG]
+        for game_hr in TICK_HOURS:
+            if game_hr == BARREL_HOUR:
+                barrel_tick(shop, catalog, game_day, game_hr, strategy, thresholds)
+            bottle_tick(shop, game_day, game_hr, objective)
+            customer_tick(shop, demand(demand_rng, potions, max_customers), game_day, game_hr)
+
+    return {
+        **shop.stats,
+        "gold": shop.gold,
+        "ml_left": sum(shop.ml.values()),
+        "potions_left": sum(potion["quantity"] for potion in shop.potions),
+        "balanced": shop.check_balances(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline simulator for the barrel and bottle planners")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--strategy", nargs="+", default=["greedy"], choices=["greedy", "optimal"])
+    parser.add_argument("--objective", nargs="+", default=["goal_fill"], choices=["goal_fill", "value"])
+    parser.add_argument("--gold", type=int, default=100, help="starting gold")
+    parser.add_argument("--capacity", type=int, default=10000, help="ml capacity")
+    parser.add_argument("--med-goal", type=int, default=10000)
+    parser.add_argument("--lg-goal", type=int, default=30000)
+    parser.add_argument("--low-ml-limit", type=int, default=500)
+    parser.add_argument("--bottle-goal-scale", type=float, nargs="+", default=[1.0],
+                        help="multiplies every potion's bottle_goal")
+    parser.add_argument("--customers", type=int, default=6, help="max customers per tick")
+    for name, value in planning.GREEDY_THRESHOLDS.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=int, default=value)
+    parser.add_argument("--no-ledgers", action="store_true", help="only keep balances (faster, skips the ledger check)")
+    args = parser.parse_args()
+
+    goal_ml = {"med_goal": args.med_goal, "lg_goal": args.lg_goal, "low_ml_limit": args.low_ml_limit}
+    thresholds = {name: getattr(args, name) for name in planning.GREEDY_THRESHOLDS}
+
+    columns = ["strategy", "objective", "goal x", "gold", "revenue", "barrel gold", "sold", "lost",
+               "ml left", "potions left", "rejected", "days/s"]
+    print(" | ".join(columns))
+    for strategy, objective, scale in itertools.product(args.strategy, args.objective, args.bottle_goal_scale):
+        start = time.perf_counter()
+        result = simulate(args.days, args.seed, strategy, objective, args.gold, args.capacity, goal_ml,
+                          scale, thresholds, args.customers, not args.no_ledgers)
+        elapsed = time.perf_counter() - start
+        if not result["balanced"]:
+            print("ledgers and balances disagree for", strategy, objective, scale)
+        print(" | ".join(str(value) for value in [
+            strategy, objective, scale, result["gold"], result["revenue"], result["barrel_gold"],
+            result["sold"], result["lost_sales"], result["ml_left"], result["potions_left"],
+            result["rejected_plans"], round(args.days / elapsed),
+        ]))
+
+
+if __name__ == "__main__":
+    main()
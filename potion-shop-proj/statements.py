@@ -0,0 +1,37 @@
+import sqlalchemy
+
+"""
+Registry of named statements for the routers. Every statement is built once at
+import and reused, so SQLAlchemy's compiled cache and the driver's prepared
+statement cache (asyncpg, see async_database) see the same text every time and
+Postgres only parses/plans each one once per connection.
+
+Handlers shouldn't build SQL per call: anything with variants (like the search
+sort/filter combinations in carts) registers each variant up front under its own name.
+"""
+
+registry = {}
+
+
+def register(name: str, sql: str):
+    """
+    Builds and registers the statement, returns it so modules can keep a handle:
+
+        checkout_sql = statements.register("carts.checkout", "...")
+    """
+    if name in registry:
+        raise ValueError(f"statement {name!r} is already registered")
+    statement = sqlalchemy.text(sql)
+    registry[name] = statement
+    return statement
+
+
+def get(name: str):
+    return registry[name]
+
+
+def texts():
+    """
+    Every registered statement's SQL, for the benchmark's distinct statement count.
+    """
+    return {str(statement) for statement in registry.values()}